@@ -0,0 +1,154 @@
+"""
+Measurements shared by the offline benchmarks
+
+The benchmarks time each step of a task as reported through progress.step_changed. The peak memory and the
+bytes written are read from /proc, so on other platforms only the peak memory of the whole process so far
+is reported and the bytes written are None.
+"""
+from .progress import step_changed
+from django.conf import settings
+from contextlib import contextmanager
+import datetime
+import platform
+import resource
+import time
+import json
+import sys
+
+
+def memory_high_water():
+    """
+    :return: the peak resident memory of this process in bytes since the last reset_high_water()
+    """
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def reset_high_water():
+    """
+    start measuring the peak memory again from the current memory, where the kernel allows it
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except OSError:
+        pass
+
+
+def bytes_written():
+    """
+    :return: the number of bytes this process has written so far, or None if it isn't known
+    """
+    try:
+        with open('/proc/self/io') as fp:
+            for line in fp:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class StageRecorder(object):
+    """
+    measure the wall time, peak memory and bytes written of each stage of a run
+    the stages are started with start() or by the steps of the tasks running in this process
+    """
+    def __init__(self):
+        self.stages = []
+        self._current = None
+
+    def __enter__(self):
+        step_changed.connect(self._step_changed)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        step_changed.disconnect(self._step_changed)
+
+    def _step_changed(self, sender, task_id=None, step=None, **kwargs):
+        if step is None:
+            self.stop()
+        else:
+            self.start(step)
+
+    def start(self, name):
+        """
+        end the current stage and start the next
+        """
+        self.stop()
+        reset_high_water()
+        self._current = (name, time.perf_counter(), bytes_written())
+
+    def stop(self):
+        """
+        end the current stage, if there is one
+        """
+        if self._current is None:
+            return
+        name, started, written = self._current
+        written_now = bytes_written()
+        self.stages.append({
+            'name': name,
+            'seconds': round(time.perf_counter() - started, 4),
+            'peak_rss_bytes': memory_high_water(),
+            'bytes_written': written_now - written if written is not None and written_now is not None else None,
+        })
+        self._current = None
+
+
+@contextmanager
+def benchmark_settings(**values):
+    """
+    change some settings while a benchmark runs the real tasks in this process, e.g. to point them at stand-in
+    locations, and put them back afterwards
+    only for the management commands that run the benchmarks, never in the web server or a worker
+    :param values: the settings to change
+    """
+    missing = object()
+    previous = {name: getattr(settings, name, missing) for name in values}
+    for name, value in values.items():
+        setattr(settings, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is missing:
+                delattr(settings, name)
+            else:
+                setattr(settings, name, value)
+
+
+def environment():
+    """
+    :return: dict describing the machine the benchmark ran on, to compare runs over time
+    """
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+    }
+
+
+def write_results(results, output=None, stream=None):
+    """
+    write the results as JSON to a file, or to a stream
+    :param results: the JSON serialisable results
+    :param output: the filename, or None to write to the stream
+    :param stream: the stream to write to if there is no filename, defaults to stdout
+    """
+    content = json.dumps(results, indent=2) + '\n'
+    if output:
+        with open(output, 'w', encoding='utf-8') as fp:
+            fp.write(content)
+    else:
+        (stream or sys.stdout).write(content)
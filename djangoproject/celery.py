@@ -15,3 +15,6 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
+
+# keep the cached task states up to date, and time the tasks, from the task signals
+from . import status, metrics  # noqa: E402,F401
@@ -8,3 +8,4 @@ class UploadFileForm(forms.Form):
 class RangeForm(forms.Form):
     start_chapter = forms.IntegerField(label='Start at chapter', min_value=1)
     stop_chapter = forms.IntegerField(label='Stop at chapter', min_value=1)
+    force = forms.BooleanField(label='Also bake unchanged chapters', required=False)
@@ -0,0 +1,288 @@
+"""
+Timings and counters of the tasks, exported in the Prometheus text format
+
+Each process (the web server and every prefork Celery worker process) keeps its own counters and histograms
+and writes them to a file of its own in METRICS_LOCATION. The /metrics view adds up the files of all the
+processes, so the numbers survive worker processes being replaced until the process has gone, when its file is
+deleted (which Prometheus sees as a counter reset). Set METRICS_LOCATION to None to turn the collection off.
+"""
+from django.conf import settings
+from contextlib import contextmanager
+from celery import signals
+import tempfile
+import threading
+import logging
+import socket
+import time
+import json
+import os
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+# write the metrics of a busy process at most this often, in seconds, and always when a task finishes
+FLUSH_INTERVAL = 5
+# the files of processes on other hosts, and stray temporary files, are deleted once they haven't been written for
+# this many seconds, the files of processes on this host as soon as the process has gone
+STALE_AGE = 24 * 60 * 60
+# the header added to each task message with the time it was sent, to work out how long it was queued for
+PUBLISHED_HEADER = 'estoria_published_at'
+
+METRICS = {
+    'estoria_task_duration_seconds': ('histogram', 'Time taken by each task.'),
+    'estoria_task_queue_wait_seconds': ('histogram', 'Time from a task being sent to it starting.'),
+    'estoria_tasks_total': ('counter', 'Finished tasks, by outcome.'),
+    'estoria_script_duration_seconds': ('histogram', 'Time taken by each run of a management script.'),
+    'estoria_scripts_total': ('counter', 'Runs of the management scripts, by outcome.'),
+    'estoria_file_copy_duration_seconds': ('histogram', 'Time taken copying the inputs of a job.'),
+    'estoria_zip_build_duration_seconds': ('histogram', 'Time taken writing a conversion zip.'),
+    'estoria_chapter_bake_duration_seconds': ('histogram', 'Time taken baking one chapter.'),
+    'estoria_chapters_total': ('counter', 'Chapters in baking tasks, by outcome.'),
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_last_flush = 0
+_filename = None
+
+
+def metrics_location():
+    """
+    :return: the directory the metrics of each process are written to, or None if metrics are turned off
+    """
+    return getattr(settings, 'METRICS_LOCATION', os.path.join(tempfile.gettempdir(), 'estoria-admin-metrics'))
+
+
+def _key(labels):
+    return json.dumps(sorted(labels.items()))
+
+
+def increment(name, amount=1, **labels):
+    """
+    add to a counter
+    :param name: the name of the counter, from METRICS
+    :param labels: the labels of the counter, e.g. task='estoria_app.tasks.bake_chapters'
+    """
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[_key(labels)] = series.get(_key(labels), 0) + amount
+    _maybe_flush()
+
+
+def observe(name, seconds, **labels):
+    """
+    record a duration in a histogram
+    :param name: the name of the histogram, from METRICS
+    :param seconds: the duration
+    :param labels: the labels of the histogram
+    """
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        # one count for each bucket, then the sum and the count
+        values = series.setdefault(_key(labels), [0] * (len(BUCKETS) + 2))
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                values[i] += 1
+        values[-2] += seconds
+        values[-1] += 1
+    _maybe_flush()
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    time the block into a histogram
+    """
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - started, **labels)
+
+
+def flush():
+    """
+    write the metrics of this process to its file in metrics_location()
+    """
+    global _last_flush, _filename
+    location = metrics_location()
+    if not location:
+        return
+    with _lock:
+        data = json.dumps({'counters': _counters, 'histograms': _histograms})
+        _last_flush = time.monotonic()
+        if _filename is None:
+            _filename = '{}-{}-{}.json'.format(socket.gethostname(), os.getpid(), int(time.time() * 1000))
+    try:
+        os.makedirs(location, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=location, suffix='.tmp')
+    except OSError as e:
+        logger.warning('could not write the metrics: {}'.format(e))
+        return
+    try:
+        with os.fdopen(handle, 'w') as fp:
+            fp.write(data)
+        os.replace(temporary, os.path.join(location, _filename))
+    except OSError as e:
+        logger.warning('could not write the metrics: {}'.format(e))
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    _prune(location)
+
+
+def _prune(location):
+    """
+    delete the files of the processes that have gone, so that they don't pile up
+    """
+    hostname = socket.gethostname()
+    now = time.time()
+    try:
+        names = os.listdir(location)
+    except OSError:
+        return
+    for name in names:
+        if name == _filename:
+            continue
+        path = os.path.join(location, name)
+        parts = name[:-len('.json')].rsplit('-', 2) if name.endswith('.json') else []
+        try:
+            if len(parts) == 3 and parts[0] == hostname and parts[1].isdigit():
+                stale = not _running(int(parts[1]))
+            else:
+                stale = now - os.path.getmtime(path) > STALE_AGE
+            if stale:
+                os.remove(path)
+        except OSError:
+            # e.g. another process deleted it first
+            continue
+
+
+def _running(pid):
+    """
+    :return: whether a process with this pid is running on this host
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # it is running as another user
+        return True
+    return True
+
+
+def _maybe_flush():
+    if time.monotonic() - _last_flush >= FLUSH_INTERVAL:
+        flush()
+
+
+def _reset():
+    """
+    start again with no metrics and a new file, for a forked child process
+    """
+    global _counters, _histograms, _filename, _last_flush, _lock
+    _lock = threading.Lock()
+    _counters = {}
+    _histograms = {}
+    _filename = None
+    _last_flush = 0
+
+
+def collect():
+    """
+    add up the metrics written by all the processes
+    :return: (counters, histograms) in the same form as each process keeps them
+    """
+    flush()
+    counters = {}
+    histograms = {}
+    location = metrics_location()
+    if not location or not os.path.isdir(location):
+        return counters, histograms
+    for name in os.listdir(location):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(location, name)) as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            continue
+        for metric, series in data.get('counters', {}).items():
+            totals = counters.setdefault(metric, {})
+            for key, value in series.items():
+                totals[key] = totals.get(key, 0) + value
+        for metric, series in data.get('histograms', {}).items():
+            totals = histograms.setdefault(metric, {})
+            for key, values in series.items():
+                if key in totals:
+                    totals[key] = [a + b for a, b in zip(totals[key], values)]
+                else:
+                    totals[key] = list(values)
+    return counters, histograms
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels]
+    return '{' + ','.join(escaped) + '}'
+
+
+def render():
+    """
+    :return: the metrics of all the processes in the Prometheus text format
+    """
+    counters, histograms = collect()
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        if name not in counters and name not in histograms:
+            continue
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        if kind == 'counter':
+            for key, value in sorted(counters[name].items()):
+                lines.append('{}{} {}'.format(name, _format_labels(json.loads(key)), value))
+        else:
+            for key, values in sorted(histograms[name].items()):
+                labels = json.loads(key)
+                for bound, count in zip(BUCKETS, values):
+                    lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + [['le', str(bound)]]), count))
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + [['le', '+Inf']]), values[-1]))
+                lines.append('{}_sum{} {}'.format(name, _format_labels(labels), values[-2]))
+                lines.append('{}_count{} {}'.format(name, _format_labels(labels), values[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+# the start time of each running task in this process, by task id
+_started = {}
+
+
+def _before_task_publish(headers=None, **kwargs):
+    if headers is not None:
+        headers[PUBLISHED_HEADER] = time.time()
+
+
+def _task_prerun(task_id=None, task=None, **kwargs):
+    _started[task_id] = time.monotonic()
+    published = getattr(task.request, PUBLISHED_HEADER, None)
+    if published:
+        observe('estoria_task_queue_wait_seconds', max(0, time.time() - published), task=task.name)
+
+
+def _task_postrun(task_id=None, task=None, state=None, **kwargs):
+    started = _started.pop(task_id, None)
+    if started is not None:
+        observe('estoria_task_duration_seconds', time.monotonic() - started, task=task.name)
+    increment('estoria_tasks_total', task=task.name, outcome=(state or 'UNKNOWN').lower())
+    flush()
+
+
+signals.before_task_publish.connect(_before_task_publish, weak=False)
+signals.task_prerun.connect(_task_prerun, weak=False)
+signals.task_postrun.connect(_task_postrun, weak=False)
+signals.worker_process_shutdown.connect(lambda **kwargs: flush(), weak=False)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset)
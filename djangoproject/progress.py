@@ -0,0 +1,167 @@
+"""
+Progress of long running tasks
+
+A task reports its progress as the custom PROGRESS state, whose meta data is shown on the task status pages:
+
+    {'step': 'bake chapters', 'chapter': 12, 'done': 3, 'total': 10, 'elapsed': 41.2,
+     'steps': [{'name': 'fingerprint chapters', 'elapsed': 0.8}, {'name': 'bake chapters', 'elapsed': 40.4}]}
+
+The state is written to the result backend and to the cached task states, so it reaches the browser whether
+or not the cache is shared. The combined progress of a group of tasks is counted in the task state cache, so it
+is only reported when the cache is shared by the workers and adds one atomically (memcached or redis).
+"""
+from celery import current_app
+from django.core.cache.backends.memcached import BaseMemcachedCache
+from django.core.exceptions import ImproperlyConfigured
+from django.dispatch import Signal
+from . import status
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+PROGRESS = 'PROGRESS'
+GROUP_DONE_PREFIX = 'task-progress-done:'
+
+# sent with task_id and step as each step starts, and with step None when the task finishes, e.g. for the
+# benchmarks to measure each step
+step_changed = Signal()
+# sent with task_id and chapter as each item of a step is done
+item_done = Signal()
+
+
+class TaskProgress(object):
+    """
+    the steps of a running task and how far through the current one it is
+    """
+    def __init__(self, task_id, total=None, group_id=None, group_total=None, steps=None, done=0):
+        """
+        :param task_id: the id of the running task, if None the progress is only logged
+        :param total: the number of items the task works through, if known
+        :param group_id: the id that the combined progress of a group of tasks is reported under, e.g. the
+                         callback of the chord of baking shards
+        :param group_total: the number of items the whole group works through
+        :param steps: the steps that are already done, e.g. by the earlier tasks of a chain
+        :param done: the number of items that are already done
+        """
+        self.task_id = task_id
+        self.total = total
+        self.group_id = group_id
+        self.group_total = group_total
+        self.done = done
+        self.chapter = None
+        self.steps = [dict(step) for step in steps or []]
+        self.running = False
+        # the steps that are already done count towards the elapsed time of the whole task
+        self.started = time.monotonic() - sum(step['elapsed'] for step in self.steps)
+        self.step_started = time.monotonic()
+
+    def step(self, name, total=None):
+        """
+        start the next step of the task
+        :param name: the name of the step, e.g. the script that is run
+        :param total: the number of items the step works through, if it differs from the task's total
+        """
+        self._end_step()
+        step_changed.send(sender=TaskProgress, task_id=self.task_id, step=name)
+        self.steps.append({'name': name, 'elapsed': 0.0})
+        self.running = True
+        self.step_started = time.monotonic()
+        if total is not None:
+            self.total = total
+            self.done = 0
+        self.publish()
+
+    def advance(self, chapter=None):
+        """
+        record that one more item of the current step is done
+        :param chapter: the chapter that is being worked on, if the items are chapters
+        """
+        self.done += 1
+        self.chapter = chapter
+        item_done.send(sender=TaskProgress, task_id=self.task_id, chapter=chapter)
+        group_done = None
+        if self.group_id:
+            group_done = _increment(GROUP_DONE_PREFIX + self.group_id)
+        self.publish(group_done)
+
+    def finish(self):
+        """
+        end the last step
+        :return: list of the name and elapsed seconds of each step
+        """
+        self._end_step()
+        step_changed.send(sender=TaskProgress, task_id=self.task_id, step=None)
+        return self.steps
+
+    def meta(self):
+        """
+        :return: the meta data of the PROGRESS state
+        """
+        steps = [dict(step) for step in self.steps]
+        if self.running:
+            steps[-1]['elapsed'] = round(time.monotonic() - self.step_started, 1)
+        return {
+            'step': steps[-1]['name'] if steps else None,
+            'chapter': self.chapter,
+            'done': self.done,
+            'total': self.total,
+            'elapsed': round(time.monotonic() - self.started, 1),
+            'steps': steps,
+        }
+
+    def publish(self, group_done=None):
+        meta = self.meta()
+        if self.task_id:
+            _store(self.task_id, meta)
+        if self.group_id and group_done is not None:
+            _store(self.group_id, dict(meta, done=group_done, total=self.group_total, steps=[]))
+
+    def _end_step(self):
+        if self.running:
+            self.running = False
+            self.steps[-1]['elapsed'] = round(time.monotonic() - self.step_started, 1)
+            logger.debug('{}: {} took {}s'.format(self.task_id, self.steps[-1]['name'], self.steps[-1]['elapsed']))
+
+
+def _store(task_id, meta):
+    try:
+        current_app.backend.store_result(task_id, meta, PROGRESS)
+    except Exception as e:
+        # progress is only informative, so it must never fail the task
+        logger.warning('{}: could not store the progress: {!r}'.format(task_id, e))
+    status.set_status(task_id, PROGRESS, meta)
+
+
+def _increment(key):
+    """
+    add one to a counter in the task state cache, which needs a cache that is shared and adds one atomically, as
+    the tasks of a group count their items at the same time
+    :return: the new value, or None if the cache can't count them
+    """
+    try:
+        cache = status.shared_cache()
+    except ImproperlyConfigured as e:
+        # each process would count only its own items, so the group is left without a count rather than a wrong one
+        logger.warning('Not counting the progress of the group: {}'.format(e))
+        return None
+    if not _atomic(cache):
+        # the other caches read the counter and write it back, losing the items counted in between
+        logger.warning('Not counting the progress of the group: {} can\'t add one atomically, use memcached or '
+                       'redis for TASK_STATUS_CACHE'.format(type(cache).__name__))
+        return None
+    cache.add(key, 0, status.LONG_TIMEOUT)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # the counter expired in between
+        cache.set(key, 1, status.LONG_TIMEOUT)
+        return 1
+
+
+def _atomic(cache):
+    """
+    :return: whether the cache adds one to a counter in the cache server, in a single operation
+    """
+    return isinstance(cache, BaseMemcachedCache) or type(cache).__module__.startswith(
+        ('django_redis', 'django.core.cache.backends.redis'))
@@ -0,0 +1,173 @@
+"""
+Run the edition management scripts
+
+The scripts are normally run with a fresh python3 from the virtual environment. When SCRIPT_RUNNER is set
+to 'inprocess' the worker keeps the compiled scripts and the libraries they import (lxml etc.) warm and runs
+them inside the worker process instead, falling back to a subprocess if a script can't be loaded. The modules a
+script imports unconditionally at the top are imported before it starts, so that it falls back before it has written
+anything; imports inside a try or an if are left to the script, which may handle their ImportError itself, and an
+ImportError once the script has started fails the run like any other error.
+"""
+from django.conf import settings
+from . import metrics
+from contextlib import redirect_stdout, redirect_stderr
+from io import StringIO
+import subprocess
+import importlib
+import ast
+import threading
+import logging
+import sys
+import os
+
+logger = logging.getLogger(__name__)
+
+# compiled scripts, keyed by the full path of the script: (mtime, size, code object, imported modules)
+_code_cache = {}
+# the worker process wide state (argv, cwd, sys.path) is swapped for each run, so only one script at a time
+_run_lock = threading.Lock()
+
+
+class UnresolvedImport(ImportError):
+    """
+    a module the script imports at the top can't be imported in this process
+    """
+
+
+def python_path():
+    """
+    the python interpreter in the virtual environment used to run the scripts in a subprocess
+    :return: the full path to python3
+    """
+    return os.path.join(settings.VIRTUAL_ENV_PATH, 'bin', 'python3')
+
+
+def run_script(script, args, cwd, capture=False):
+    """
+    run one of the edition management scripts, either in a subprocess or in the current process
+    :param script: the filename of the script, e.g. make_paginated_json.py
+    :param args: list of command line arguments for the script
+    :param cwd: the directory the script lives in, and is run from
+    :param capture: return the combined stdout and stderr of the script
+    :return: the output of the script if capture is True, otherwise None
+    """
+    outcome = 'failure'
+    try:
+        with metrics.timer('estoria_script_duration_seconds', script=script):
+            output = _run_script(script, args, cwd, capture)
+        outcome = 'success'
+        return output
+    finally:
+        metrics.increment('estoria_scripts_total', script=script, outcome=outcome)
+
+
+def _run_script(script, args, cwd, capture):
+    if getattr(settings, 'SCRIPT_RUNNER', 'subprocess') == 'inprocess':
+        loaded = _load_script(os.path.join(cwd, script))
+        if loaded is not None:
+            try:
+                return _run_inprocess(loaded[0], script, args, cwd, capture, imports=loaded[1])
+            except UnresolvedImport as e:
+                logger.warning('{} could not be run in process ({}), falling back to a subprocess'.format(script, e))
+
+    if capture:
+        return subprocess.check_output([python_path(), script] + list(args), cwd=cwd, stderr=subprocess.STDOUT)
+    subprocess.check_call([python_path(), script] + list(args), cwd=cwd)
+
+
+def _load_script(script_path):
+    """
+    compile a script, reusing the cached code object if the file is unchanged
+    :param script_path: the full path to the script
+    :return: (the code object, the unconditional absolute imports at the top of the script) or None if the script can't be loaded
+    """
+    # a script linked into a staging directory shares the compiled code of the original
+    script_path = os.path.realpath(script_path)
+    try:
+        stat = os.stat(script_path)
+    except OSError:
+        return None
+
+    cached = _code_cache.get(script_path)
+    if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+        return cached[2], cached[3]
+
+    try:
+        with open(script_path, 'rb') as fp:
+            source = fp.read()
+        tree = ast.parse(source, script_path)
+        code = compile(tree, script_path, 'exec')
+    except (OSError, SyntaxError, ValueError) as e:
+        logger.warning('{} could not be compiled: {}'.format(script_path, e))
+        return None
+
+    imports = []
+    # only the statements of the module body itself, so an optional import in a try/except ImportError isn't required
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            imports += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and not node.level:
+            imports.append(node.module)
+    _code_cache[script_path] = (stat.st_mtime, stat.st_size, code, imports)
+    return code, imports
+
+
+def _run_inprocess(code, script, args, cwd, capture, imports=()):
+    """
+    run a compiled script as __main__, isolating argv, cwd, sys.path and any modules imported from cwd
+    :param imports: the modules to import before the script starts
+    :return: the output of the script if capture is True, otherwise None
+    :raises UnresolvedImport: if one of the imports fails, before the script has started
+    :raises subprocess.CalledProcessError: if the script exits with a non-zero status
+    """
+    script_path = os.path.join(cwd, script)
+    scripts_dirs = (os.path.realpath(cwd) + os.sep, os.path.abspath(cwd) + os.sep)
+    output = StringIO()
+    returncode = 0
+
+    with _run_lock:
+        saved_argv = sys.argv
+        saved_path = list(sys.path)
+        saved_cwd = os.getcwd()
+        saved_modules = set(sys.modules)
+        try:
+            sys.argv = [script_path] + list(args)
+            sys.path.insert(0, cwd)
+            os.chdir(cwd)
+            for name in imports:
+                try:
+                    importlib.import_module(name)
+                except ImportError as e:
+                    raise UnresolvedImport(str(e)) from e
+            namespace = {'__name__': '__main__', '__file__': script_path, '__builtins__': __builtins__}
+            try:
+                if capture:
+                    with redirect_stdout(output), redirect_stderr(output):
+                        exec(code, namespace)
+                else:
+                    exec(code, namespace)
+            except SystemExit as e:
+                if e.code is None:
+                    returncode = 0
+                elif isinstance(e.code, int):
+                    returncode = e.code
+                else:
+                    output.write(str(e.code))
+                    returncode = 1
+        finally:
+            os.chdir(saved_cwd)
+            sys.argv = saved_argv
+            sys.path[:] = saved_path
+            # forget helper modules the script imported from its own directory so the next run starts clean,
+            # but keep the third party libraries, which is where the start up time goes
+            for name in set(sys.modules) - saved_modules:
+                module_file = getattr(sys.modules[name], '__file__', None)
+                # the helper modules of a staging directory may be links to the edition's scripts
+                if module_file and (os.path.realpath(module_file).startswith(scripts_dirs) or
+                                    os.path.abspath(module_file).startswith(scripts_dirs)):
+                    del sys.modules[name]
+
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, [script] + list(args), output=output.getvalue().encode())
+    if capture:
+        return output.getvalue().encode()
@@ -0,0 +1,78 @@
+"""
+Scratch space for the jobs
+
+Each job is staged in its own directory under SCRATCH_LOCATION, which can be a fast filesystem such as a tmpfs,
+or the system temporary directory if it isn't set. The inputs that don't change, like the edition scripts,
+are linked into the staging directory rather than copied. A new job is refused while the scratch filesystem
+has less than SCRATCH_MIN_FREE MB free.
+"""
+from django.conf import settings
+import tempfile
+import shutil
+import os
+
+
+class ScratchFullError(Exception):
+    """
+    there isn't enough free scratch space to start a job
+    """
+
+
+def scratch_root():
+    """
+    :return: the directory the staging directories are made in
+    """
+    location = getattr(settings, 'SCRATCH_LOCATION', None)
+    if not location:
+        return tempfile.gettempdir()
+    os.makedirs(location, exist_ok=True)
+    return location
+
+
+def free_space():
+    """
+    :return: the free space of the scratch filesystem in bytes
+    """
+    return shutil.disk_usage(scratch_root()).free
+
+
+def mkdtemp(prefix=None):
+    """
+    make a staging directory for a new job
+    :param prefix: the start of the directory name
+    :return: the full path of the new directory
+    """
+    min_free = getattr(settings, 'SCRATCH_MIN_FREE', None)
+    if min_free and free_space() < min_free * 1024 * 1024:
+        raise ScratchFullError('Less than {} MB of scratch space is free in {}'.format(min_free, scratch_root()))
+    return tempfile.mkdtemp(prefix=prefix, dir=scratch_root())
+
+
+def link(source, destination):
+    """
+    make an input that doesn't change available in a staging directory, by a symbolic link where the
+    filesystem allows it, otherwise by a copy
+    :param source: the file or directory to link to
+    :param destination: the path of the link
+    """
+    try:
+        os.symlink(os.path.abspath(source), destination)
+    except OSError:
+        if os.path.isdir(source):
+            shutil.copytree(source, destination)
+        else:
+            shutil.copy(source, destination)
+
+
+def link_contents(source, destination, ignore=('__pycache__',)):
+    """
+    link each entry of a directory into a new directory, so that the directory itself is a real one and paths
+    relative to it stay inside the staging directory
+    :param source: the directory of inputs
+    :param destination: the directory to make
+    :param ignore: names not to link
+    """
+    os.makedirs(destination, exist_ok=True)
+    for name in os.listdir(source):
+        if name not in ignore:
+            link(os.path.join(source, name), os.path.join(destination, name))
@@ -1,23 +1,100 @@
-from django.http import HttpResponse
-from celery.result import AsyncResult
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
+from django.conf import settings
+from celery.states import READY_STATES
 from lxml import etree
-from io import BytesIO
+from . import status
+import tempfile
 import json
+import time
+import os
+import re
 
+RANGE_HEADER = re.compile(r'^bytes=(\d*)-(\d*)$')
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# seconds between comments sent to keep an idle event stream open through proxies
+KEEPALIVE_INTERVAL = 15
+# the most task ids poll_states answers in one request
+MAX_POLLED_TASKS = 100
 
-def validate_xml(xml_to_check):
+
+class _DiscardTarget:
+    """
+    parser target that throws the parsed document away, so that checking a file doesn't build a tree
     """
-    validate the xml of the supplied input
-    :param xml_to_check: bytes object which is the xml to be validated
+    def start(self, tag, attrib):
+        pass
+
+    def end(self, tag):
+        pass
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        return True
+
+
+def stream_xml(uploaded_file, destination, hasher=None):
+    """
+    write an uploaded file out while checking that it is well formed XML, in a single pass over its chunks
+    :param uploaded_file: the Django UploadedFile
+    :param destination: the binary file object to write the upload to
+    :param hasher: optional hashlib object that is updated with the uploaded bytes
     :return: True or False
     """
+    parser = etree.XMLParser(target=_DiscardTarget(), resolve_entities=False, no_network=True)
     try:
-        etree.parse(BytesIO(xml_to_check))
+        for chunk in uploaded_file.chunks():
+            parser.feed(chunk)
+            destination.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+        parser.close()
         return True
     except etree.XMLSyntaxError:
         return False
 
 
+def save_valid_xml(uploaded_file, file_and_path):
+    """
+    save an uploaded file if it is well formed XML, replacing any existing file only if it is
+    :param uploaded_file: the Django UploadedFile
+    :param file_and_path: where to save the file
+    :return: True or False
+    """
+    # a name of its own, so that two uploads of the same file at once don't write to the same temporary file
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(file_and_path) or None,
+                                         prefix='.' + os.path.basename(file_and_path) + '.', suffix='.part')
+    replaced = False
+    try:
+        with os.fdopen(handle, 'wb') as destination:
+            valid = stream_xml(uploaded_file, destination)
+        if valid:
+            # mkstemp makes the file readable only by this user, give it the mode open() would have
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temporary, 0o666 & ~umask)
+            os.replace(temporary, file_and_path)
+            replaced = True
+        return valid
+    finally:
+        # whatever went wrong, e.g. a failed write or a dropped upload, the temporary file doesn't stay behind
+        if not replaced:
+            try:
+                os.remove(temporary)
+            except FileNotFoundError:
+                pass
+
+
+def task_status(task_id):
+    """
+    the current state of a task, in a form that can be sent to the browser as JSON
+    :param task_id: the Celery task id
+    :return: dict of the result and state
+    """
+    return status.get_status(task_id)
+
+
 def poll_state(request):
     """
     check the current state of a task
@@ -26,9 +103,7 @@ def poll_state(request):
     """
     if request.is_ajax():
         if 'task_id' in request.POST.keys() and request.POST['task_id']:
-            task_id = request.POST['task_id']
-            task = AsyncResult(task_id)
-            context = {'result': task.result, 'state': task.state }
+            context = task_status(request.POST['task_id'])
         else:
             context = {'result': 'No task_id in the request', 'state': 'FAILURE'}
     else:
@@ -36,3 +111,135 @@ def poll_state(request):
 
     json_data = json.dumps(context)
     return HttpResponse(json_data, content_type='application/json')
+
+
+def poll_states(request):
+    """
+    check the current states of a number of tasks at once
+    the task ids are given as several task_id parameters, at most MAX_POLLED_TASKS of them
+    :param request: the Django request
+    :return: the HttpResponse object, with a dict of task id to result and state
+    """
+    if not request.is_ajax():
+        context = {'result': 'This is not an ajax request', 'state': 'FAILURE'}
+        return HttpResponse(json.dumps(context), content_type='application/json')
+
+    task_ids = [task_id for task_id in request.POST.getlist('task_id') if task_id]
+    if not task_ids:
+        context = {'result': 'No task_id in the request', 'state': 'FAILURE'}
+    elif len(task_ids) > MAX_POLLED_TASKS:
+        context = {'result': 'Too many task ids in the request', 'state': 'FAILURE'}
+    else:
+        return HttpResponse(json.dumps({'tasks': status.get_statuses(task_ids)}), content_type='application/json')
+    return HttpResponse(json.dumps(context), content_type='application/json', status=400)
+
+
+def task_events(request):
+    """
+    stream the state of a task to the browser as server-sent events
+    an event is only sent when the state changes, and the stream ends when the task has finished or after
+    TASK_STATUS_STREAM_TIMEOUT seconds, when the browser reconnects
+    :param request: the Django request
+    :return: the StreamingHttpResponse object
+    """
+    task_id = request.GET.get('task_id')
+    if not task_id:
+        return HttpResponse(json.dumps({'result': 'No task_id in the request', 'state': 'FAILURE'}),
+                            content_type='application/json', status=400)
+
+    response = StreamingHttpResponse(_task_event_stream(task_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # stop nginx from buffering the events
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _task_event_stream(task_id):
+    """
+    generator of the server-sent events for a task
+    """
+    interval = getattr(settings, 'TASK_STATUS_STREAM_INTERVAL', 1)
+    deadline = time.monotonic() + getattr(settings, 'TASK_STATUS_STREAM_TIMEOUT', 55)
+    yield 'retry: 2000\n\n'
+    last_state = None
+    last_sent = time.monotonic()
+    while True:
+        state = task_status(task_id)
+        if state != last_state:
+            yield 'data: {}\n\n'.format(json.dumps(state))
+            last_state = state
+            last_sent = time.monotonic()
+            if state['state'] in READY_STATES:
+                yield 'event: end\ndata: {}\n\n'
+                return
+        elif time.monotonic() - last_sent >= KEEPALIVE_INTERVAL:
+            yield ': keep-alive\n\n'
+            last_sent = time.monotonic()
+        if time.monotonic() >= deadline:
+            return
+        time.sleep(interval)
+
+
+def serve_file(request, file_and_path, filename, content_type):
+    """
+    send a file to the user without reading it all into memory
+    if DOWNLOAD_SENDFILE is set the web server sends the file (nginx X-Accel-Redirect or X-Sendfile),
+    otherwise it is streamed in chunks, with support for a single byte range so that downloads can be resumed
+    :param request: the Django request
+    :param file_and_path: the full path of the file
+    :param filename: the filename for the user to save the file as
+    :param content_type: the content type of the file
+    :return: the response object
+    """
+    sendfile = getattr(settings, 'DOWNLOAD_SENDFILE', None)
+    if sendfile:
+        response = HttpResponse(content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename=' + filename
+        if sendfile == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = getattr(settings, 'DOWNLOAD_ACCEL_PREFIX', '/protected/') + \
+                os.path.relpath(file_and_path, settings.OUTPUT_LOCATION)
+        else:
+            response['X-Sendfile'] = file_and_path
+        return response
+
+    size = os.path.getsize(file_and_path)
+    match = RANGE_HEADER.match(request.META.get('HTTP_RANGE', '').strip())
+    if match and any(match.groups()):
+        first, last = match.groups()
+        if first:
+            first = int(first)
+            last = min(int(last), size - 1) if last else size - 1
+        else:
+            # a suffix range, i.e. the final N bytes
+            first = max(size - int(last), 0)
+            last = size - 1
+        if first > last or first >= size:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+
+        response = StreamingHttpResponse(_read_range(file_and_path, first, last), status=206,
+                                         content_type=content_type)
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, size)
+        response['Content-Length'] = str(last - first + 1)
+    else:
+        response = FileResponse(open(file_and_path, 'rb'), content_type=content_type)
+        response['Content-Length'] = str(size)
+    response['Content-Disposition'] = 'attachment; filename=' + filename
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _read_range(file_and_path, first, last):
+    """
+    generator of the chunks of a byte range of a file, which closes the file when done
+    """
+    with open(file_and_path, 'rb') as fp:
+        fp.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = fp.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
@@ -0,0 +1,122 @@
+var TASK_STATUS = (function () {
+
+    var FINISHED_STATES = ['SUCCESS', 'FAILURE', 'REVOKED'];
+    var MIN_POLL_DELAY = 500;
+    var MAX_POLL_DELAY = 10000;
+
+    /* options: task_id, events_url, poll_url, csrf_token and update, which is called with each new status */
+    var watch = function (options) {
+        var finished = false;
+        var last_state;
+        var poll_delay = MIN_POLL_DELAY;
+
+        var handle = function (status) {
+            options.update(status);
+            last_state = status.state;
+            finished = FINISHED_STATES.indexOf(status.state) > -1;
+            return finished;
+        };
+
+        /* fall back to polling, backing off while nothing changes */
+        var poll = function () {
+            $.ajax({
+                url: options.poll_url,
+                type: 'POST',
+                data: {
+                    task_id: options.task_id,
+                    csrfmiddlewaretoken: options.csrf_token,
+                },
+                success: function (status) {
+                    var previous_state = last_state;
+                    if (handle(status)) {
+                        return;
+                    }
+                    if (status.state === previous_state) {
+                        poll_delay = Math.min(poll_delay * 2, MAX_POLL_DELAY);
+                    } else {
+                        poll_delay = MIN_POLL_DELAY;
+                    }
+                    setTimeout(poll, poll_delay);
+                },
+                error: function () {
+                    poll_delay = Math.min(poll_delay * 2, MAX_POLL_DELAY);
+                    setTimeout(poll, poll_delay);
+                }
+            });
+        };
+
+        if (!window.EventSource) {
+            poll();
+            return;
+        }
+
+        var opened = false;
+        var source = new EventSource(options.events_url + '?task_id=' + encodeURIComponent(options.task_id));
+        source.onmessage = function (event) {
+            opened = true;
+            if (handle(JSON.parse(event.data))) {
+                source.close();
+            }
+        };
+        source.addEventListener('end', function () {
+            source.close();
+        });
+        source.onerror = function () {
+            /* once the stream has worked the browser reconnects by itself when the server ends it */
+            if (finished || !opened) {
+                source.close();
+                if (!finished) {
+                    poll();
+                }
+            }
+        };
+    };
+
+    var format_seconds = function (seconds) {
+        seconds = Math.round(seconds);
+        if (seconds < 60) {
+            return seconds + 's';
+        }
+        return Math.floor(seconds / 60) + 'm ' + (seconds % 60) + 's';
+    };
+
+    /* render the meta data of a PROGRESS state into the element as a progress bar, with an estimate of the time
+       left worked out from the rate so far, and the time taken by each step */
+    var show_progress = function (element, progress) {
+        element.textContent = '';
+        var heading = document.createElement('p');
+        var text = progress.step || 'Working';
+        if (progress.chapter !== null && progress.chapter !== undefined) {
+            text += ' (chapter ' + progress.chapter + ')';
+        }
+        if (progress.total) {
+            var bar = document.createElement('progress');
+            bar.max = progress.total;
+            bar.value = progress.done;
+            element.appendChild(bar);
+            text += ': ' + progress.done + ' of ' + progress.total;
+            if (progress.done > 0 && progress.done < progress.total) {
+                var step_elapsed = progress.steps.length ? progress.steps[progress.steps.length - 1].elapsed : progress.elapsed;
+                var remaining = step_elapsed / progress.done * (progress.total - progress.done);
+                text += ', about ' + format_seconds(remaining) + ' left';
+            }
+        }
+        heading.textContent = text;
+        element.insertBefore(heading, element.firstChild);
+        if (progress.steps && progress.steps.length) {
+            var list = document.createElement('ul');
+            progress.steps.forEach(function (step) {
+                var item = document.createElement('li');
+                item.textContent = step.name + ': ' + format_seconds(step.elapsed);
+                list.appendChild(item);
+            });
+            element.appendChild(list);
+        }
+    };
+
+    return {
+        watch: watch,
+        show_progress: show_progress,
+    };
+
+})();
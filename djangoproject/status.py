@@ -0,0 +1,127 @@
+"""
+Cached task states
+
+The state of each task is kept in the Django cache (TASK_STATUS_CACHE) so that repeated checks of a task that
+hasn't changed don't query the result backend. The Celery task signals write each new state into the cache
+as it happens, which reaches the web server as the cache is shared (e.g. memcached, redis, the database or
+file based cache, as in the example settings). A state read from the result backend that may still change is only
+cached for TASK_STATUS_CACHE_TIMEOUT seconds.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from celery import signals
+from celery.result import AsyncResult
+from celery.states import READY_STATES
+import json
+
+CACHE_PREFIX = 'task-status:'
+# finished states and the states written by the task signals are cached for this many seconds
+LONG_TIMEOUT = 24 * 60 * 60
+
+
+def _cache():
+    return caches[getattr(settings, 'TASK_STATUS_CACHE', 'default')]
+
+
+def shared_cache():
+    """
+    the task state cache, for what only works when every process sees the same cache
+    :return: the cache
+    :raise ImproperlyConfigured: if it is a local memory cache, which each process keeps to itself
+    """
+    cache = _cache()
+    if isinstance(cache, LocMemCache):
+        raise ImproperlyConfigured('TASK_STATUS_CACHE must be shared by the web server and the workers, '
+                                   'configure a cache in CACHES that isn\'t a local memory cache')
+    return cache
+
+
+def _json_safe(result):
+    """
+    :return: the result if it can be sent to the browser as JSON, otherwise its string form
+    """
+    try:
+        json.dumps(result)
+        return result
+    except (TypeError, ValueError):
+        return str(result)
+
+
+def get_statuses(task_ids):
+    """
+    the current states of a number of tasks, from the cache where possible
+    :param task_ids: list of Celery task ids
+    :return: dict of task id to dict of result and state (plus any progress meta)
+    """
+    statuses = {}
+    cached = _cache().get_many([CACHE_PREFIX + task_id for task_id in task_ids])
+    for task_id in task_ids:
+        status = cached.get(CACHE_PREFIX + task_id)
+        if status is None:
+            task = AsyncResult(task_id)
+            status = {'result': _json_safe(task.result), 'state': task.state}
+            if status['state'] in READY_STATES:
+                timeout = LONG_TIMEOUT
+            else:
+                timeout = getattr(settings, 'TASK_STATUS_CACHE_TIMEOUT', 5)
+            if timeout:
+                _cache().set(CACHE_PREFIX + task_id, status, timeout)
+        statuses[task_id] = status
+    return statuses
+
+
+def get_status(task_id):
+    """
+    :param task_id: the Celery task id
+    :return: dict of the result and state of the task
+    """
+    return get_statuses([task_id])[task_id]
+
+
+def set_status(task_id, state, result=None):
+    """
+    record a new state of a task in the cache
+    :param task_id: the Celery task id
+    :param state: the Celery state
+    :param result: the result, exception or meta data of the state
+    """
+    if task_id:
+        _cache().set(CACHE_PREFIX + task_id, {'result': _json_safe(result), 'state': state}, LONG_TIMEOUT)
+
+
+def forget(task_id):
+    """
+    drop the result of a task from the result backend and the cache, e.g. once its output is deleted
+    :param task_id: the Celery task id
+    """
+    AsyncResult(task_id).forget()
+    _cache().delete(CACHE_PREFIX + task_id)
+
+
+def _task_prerun(task_id=None, **kwargs):
+    set_status(task_id, 'STARTED')
+
+
+def _task_success(sender=None, result=None, **kwargs):
+    set_status(sender.request.id, 'SUCCESS', result)
+
+
+def _task_failure(task_id=None, exception=None, **kwargs):
+    set_status(task_id, 'FAILURE', exception)
+
+
+def _task_revoked(request=None, **kwargs):
+    set_status(getattr(request, 'id', None), 'REVOKED')
+
+
+def _task_retry(request=None, reason=None, **kwargs):
+    set_status(getattr(request, 'id', None), 'RETRY', reason)
+
+
+signals.task_prerun.connect(_task_prerun, weak=False)
+signals.task_success.connect(_task_success, weak=False)
+signals.task_failure.connect(_task_failure, weak=False)
+signals.task_revoked.connect(_task_revoked, weak=False)
+signals.task_retry.connect(_task_retry, weak=False)
@@ -0,0 +1,24 @@
+"""
+Test runner that keeps the tests apart from the running web server and workers
+"""
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+import tempfile
+import shutil
+
+
+class TestRunner(DiscoverRunner):
+    """
+    runs the tests with the metrics written to a temporary directory, rather than to the METRICS_LOCATION that
+    /metrics adds up
+    """
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.metrics_location = tempfile.mkdtemp()
+        self.metrics_settings = override_settings(METRICS_LOCATION=self.metrics_location)
+        self.metrics_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.metrics_settings.disable()
+        shutil.rmtree(self.metrics_location, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
@@ -1,8 +1,35 @@
-from .shared import validate_xml, poll_state
+from .shared import poll_state, stream_xml, save_valid_xml
+from celery.result import AsyncResult
+from celery import current_app
+from .runner import run_script
+from . import status, metrics, scratch
+from .progress import TaskProgress
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from io import BytesIO
+import hashlib
+from unittest.mock import patch
+import subprocess
+import tempfile
+import shutil
+import socket
+import time
 import json
+import sys
+import os
+
+
+# the tests that clear the cache use one of their own, not the cache of the running web server and workers, which
+# must be shared, so file based rather than local memory
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'estoria_admin_test_cache'),
+    }
+}
 
 
 class TestIndexView(TestCase):
@@ -18,26 +45,77 @@ class TestIndexView(TestCase):
         self.assertEqual(response.status_code, 200)
 
 
-class ValidateXMLTest(TestCase):
+class StreamXMLTest(TestCase):
     """
-    Test the validate XML function
+    Test validating uploaded XML while it is written out
     """
-    def test_invalid_xml_should_be_false(self):
+    def _upload(self, content):
+        upload = SimpleUploadedFile('test.xml', content)
+        upload.DEFAULT_CHUNK_SIZE = 4
+        return upload
+
+    def test_stream_valid_xml(self):
+        """
+        test with valid xml split over several chunks
+        should get True, with the file written out and hashed
         """
-        test with invalid xml
+        destination = BytesIO()
+        hasher = hashlib.sha256()
+        self.assertIs(stream_xml(self._upload(b'<a><b>text</b></a>'), destination, hasher), True)
+        self.assertEqual(destination.getvalue(), b'<a><b>text</b></a>')
+        self.assertEqual(hasher.hexdigest(), hashlib.sha256(b'<a><b>text</b></a>').hexdigest())
+
+    def test_stream_invalid_xml(self):
+        """
+        test with invalid and incomplete xml
         should get False
         """
-        xml = b'<a><b></c></a>'
-        self.assertIs(validate_xml(xml), False)
+        self.assertIs(stream_xml(self._upload(b'<a><b></c></a>'), BytesIO()), False)
+        self.assertIs(stream_xml(self._upload(b'<a><b></b>'), BytesIO()), False)
+        self.assertIs(stream_xml(self._upload(b''), BytesIO()), False)
+
+    def test_save_valid_xml(self):
+        """
+        a valid upload replaces the existing file, an invalid one leaves it alone
+        """
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'test.xml')
+        self.assertIs(save_valid_xml(self._upload(b'<a/>'), filename), True)
+        self.assertIs(save_valid_xml(self._upload(b'<a>'), filename), False)
+        with open(filename, 'rb') as fp:
+            self.assertEqual(fp.read(), b'<a/>')
+        self.assertEqual(os.listdir(directory), ['test.xml'])
+        shutil.rmtree(directory)
+
 
-    def test_valid_xml_should_be_true(self):
+    def test_save_valid_xml_mode(self):
         """
-        test with valid xml
-        should get True
+        the saved file has the mode of a file opened for writing, not that of a temporary file
         """
-        xml = b'<a><b></b></a>'
-        self.assertIs(validate_xml(xml), True)
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'test.xml')
+        umask = os.umask(0o022)
+        try:
+            self.assertTrue(save_valid_xml(self._upload(b'<a/>'), filename))
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(filename).st_mode & 0o777, 0o644)
+        shutil.rmtree(directory)
 
+    def test_save_valid_xml_failed_upload(self):
+        """
+        an upload that fails part way through leaves the existing file and no temporary file
+        """
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'test.xml')
+        with open(filename, 'wb') as fp:
+            fp.write(b'<a/>')
+        upload = self._upload(b'<a><b></b></a>')
+        with patch.object(upload, 'chunks', side_effect=OSError('connection reset')):
+            with self.assertRaises(OSError):
+                save_valid_xml(upload, filename)
+        self.assertEqual(os.listdir(directory), ['test.xml'])
+        shutil.rmtree(directory)
 
 class PollStateTest(TestCase):
     """
@@ -73,3 +151,438 @@ class PollStateTest(TestCase):
         response = self.client.post(reverse('poll_state'), {'task_id': 'aaa'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response['Content-Type'], 'application/json')
+
+
+class RunScriptTest(TestCase):
+    """
+    Test the run_script function
+    """
+    def setUp(self):
+        self.scripts_path = tempfile.mkdtemp()
+        with open(os.path.join(self.scripts_path, 'helper_for_test.py'), 'w') as fp:
+            fp.write('VALUE = "helper"\n')
+        with open(os.path.join(self.scripts_path, 'make_test.py'), 'w') as fp:
+            fp.write('import sys, os\n'
+                     'import helper_for_test\n'
+                     'if __name__ == "__main__":\n'
+                     '    print(helper_for_test.VALUE, sys.argv[1:], os.getcwd())\n'
+                     '    if sys.argv[1:] == ["fail"]:\n'
+                     '        sys.exit(2)\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.scripts_path)
+
+    @patch('subprocess.check_call')
+    def test_subprocess_runner(self, mocked_check_call):
+        """
+        test the default runner
+        should run the script with the virtual environment python
+        """
+        run_script('make_test.py', ['-d', 'data'], self.scripts_path)
+        self.assertEqual(mocked_check_call.call_args[0][0][1:], ['make_test.py', '-d', 'data'])
+        self.assertEqual(mocked_check_call.call_args[1], {'cwd': self.scripts_path})
+
+    @override_settings(SCRIPT_RUNNER='inprocess')
+    @patch('subprocess.check_call')
+    def test_inprocess_runner(self, mocked_check_call):
+        """
+        test the in process runner
+        should run the script in this process with its own argv and cwd, and then restore them
+        """
+        argv = sys.argv
+        cwd = os.getcwd()
+        output = run_script('make_test.py', ['-d', 'data'], self.scripts_path, capture=True)
+        self.assertFalse(mocked_check_call.called)
+        self.assertIn("helper ['-d', 'data'] " + os.path.realpath(self.scripts_path), output.decode())
+        self.assertIs(sys.argv, argv)
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertNotIn('helper_for_test', sys.modules)
+
+    @override_settings(SCRIPT_RUNNER='inprocess')
+    def test_inprocess_runner_failure(self):
+        """
+        test the in process runner with a script that exits with an error
+        should raise CalledProcessError, just like a subprocess
+        """
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            run_script('make_test.py', ['fail'], self.scripts_path, capture=True)
+        self.assertEqual(cm.exception.returncode, 2)
+
+    @override_settings(SCRIPT_RUNNER='inprocess')
+    @patch('subprocess.check_call')
+    def test_inprocess_runner_fallback(self, mocked_check_call):
+        """
+        test the in process runner with a script that can't be loaded
+        should fall back to a subprocess
+        """
+        with open(os.path.join(self.scripts_path, 'make_broken.py'), 'w') as fp:
+            fp.write('import this_module_does_not_exist\n')
+        run_script('make_broken.py', ['-d', 'data'], self.scripts_path)
+        run_script('make_missing.py', ['-d', 'data'], self.scripts_path)
+        self.assertEqual(mocked_check_call.call_count, 2)
+
+    @override_settings(SCRIPT_RUNNER='inprocess')
+    @patch('subprocess.check_call')
+    def test_inprocess_runner_optional_import(self, mocked_check_call):
+        """
+        test the in process runner with a script that handles a missing optional module itself
+        should run the script in this process rather than fall back to a subprocess
+        """
+        with open(os.path.join(self.scripts_path, 'make_optional.py'), 'w') as fp:
+            fp.write('try:\n'
+                     '    import this_module_does_not_exist\n'
+                     'except ImportError:\n'
+                     '    this_module_does_not_exist = None\n'
+                     'print("optional", this_module_does_not_exist)\n')
+        output = run_script('make_optional.py', [], self.scripts_path, capture=True)
+        self.assertFalse(mocked_check_call.called)
+        self.assertIn('optional None', output.decode())
+
+    @override_settings(SCRIPT_RUNNER='inprocess')
+    @patch('subprocess.check_call')
+    def test_inprocess_runner_import_error_after_start(self, mocked_check_call):
+        """
+        test the in process runner with a script that fails to import a module once it has started
+        should fail rather than run the script again in a subprocess
+        """
+        with open(os.path.join(self.scripts_path, 'make_partial.py'), 'w') as fp:
+            fp.write('open("partial.txt", "w").close()\n'
+                     'if __name__ == "__main__":\n'
+                     '    import this_module_does_not_exist\n')
+        with self.assertRaises(ImportError):
+            run_script('make_partial.py', [], self.scripts_path)
+        self.assertFalse(mocked_check_call.called)
+        self.assertTrue(os.path.isfile(os.path.join(self.scripts_path, 'partial.txt')))
+
+    @override_settings(SCRIPT_RUNNER='inprocess')
+    def test_inprocess_runner_linked(self):
+        """
+        test the in process runner with the scripts linked into a staging directory
+        should run from the staging directory and forget the linked helper modules
+        """
+        staged = tempfile.mkdtemp()
+        scratch.link_contents(self.scripts_path, os.path.join(staged, 'scripts'))
+        output = run_script('make_test.py', ['-d', 'data'], os.path.join(staged, 'scripts'), capture=True)
+        self.assertIn("helper ['-d', 'data'] " + os.path.realpath(os.path.join(staged, 'scripts')), output.decode())
+        self.assertNotIn('helper_for_test', sys.modules)
+        shutil.rmtree(staged)
+
+
+class ScratchTest(TestCase):
+    """
+    Test the scratch space of the jobs
+    """
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_mkdtemp(self):
+        with override_settings(SCRATCH_LOCATION=os.path.join(self.location, 'scratch'), SCRATCH_MIN_FREE=1):
+            staged = scratch.mkdtemp()
+        self.assertEqual(os.path.dirname(staged), os.path.join(self.location, 'scratch'))
+
+    def test_refuse_when_full(self):
+        with override_settings(SCRATCH_LOCATION=self.location, SCRATCH_MIN_FREE=1024 ** 4):
+            with self.assertRaises(scratch.ScratchFullError):
+                scratch.mkdtemp()
+        self.assertEqual(os.listdir(self.location), [])
+
+    def test_link_contents(self):
+        source = os.path.join(self.location, 'source')
+        os.makedirs(os.path.join(source, '__pycache__'))
+        with open(os.path.join(source, 'make_test.py'), 'w') as fp:
+            fp.write('pass\n')
+        scratch.link_contents(source, os.path.join(self.location, 'staged'))
+        self.assertEqual(os.listdir(os.path.join(self.location, 'staged')), ['make_test.py'])
+        self.assertTrue(os.path.islink(os.path.join(self.location, 'staged', 'make_test.py')))
+        self.assertFalse(os.path.islink(os.path.join(self.location, 'staged')))
+
+
+@override_settings(TASK_STATUS_STREAM_INTERVAL=0, TASK_STATUS_STREAM_TIMEOUT=0)
+@override_settings(CACHES=TEST_CACHES)
+class TaskEventsTest(TestCase):
+    """
+    Test the server-sent events task status endpoint
+    """
+    def setUp(self):
+        cache.clear()
+
+    def test_task_events_no_task_id(self):
+        """
+        test without a task id
+        should be rejected
+        """
+        response = self.client.get(reverse('task_events'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_task_events_running_task(self):
+        """
+        test with a task that is still running
+        should send the state once and then end the stream for the browser to reconnect
+        """
+        response = self.client.get(reverse('task_events'), {'task_id': 'aaa'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = b''.join(response.streaming_content).decode()
+        self.assertEqual(content, 'retry: 2000\n\ndata: {"result": null, "state": "PENDING"}\n\n')
+
+    @patch.object(AsyncResult, 'state', 'FAILURE')
+    @patch.object(AsyncResult, 'result', ValueError('broken'))
+    def test_task_events_finished_task(self):
+        """
+        test with a task that has failed
+        should send the state, with the exception as a string, and an end event
+        """
+        response = self.client.get(reverse('task_events'), {'task_id': 'aaa'})
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('data: {"result": "broken", "state": "FAILURE"}\n\n', content)
+        self.assertTrue(content.endswith('event: end\ndata: {}\n\n'))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TaskStatusCacheTest(TestCase):
+    """
+    Test the cached task states and the poll_states endpoint
+    """
+    def setUp(self):
+        cache.clear()
+
+    @patch.object(AsyncResult, 'state', 'SUCCESS')
+    @patch.object(AsyncResult, 'result', 'done.zip')
+    def test_finished_state_is_cached(self):
+        """
+        test checking a finished task twice
+        should only read the result backend once
+        """
+        with patch('djangoproject.status.AsyncResult', wraps=AsyncResult) as mocked:
+            self.assertEqual(status.get_status('aaa'), {'result': 'done.zip', 'state': 'SUCCESS'})
+            self.assertEqual(status.get_status('aaa'), {'result': 'done.zip', 'state': 'SUCCESS'})
+        self.assertEqual(mocked.call_count, 1)
+
+    @override_settings(TASK_STATUS_CACHE_TIMEOUT=0)
+    def test_running_state_is_not_cached(self):
+        """
+        test checking an unfinished task with the backend cache timeout turned off
+        should read the result backend each time
+        """
+        with patch('djangoproject.status.AsyncResult', wraps=AsyncResult) as mocked:
+            status.get_status('aaa')
+            status.get_status('aaa')
+        self.assertEqual(mocked.call_count, 2)
+
+    def test_forget(self):
+        """
+        test forgetting a finished task
+        should drop its result from the backend and the cache
+        """
+        current_app.backend.store_result('aaa', 'done.zip', 'SUCCESS')
+        self.assertEqual(status.get_status('aaa'), {'result': 'done.zip', 'state': 'SUCCESS'})
+        status.forget('aaa')
+        self.assertEqual(status.get_status('aaa'), {'result': None, 'state': 'PENDING'})
+
+    def test_signals_update_state(self):
+        """
+        test the task signals
+        should replace the cached state without reading the result backend
+        """
+        status.get_status('aaa')
+        status._task_prerun(task_id='aaa')
+        self.assertEqual(status.get_status('aaa'), {'result': None, 'state': 'STARTED'})
+        status._task_failure(task_id='aaa', exception=ValueError('broken'))
+        with patch('djangoproject.status.AsyncResult') as mocked:
+            self.assertEqual(status.get_status('aaa'), {'result': 'broken', 'state': 'FAILURE'})
+        mocked.assert_not_called()
+
+    def test_poll_states(self):
+        """
+        test asking for several tasks at once
+        should answer with the state of each task
+        """
+        status.set_status('bbb', 'SUCCESS', 'done.zip')
+        response = self.client.post(reverse('poll_states'), {'task_id': ['aaa', 'bbb']},
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'tasks': {'aaa': {'result': None, 'state': 'PENDING'},
+                                                     'bbb': {'result': 'done.zip', 'state': 'SUCCESS'}}})
+
+    def test_poll_states_no_task_id(self):
+        """
+        test without any task ids
+        should be rejected
+        """
+        response = self.client.post(reverse('poll_states'), {}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'result': 'No task_id in the request', 'state': 'FAILURE'})
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TaskProgressTest(TestCase):
+    """
+    Test the progress reported by running tasks
+    """
+    def setUp(self):
+        cache.clear()
+
+    def test_steps_and_items(self):
+        """
+        test a task working through two steps
+        should publish the current step, the chapter and the count as the PROGRESS state
+        """
+        progress = TaskProgress('aaa')
+        progress.step('fingerprint chapters')
+        progress.step('bake chapters', total=3)
+        progress.advance(chapter=7)
+        result = status.get_status('aaa')
+        self.assertEqual(result['state'], 'PROGRESS')
+        self.assertEqual(result['result']['step'], 'bake chapters')
+        self.assertEqual(result['result']['chapter'], 7)
+        self.assertEqual((result['result']['done'], result['result']['total']), (1, 3))
+        self.assertEqual([step['name'] for step in result['result']['steps']],
+                         ['fingerprint chapters', 'bake chapters'])
+        self.assertEqual(AsyncResult('aaa').state, 'PROGRESS')
+        self.assertEqual([step['name'] for step in progress.finish()], ['fingerprint chapters', 'bake chapters'])
+
+    @patch('djangoproject.progress._atomic', return_value=True)
+    def test_group_progress(self, mocked_atomic):
+        """
+        test two shards reporting to the same group, in a cache that adds one atomically
+        should count the items of both out of the total of the group
+        """
+        first = TaskProgress('aaa', group_id='ccc', group_total=4)
+        second = TaskProgress('bbb', group_id='ccc', group_total=4)
+        first.step('bake chapters', total=2)
+        second.step('bake chapters', total=2)
+        first.advance(chapter=1)
+        second.advance(chapter=3)
+        second.advance(chapter=4)
+        result = status.get_status('ccc')['result']
+        self.assertEqual((result['done'], result['total'], result['chapter']), (3, 4, 4))
+        self.assertEqual(status.get_status('aaa')['result']['done'], 1)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_group_progress_unshared_cache(self):
+        """
+        test a shard reporting to a group while the cache isn't shared
+        should report its own progress and leave out the group's, which it can't count
+        """
+        progress = TaskProgress('aaa', group_id='ccc', group_total=4)
+        progress.step('bake chapters', total=2)
+        progress.advance(chapter=1)
+        self.assertEqual(status.get_status('aaa')['result']['done'], 1)
+        self.assertEqual(status.get_status('ccc')['state'], 'PENDING')
+
+    def test_group_progress_not_atomic(self):
+        """
+        test a shard reporting to a group in a cache that can't add one atomically, such as the file based cache
+        should report its own progress and leave out the group's, which would lose counts
+        """
+        progress = TaskProgress('aaa', group_id='ccc', group_total=4)
+        progress.step('bake chapters', total=2)
+        progress.advance(chapter=1)
+        self.assertEqual(status.get_status('aaa')['result']['done'], 1)
+        self.assertEqual(status.get_status('ccc')['state'], 'PENDING')
+
+    def test_without_task_id(self):
+        """
+        test a task function that is called directly
+        should keep track of the steps without publishing them
+        """
+        progress = TaskProgress(None)
+        progress.step('run make_reader.py')
+        with patch('djangoproject.progress._store') as mocked:
+            progress.advance()
+        mocked.assert_not_called()
+        self.assertEqual(progress.meta()['done'], 1)
+
+
+class MetricsTest(TestCase):
+    """
+    Test the task metrics and the /metrics endpoint
+    """
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.settings_override = override_settings(METRICS_LOCATION=self.location)
+        self.settings_override.enable()
+        metrics._reset()
+
+    def tearDown(self):
+        metrics._reset()
+        self.settings_override.disable()
+        shutil.rmtree(self.location)
+
+    def test_processes_are_added_up(self):
+        """
+        test the metrics written by another process
+        should be added to the metrics of this process
+        """
+        metrics.increment('estoria_tasks_total', task='a', outcome='success')
+        metrics.observe('estoria_script_duration_seconds', 0.2, script='make_test.py')
+        metrics.flush()
+        with open(os.path.join(self.location, 'other-1-1.json'), 'w') as fp:
+            json.dump({'counters': {'estoria_tasks_total': {json.dumps([['outcome', 'success'], ['task', 'a']]): 2}},
+                       'histograms': {}}, fp)
+
+        counters, histograms = metrics.collect()
+        self.assertEqual(counters['estoria_tasks_total'][json.dumps([['outcome', 'success'], ['task', 'a']])], 3)
+        self.assertEqual(histograms['estoria_script_duration_seconds'][json.dumps([['script', 'make_test.py']])][-1], 1)
+
+    def test_files_of_gone_processes_are_pruned(self):
+        """
+        test the files left by processes that have finished
+        should delete those of this host's finished processes and the old ones of other hosts
+        """
+        finished = subprocess.Popen([sys.executable, '-c', 'pass'])
+        finished.wait()
+        hostname = socket.gethostname()
+        names = {'dead': '{}-{}-1.json'.format(hostname, finished.pid),
+                 'alive': '{}-{}-1.json'.format(hostname, os.getppid()),
+                 'old': 'other-1-1.json',
+                 'recent': 'other-2-1.json',
+                 'temporary': 'abc.tmp'}
+        for name in names.values():
+            with open(os.path.join(self.location, name), 'w') as fp:
+                json.dump({'counters': {}, 'histograms': {}}, fp)
+        old = time.time() - metrics.STALE_AGE - 60
+        for key in ('old', 'temporary'):
+            os.utime(os.path.join(self.location, names[key]), (old, old))
+
+        metrics.increment('estoria_tasks_total', task='a', outcome='success')
+        metrics.flush()
+        remaining = set(os.listdir(self.location))
+        self.assertEqual(remaining - {metrics._filename}, {names['alive'], names['recent']})
+        self.assertIn(metrics._filename, remaining)
+
+    def test_metrics_endpoint(self):
+        """
+        test the /metrics endpoint
+        should give the histograms and counters in the Prometheus text format
+        """
+        metrics.observe('estoria_script_duration_seconds', 0.2, script='make_test.py')
+        metrics.increment('estoria_chapters_total', 3, outcome='skipped')
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        content = response.content.decode()
+        self.assertIn('# TYPE estoria_script_duration_seconds histogram', content)
+        self.assertIn('estoria_script_duration_seconds_bucket{script="make_test.py",le="0.1"} 0', content)
+        self.assertIn('estoria_script_duration_seconds_bucket{script="make_test.py",le="0.5"} 1', content)
+        self.assertIn('estoria_script_duration_seconds_count{script="make_test.py"} 1', content)
+        self.assertIn('estoria_chapters_total{outcome="skipped"} 3', content)
+
+    @patch('subprocess.check_call')
+    def test_run_script_is_timed(self, mocked_call):
+        """
+        test running a script
+        should time it and count it by outcome
+        """
+        run_script('make_test.py', [], self.location)
+        mocked_call.side_effect = subprocess.CalledProcessError(1, 'make_test.py')
+        with self.assertRaises(subprocess.CalledProcessError):
+            run_script('make_test.py', [], self.location)
+        counters, histograms = metrics.collect()
+        self.assertEqual(counters['estoria_scripts_total'],
+                         {json.dumps([['outcome', 'success'], ['script', 'make_test.py']]): 1,
+                          json.dumps([['outcome', 'failure'], ['script', 'make_test.py']]): 1})
+        self.assertEqual(histograms['estoria_script_duration_seconds'][json.dumps([['script', 'make_test.py']])][-1], 2)
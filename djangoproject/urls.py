@@ -2,7 +2,7 @@
 djangoproject URL Configuration
 """
 from django.urls import include, path, re_path
-from .shared import poll_state
+from .shared import poll_state, poll_states, task_events
 from . import views
 from estoria_app import views as admin_views
 
@@ -11,6 +11,9 @@ urlpatterns = [
     path('xmlconversion/', include('xmlconversion_app.urls')),
     path('estoria-admin/', include('estoria_app.urls')),
     path('poll_state', poll_state, name='poll_state'),
+    path('poll_states', poll_states, name='poll_states'),
+    path('task_events', task_events, name='task_events'),
+    path('metrics', views.metrics, name='metrics'),
     re_path(r'apparatus/(?P<project>\w+-digital)/chapter/(?P<chapter>\d+)/?$',
             admin_views.chapter, name='chapter'),
 ]
@@ -1,8 +1,17 @@
 from django.shortcuts import render
+from django.http import HttpResponse
+from . import metrics as task_metrics
 
 
 def index(request):
     """
     index page
     """
-    return render(request, 'index.html', {})
\ No newline at end of file
+    return render(request, 'index.html', {})
+
+
+def metrics(request):
+    """
+    the task timings and counters of all the processes, for Prometheus to scrape
+    """
+    return HttpResponse(task_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
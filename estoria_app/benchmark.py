@@ -0,0 +1,283 @@
+"""
+Offline benchmark of baking
+
+A local stand-in of the chapter page is served from a fixture collations.json and approved collations. The
+page renders the chapter after a configurable delay and then adds the #finished element, like
+chapter_check.html. bake_chapters is run against it in this process for each pool and shard configuration,
+with the shards baked in parallel by a number of worker threads that share the process's browser pool.
+
+    python manage.py benchmark_baking --chapters 50 --render-delay 200 --config 1:25:1 --config 2:10:2
+"""
+from djangoproject import benchmarks
+from djangoproject.progress import step_changed, item_done
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from .tasks import bake_chapters, chapter_shards
+from . import browsers
+
+import collections
+import threading
+import tempfile
+import shutil
+import json
+import time
+import math
+import html
+import os
+import re
+
+CHAPTER_URL = re.compile(r'^/chapter/(\d+)/?$')
+
+CHAPTER_PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head><meta charset="utf-8"><title>Chapter {chapter}</title></head>
+<body>
+<div class="container"></div>
+<script type="text/javascript">
+    var DATA = {data};
+    setTimeout(function () {{
+        var container = document.getElementsByClassName('container')[0];
+        DATA.verses.forEach(function (verse) {{
+            var table = document.createElement('table');
+            table.id = verse.context;
+            verse.structure.apparatus.forEach(function (unit) {{
+                var row = table.insertRow();
+                unit.readings.forEach(function (reading) {{
+                    var text = reading.text.map(function (token) {{ return token.interface; }}).join(' ');
+                    row.insertCell().textContent = text + ' ' + reading.witnesses.join(' ');
+                }});
+            }});
+            container.appendChild(table);
+        }});
+        var finished = document.createElement('div');
+        finished.id = 'finished';
+        container.appendChild(finished);
+    }}, {render_delay});
+</script>
+</body>
+</html>
+"""
+
+
+def make_fixture(data_path, chapters, verses, witnesses=12, units=20):
+    """
+    write a collations.json, page_chapter_index.json and approved collations for the stand-in edition
+    :param data_path: the data directory to write collations.json and page_chapter_index.json to
+    :param chapters: the number of chapters
+    :param verses: the number of verses in each chapter, as well as a rubric
+    :return: the directory of approved collations
+    """
+    approved_path = os.path.join(data_path, 'approved')
+    os.makedirs(approved_path, exist_ok=True)
+    sigla = ['W{}'.format(i) for i in range(witnesses)]
+    index = collections.OrderedDict()
+    page_chapter_index = {siglum: {} for siglum in sigla}
+    for chapter in range(1, chapters + 1):
+        index[str(chapter)] = ['Rubric'] + [str(verse) for verse in range(1, verses + 1)]
+        for verse in index[str(chapter)]:
+            context = 'D{}S{}'.format(chapter, verse)
+            apparatus = [{'start': unit * 2, 'end': unit * 2,
+                          'readings': [_reading(['reading{}'.format(unit), 'word'], sigla[:witnesses // 2], unit),
+                                       _reading(['variant{}'.format(unit)], sigla[witnesses // 2:], unit)]}
+                         for unit in range(units)]
+            with open(os.path.join(approved_path, context + '.json'), 'w', encoding='utf-8') as fp:
+                json.dump({'context': context, 'structure': {'apparatus': apparatus}}, fp)
+            page_key = 'D{}S100'.format(chapter) if verse == 'Rubric' else context
+            for siglum in sigla:
+                page_chapter_index[siglum][page_key] = '{}r'.format(chapter)
+    with open(os.path.join(data_path, 'collations.json'), 'w', encoding='utf-8') as fp:
+        json.dump(index, fp)
+    with open(os.path.join(data_path, 'page_chapter_index.json'), 'w', encoding='utf-8') as fp:
+        json.dump(page_chapter_index, fp)
+    return approved_path
+
+
+def _reading(words, witnesses, unit):
+    """
+    :return: a reading of a unit of the apparatus as the collation editor approves it, its text a list of tokens
+    """
+    return {'witnesses': witnesses,
+            'text': [{'index': str((unit * 2 + position) * 2), 't': word, 'interface': word, 'reading': witnesses}
+                     for position, word in enumerate(words)]}
+
+
+class StandinChapterServer(object):
+    """
+    a local web server of stand-in chapter pages, run in a thread
+    """
+    def __init__(self, data_path, approved_path, render_delay=0, server_delay=0):
+        """
+        :param render_delay: milliseconds the page waits before rendering the chapter and adding #finished
+        :param server_delay: seconds the server waits before answering each request
+        """
+        self.data_path = data_path
+        self.approved_path = approved_path
+        self.render_delay = render_delay
+        self.server_delay = server_delay
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                match = CHAPTER_URL.match(self.path)
+                content = server.chapter_page(int(match.group(1))) if match else None
+                if content is None:
+                    self.send_error(404)
+                    return
+                if server.server_delay:
+                    time.sleep(server.server_delay)
+                body = content.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+    def chapter_page(self, chapter):
+        """
+        :return: the html of the stand-in page of a chapter, or None if the chapter doesn't exist
+        """
+        with open(os.path.join(self.data_path, 'collations.json'), encoding='utf-8') as fp:
+            verses = json.load(fp).get(str(chapter))
+        if verses is None:
+            return None
+        data = {'chapter': chapter, 'verses': []}
+        for verse in verses:
+            with open(os.path.join(self.approved_path, 'D{}S{}.json'.format(chapter, verse)), encoding='utf-8') as fp:
+                data['verses'].append(json.load(fp))
+        # stop the data closing the script element
+        data = json.dumps(data).replace('</', '<\\/')
+        return CHAPTER_PAGE.format(chapter=html.escape(str(chapter)), data=data, render_delay=int(self.render_delay))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class LatencyRecorder(object):
+    """
+    the time each chapter took to bake, from the progress of the bake_chapters tasks running in this process
+    """
+    def __init__(self):
+        self.latencies = []
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        step_changed.connect(self._step_changed)
+        item_done.connect(self._item_done)
+        return self
+
+    def __exit__(self, *exc_info):
+        step_changed.disconnect(self._step_changed)
+        item_done.disconnect(self._item_done)
+
+    def _step_changed(self, sender, step=None, **kwargs):
+        # only the chapters of the baking step are timed, not the skipped chapters of the fingerprint step
+        self._last[threading.get_ident()] = time.perf_counter() if step == 'bake chapters' else None
+
+    def _item_done(self, sender, **kwargs):
+        now = time.perf_counter()
+        last = self._last.get(threading.get_ident())
+        if last is not None:
+            with self._lock:
+                self.latencies.append(now - last)
+            self._last[threading.get_ident()] = now
+
+
+def percentile(values, fraction):
+    """
+    :return: the value below which the fraction of the sorted values fall (nearest rank), or None if empty
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+def run_benchmark(configs, chapters=20, verses=10, render_delay=0, server_delay=0):
+    """
+    bake the stand-in edition with each configuration and measure the throughput
+    :param configs: list of (pool size, shard size, worker threads)
+    :param chapters: the number of chapters in the stand-in edition
+    :param verses: the number of verses in each chapter
+    :param render_delay: milliseconds each page waits before it is rendered
+    :param server_delay: seconds the server waits before answering each request
+    :return: dict of the environment and a result for each configuration
+    """
+    workdir = tempfile.mkdtemp(prefix='baking-benchmark-')
+    results = []
+    try:
+        approved_path = make_fixture(workdir, chapters, verses)
+        with StandinChapterServer(workdir, approved_path, render_delay, server_delay) as server:
+            for pool_size, shard_size, workers in configs:
+                results.append(_bake(server, workdir, approved_path, chapters, pool_size, shard_size, workers))
+    finally:
+        shutil.rmtree(workdir)
+    return {'benchmark': 'baking', 'environment': benchmarks.environment(),
+            'chapters': chapters, 'verses': verses, 'render_delay': render_delay, 'server_delay': server_delay,
+            'runs': results}
+
+
+def _bake(server, data_path, approved_path, chapters, pool_size, shard_size, workers):
+    shards = chapter_shards(1, chapters, shard_size)
+    # the pool sizes are only measured when the chapters are baked in the browser
+    with benchmarks.benchmark_settings(BAKING_RENDERER='browser', BAKING_BROWSER_POOL_SIZE=pool_size,
+                                       METRICS_LOCATION=None):
+        # each configuration starts with a cold pool, as a new worker would
+        browsers.close_pool()
+        try:
+            with LatencyRecorder() as recorder:
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    shard_results = list(executor.map(
+                        lambda shard: bake_chapters(shard[0], shard[1], server.url, data_path,
+                                                    raise_on_failure=False, approved_path=approved_path,
+                                                    force=True),
+                        shards))
+                seconds = time.perf_counter() - started
+            memory = browsers.get_pool().memory()
+        finally:
+            browsers.close_pool()
+
+    baked = sum(len(result['baked']) for result in shard_results)
+    failed = {}
+    for result in shard_results:
+        failed.update(result['failed'])
+    latencies = recorder.latencies
+    return {
+        'pool_size': pool_size,
+        'shard_size': shard_size,
+        'workers': workers,
+        'shards': len(shards),
+        'seconds': round(seconds, 3),
+        'baked': baked,
+        'failed': failed,
+        'chapters_per_minute': round(baked / seconds * 60, 2) if seconds else None,
+        'latency_seconds': {
+            'p50': _round(percentile(latencies, 0.5)),
+            'p90': _round(percentile(latencies, 0.9)),
+            'p99': _round(percentile(latencies, 0.99)),
+            'max': _round(max(latencies) if latencies else None),
+        },
+        'browsers': len(memory),
+        'browser_memory_bytes': sum(m for m in memory if m) if any(memory) else None,
+    }
+
+
+def _round(value):
+    return round(value, 4) if value is not None else None
@@ -0,0 +1,245 @@
+"""
+A pool of warm headless browsers for baking
+
+Each worker process keeps its browsers between tasks, so baking a single chapter doesn't pay for starting
+Firefox. A browser is replaced once it stops responding, after a number of pages or when it uses too much
+memory, which is checked both when it is checked back in and before it is handed out again. The pool is shut
+down when the worker process stops.
+
+Each worker process has its own pool, and a prefork worker process bakes one chapter at a time, so more than
+one browser per pool only helps a process that bakes in several threads at once (e.g. the baking benchmark).
+"""
+from celery import signals
+from django.conf import settings
+from selenium import webdriver
+from selenium.webdriver import FirefoxOptions
+from contextlib import contextmanager
+import threading
+import logging
+import atexit
+import os
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class PooledBrowser:
+    """
+    a webdriver checked out of the pool, and the number of pages it has loaded
+    """
+    def __init__(self, driver):
+        self.driver = driver
+        self.pages = 0
+
+    def is_healthy(self):
+        """
+        :return: True if the browser still responds to commands
+        """
+        try:
+            self.driver.execute_script('return 1;')
+            return True
+        except Exception:
+            return False
+
+    def memory(self):
+        """
+        :return: the resident memory in bytes of geckodriver and the browser processes it started,
+                 or None if it can't be found
+        """
+        try:
+            pid = self.driver.service.process.pid
+        except AttributeError:
+            return None
+        if not isinstance(pid, int):
+            return None
+        return _process_tree_rss(pid)
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception as e:
+            logger.warning('Could not quit the browser cleanly: {!r}'.format(e))
+
+
+class BrowserPool:
+    """
+    a fixed size pool of headless Firefox browsers
+    """
+    def __init__(self, size=1, max_pages=200, max_memory=None):
+        """
+        :param size: the maximum number of browsers
+        :param max_pages: replace a browser after it has loaded this many pages
+        :param max_memory: replace a browser once it is using more than this many bytes, None to not check
+        """
+        self.size = max(1, size)
+        self.max_pages = max_pages
+        self.max_memory = max_memory
+        self._idle = []
+        self._checked_out = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def checkout(self, timeout=None):
+        """
+        take a browser from the pool, starting a new one if needed and there is room
+        waits for a browser to be checked back in if the pool is at its limit
+        :param timeout: seconds to wait for a browser, None to wait for ever
+        :return: a PooledBrowser
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._closed or self._idle or self._checked_out < self.size,
+                                            timeout):
+                raise TimeoutError('No browser became available in the pool')
+            if self._closed:
+                raise RuntimeError('The browser pool has been closed')
+            browser = self._idle.pop() if self._idle else None
+            self._checked_out += 1
+
+        try:
+            if browser is not None and not browser.is_healthy():
+                logger.info('Replacing a browser that failed its health check')
+                browser.quit()
+                browser = None
+            if browser is not None and self._worn_out(browser):
+                browser.quit()
+                browser = None
+            if browser is None:
+                browser = PooledBrowser(_start_browser())
+        except Exception:
+            with self._condition:
+                self._checked_out -= 1
+                self._condition.notify()
+            raise
+        return browser
+
+    def checkin(self, browser):
+        """
+        return a browser to the pool, or quit it if it has crashed or reached its page or memory limit
+        :param browser: the PooledBrowser from checkout()
+        """
+        if not browser.is_healthy():
+            logger.info('Quitting a browser that failed its health check')
+            browser.quit()
+            browser = None
+        elif self._worn_out(browser):
+            browser.quit()
+            browser = None
+
+        with self._condition:
+            self._checked_out -= 1
+            if browser is not None:
+                if self._closed:
+                    browser.quit()
+                else:
+                    self._idle.append(browser)
+            self._condition.notify()
+
+    def _worn_out(self, browser):
+        """
+        :return: True if the browser has reached its page or memory limit
+        """
+        if self.max_pages and browser.pages >= self.max_pages:
+            logger.info('Recycling a browser after {} pages'.format(browser.pages))
+            return True
+        if self.max_memory:
+            memory = browser.memory()
+            if memory is not None and memory > self.max_memory:
+                logger.info('Recycling a browser using {} bytes'.format(memory))
+                return True
+        return False
+
+    @contextmanager
+    def browser(self, timeout=None):
+        """
+        check out a browser for the duration of a with block
+        """
+        browser = self.checkout(timeout)
+        try:
+            yield browser
+        finally:
+            self.checkin(browser)
+
+    def memory(self):
+        """
+        :return: list of the resident memory in bytes of each idle browser, None where it can't be found
+        """
+        with self._condition:
+            idle = list(self._idle)
+        return [browser.memory() for browser in idle]
+
+    def close(self):
+        """
+        quit all the idle browsers, browsers that are checked out are quit when they are checked back in
+        """
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._condition.notify_all()
+        for browser in idle:
+            browser.quit()
+
+
+def get_pool():
+    """
+    :return: the browser pool of this process, created from the settings on first use
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            max_memory = getattr(settings, 'BAKING_BROWSER_MAX_MEMORY', None)
+            _pool = BrowserPool(size=getattr(settings, 'BAKING_BROWSER_POOL_SIZE', 1),
+                                max_pages=getattr(settings, 'BAKING_BROWSER_MAX_PAGES', 200),
+                                max_memory=max_memory * 1024 * 1024 if max_memory else None)
+        return _pool
+
+
+def close_pool(**kwargs):
+    """
+    shut down the browser pool of this process, if there is one
+    """
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
+
+
+def forget_pool(**kwargs):
+    """
+    a forked worker process must not share the browsers of its parent
+    """
+    global _pool
+    _pool = None
+
+
+signals.worker_process_init.connect(forget_pool, weak=False)
+signals.worker_process_shutdown.connect(close_pool, weak=False)
+signals.worker_shutdown.connect(close_pool, weak=False)
+atexit.register(close_pool)
+
+
+def _start_browser():
+    options = FirefoxOptions()
+    options.add_argument("--headless")
+    return webdriver.Firefox(options=options)
+
+
+def _process_tree_rss(pid):
+    """
+    :return: the total resident memory in bytes of a process and its descendants, from /proc (Linux only)
+    """
+    total = 0
+    pids = [pid]
+    try:
+        while pids:
+            current = pids.pop()
+            with open('/proc/{}/statm'.format(current)) as fp:
+                total += int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            for task in os.listdir('/proc/{}/task'.format(current)):
+                with open('/proc/{}/task/{}/children'.format(current, task)) as fp:
+                    pids.extend(int(child) for child in fp.read().split())
+    except (OSError, ValueError):
+        return total or None
+    return total
@@ -0,0 +1,88 @@
+"""
+Process-wide cache of the parsed collations index
+
+collations.json maps each chapter to its list of verses. It is parsed once per process and kept with the
+structures derived from it, keyed by its path, modification time and size, so it is only parsed again once
+the file has changed.
+"""
+import collections
+import bisect
+import threading
+import json
+import os
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+class CollationsIndex(object):
+    """
+    the parsed collations.json and the structures derived from it
+    """
+    def __init__(self, data):
+        """
+        :param data: the parsed collations.json, an OrderedDict of chapter to list of verses
+        """
+        self.data = data
+        self.chapter_verses = {int(chapter): verses for chapter, verses in data.items() if chapter.isdigit()}
+        self.maximum_chapter = max(self.chapter_verses) if self.chapter_verses else 0
+        self.total_verses = sum(len(verses) for verses in data.values())
+        self.chapters = sorted(self.chapter_verses)
+
+    def find(self, start=None, stop=None, query=None):
+        """
+        the chapters in a range, with only the verses whose context matches a search
+        :param start: the first chapter, or None to start at the beginning
+        :param stop: the last chapter (inclusive), or None to go on to the end
+        :param query: part of a verse context to search for, e.g. D12S3, case insensitive
+        :return: list of (chapter, verses) in chapter order, leaving out chapters without matching verses
+        """
+        first = 0 if start is None else bisect.bisect_left(self.chapters, start)
+        last = len(self.chapters) if stop is None else bisect.bisect_right(self.chapters, stop)
+        found = []
+        for chapter in self.chapters[first:last]:
+            verses = self.chapter_verses[chapter]
+            if query:
+                verses = [verse for verse in verses if query.upper() in 'D{}S{}'.format(chapter, verse).upper()]
+                if not verses:
+                    continue
+            found.append((chapter, verses))
+        return found
+
+
+def collations_file(data_path):
+    """
+    :return: the full path of collations.json in the data directory
+    """
+    return os.path.join(data_path, 'collations.json')
+
+
+def get_index(data_path):
+    """
+    the collations index of the data directory, parsed again only if the file has changed since it was last read
+    :param data_path: the data directory of the edition
+    :return: the CollationsIndex
+    """
+    filename = collations_file(data_path)
+    stat = os.stat(filename)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _indexes.get(filename)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    with _lock:
+        cached = _indexes.get(filename)
+        if cached and cached[0] == key:
+            return cached[1]
+        with open(filename, encoding='utf-8') as fp:
+            index = CollationsIndex(json.load(fp, object_pairs_hook=collections.OrderedDict))
+        _indexes[filename] = (key, index)
+        return index
+
+
+def clear():
+    """
+    forget all of the parsed indexes
+    """
+    with _lock:
+        _indexes.clear()
@@ -0,0 +1,100 @@
+"""
+Fingerprints of the inputs of each baked chapter
+
+A chapter's fingerprint covers its approved collation files, its entry in collations.json, the
+page_chapter_index entries of its verses and the page that renders it. The fingerprint of the last
+successful bake is stored next to the baked chapter, so unchanged chapters can be skipped.
+"""
+from .incremental import parse_js_assignment
+
+import collections
+import hashlib
+import json
+import os
+
+FINGERPRINTS_DIR = '.fingerprints'
+# the files in this app that turn the collations into the baked html: the page, the scripts it loads and the python
+# renderer
+RENDERER_FILES = [
+    os.path.join(os.path.dirname(__file__), 'templates', 'estoria_app', 'chapter_check.html'),
+    os.path.join(os.path.dirname(__file__), 'static', 'estoria_app', 'js', 'simpleeditor.js'),
+    os.path.join(os.path.dirname(__file__), 'static', 'estoria_app', 'js', 'handlebars-4.7.7.min.js'),
+    os.path.join(os.path.dirname(__file__), 'renderer.py'),
+]
+
+
+def load_json_index(data_path, name):
+    """
+    load one of the edition's index files, from the .json version if there is one, otherwise from the .js
+    :param data_path: the data directory of the edition
+    :param name: the name of the index, e.g. page_chapter_index
+    :return: the index as an OrderedDict, empty if it doesn't exist
+    """
+    json_file = os.path.join(data_path, name + '.json')
+    if os.path.isfile(json_file):
+        with open(json_file, encoding='utf-8') as fp:
+            return json.load(fp, object_pairs_hook=collections.OrderedDict)
+
+    js_file = os.path.join(data_path, name + '.js')
+    if os.path.isfile(js_file):
+        with open(js_file, encoding='utf-8') as fp:
+            assignment = parse_js_assignment(fp.read())
+        if assignment:
+            return json.loads(assignment[1], object_pairs_hook=collections.OrderedDict)
+    return collections.OrderedDict()
+
+
+def chapter_fingerprint(chapter, collations, page_chapter_index, approved_path):
+    """
+    :param chapter: the chapter number
+    :param collations: the collations index, chapter to list of verses
+    :param page_chapter_index: the page chapter index, witness to verse context to page
+    :param approved_path: the directory of approved collation files
+    :return: the sha256 hex digest of everything the baked chapter depends on
+    """
+    sha = hashlib.sha256()
+    for filename in RENDERER_FILES:
+        with open(filename, 'rb') as fp:
+            sha.update(fp.read())
+
+    verses = collations.get(str(chapter), [])
+    sha.update(json.dumps(verses).encode())
+    for verse in verses:
+        context = 'D{}S{}'.format(chapter, verse)
+        try:
+            with open(os.path.join(approved_path, context + '.json'), 'rb') as fp:
+                sha.update(fp.read())
+        except FileNotFoundError:
+            sha.update(b'missing')
+
+        # rubrics are indexed as verse 100
+        context_key = 'D{}S100'.format(chapter) if verse == 'Rubric' else context
+        pages = {witness: index.get(context_key) for witness, index in page_chapter_index.items()}
+        sha.update(json.dumps(pages, sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+def stored_fingerprint(data_path, chapter):
+    """
+    :return: the fingerprint of the last successful bake of the chapter, or None
+    """
+    try:
+        with open(_fingerprint_file(data_path, chapter), encoding='utf-8') as fp:
+            return fp.read().strip()
+    except OSError:
+        return None
+
+
+def store_fingerprint(data_path, chapter, fingerprint):
+    """
+    record the fingerprint of a successful bake of the chapter
+    """
+    filename = _fingerprint_file(data_path, chapter)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + '.tmp', 'w', encoding='utf-8') as fp:
+        fp.write(fingerprint)
+    os.replace(filename + '.tmp', filename)
+
+
+def _fingerprint_file(data_path, chapter):
+    return os.path.join(data_path, 'critical', FINGERPRINTS_DIR, str(chapter))
@@ -0,0 +1,334 @@
+"""
+Incremental rebuild of the transcriptions
+
+Each manuscript is built on its own in a staging copy of the edition layout, so that only the manuscripts
+whose XML has changed need to be processed. A manifest of content hashes is kept under the data path, along
+with the index files that each manuscript produced (its fragments), which are merged to make the index files
+for the whole edition.
+
+A full rebuild stages the manuscripts in the same way to build their pages in parallel, before the chapter
+index is made from all of them.
+"""
+from djangoproject.runner import run_script
+from djangoproject import metrics
+from djangoproject import scratch as staging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import collections
+import tempfile
+import hashlib
+import shutil
+import json
+import os
+import re
+
+INCREMENTAL_DIR = 'incremental'
+MANIFEST_FILE = 'manifest.json'
+FRAGMENTS_DIR = 'fragments'
+TRANSCRIPTION_SCRIPTS = ['make_paginated_json.py', 'add_html_to_paginated_json.py', 'make_chapter_index_json.py']
+# the scripts that only need the manuscript itself, before the chapter index is made from all of them
+PAGE_SCRIPTS = TRANSCRIPTION_SCRIPTS[:2]
+
+JS_ASSIGNMENT = re.compile(r'^\s*([\w.$]+)\s*=\s*(.*?)\s*;?\s*$', re.DOTALL)
+
+
+class MergeError(Exception):
+    """
+    the fragments of an index file can't be merged
+    """
+
+
+def manuscripts_path(scripts_path):
+    """
+    the transcription XML files live alongside the edition in the project directory
+    :param scripts_path: the edition scripts directory (edition/src/assets/scripts)
+    :return: the transcriptions/manuscripts directory
+    """
+    return os.path.normpath(os.path.join(scripts_path, '..', '..', '..', '..', 'transcriptions', 'manuscripts'))
+
+
+def hash_file(filename):
+    """
+    :param filename: the file to hash
+    :return: the sha256 hex digest of the contents of the file
+    """
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(65536), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def load_manifest(data_path):
+    """
+    :param data_path: the data directory of the edition
+    :return: dict of manuscript filename to content hash, empty if there is no manifest yet
+    """
+    try:
+        with open(os.path.join(data_path, INCREMENTAL_DIR, MANIFEST_FILE), encoding='utf-8') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(data_path, manifest):
+    """
+    write the manifest, replacing the old one in a single step
+    :param data_path: the data directory of the edition
+    :param manifest: dict of manuscript filename to content hash
+    """
+    _write_atomic(os.path.join(data_path, INCREMENTAL_DIR, MANIFEST_FILE),
+                  json.dumps(manifest, indent=1, sort_keys=True))
+
+
+def find_changes(data_path, scripts_path):
+    """
+    compare the manuscripts on disk with the manifest
+    a manuscript without stored fragments counts as changed, so the first incremental run builds everything
+    :param data_path: the data directory of the edition
+    :param scripts_path: the edition scripts directory
+    :return: (changed, removed, hashes) - sorted lists of manuscript filenames and the hashes of the current files
+    """
+    manifest = load_manifest(data_path)
+    location = manuscripts_path(scripts_path)
+    hashes = {filename: hash_file(os.path.join(location, filename)) for filename in manuscript_files(scripts_path)}
+
+    changed = [filename for filename, digest in hashes.items()
+               if manifest.get(filename) != digest or not os.path.isdir(_fragment_path(data_path, filename))]
+    removed = sorted(filename for filename in manifest if filename not in hashes)
+    return changed, removed, hashes
+
+
+def manuscript_files(scripts_path):
+    """
+    :param scripts_path: the edition scripts directory
+    :return: sorted list of the manuscript XML filenames
+    """
+    location = manuscripts_path(scripts_path)
+    return [filename for filename in sorted(os.listdir(location))
+            if filename.endswith('.xml') and os.path.isfile(os.path.join(location, filename))]
+
+
+def build_manuscript(filename, data_path, scripts_path, scratch=None, scripts=TRANSCRIPTION_SCRIPTS,
+                     fragments_root=None):
+    """
+    run the transcription scripts for a single manuscript in a staging directory
+    and copy its pages into the data path and its index files into the fragment store
+    :param filename: the manuscript XML filename, e.g. E1.xml
+    :param data_path: the data directory of the edition
+    :param scripts_path: the edition scripts directory
+    :param scratch: the directory to stage the build in, defaults to the scratch space (SCRATCH_LOCATION)
+    :param scripts: the scripts to run, in order
+    :param fragments_root: where to store the index files, defaults to the fragment store of the data path
+    """
+    stagedir = tempfile.mkdtemp(dir=scratch) if scratch else staging.mkdtemp()
+    try:
+        staged_scripts = os.path.join(stagedir, 'edition/src/assets/scripts')
+        staged_data = os.path.join(stagedir, 'edition/static/data')
+        os.makedirs(os.path.join(stagedir, 'transcriptions/manuscripts'))
+        os.makedirs(staged_data)
+        # the scripts and the manuscript are only read, so they are linked rather than copied
+        with metrics.timer('estoria_file_copy_duration_seconds', step='stage manuscript'):
+            staging.link_contents(scripts_path, staged_scripts)
+            staging.link(os.path.join(manuscripts_path(scripts_path), filename),
+                         os.path.join(stagedir, 'transcriptions/manuscripts', filename))
+
+        for script in scripts:
+            run_script(script, ['-d', staged_data], staged_scripts)
+
+        collect_outputs(filename, staged_data, data_path, fragments_root)
+    finally:
+        shutil.rmtree(stagedir)
+
+
+def collect_outputs(filename, staged_data, data_path, fragments_root=None):
+    """
+    move the output of a staged build into place
+    directories are merged into the data path, top level files are stored as the manuscript's fragments
+    :param filename: the manuscript XML filename
+    :param staged_data: the data directory of the staged build
+    :param data_path: the data directory of the edition
+    :param fragments_root: where to store the fragments, defaults to the fragment store of the data path
+    """
+    fragment_path = _fragment_path(data_path, filename, fragments_root)
+    if os.path.isdir(fragment_path):
+        shutil.rmtree(fragment_path)
+    os.makedirs(fragment_path)
+
+    for name in os.listdir(staged_data):
+        source = os.path.join(staged_data, name)
+        if os.path.isdir(source):
+            for item in os.listdir(source):
+                destination = os.path.join(data_path, name, item)
+                if os.path.isdir(destination):
+                    shutil.rmtree(destination)
+                os.makedirs(os.path.join(data_path, name), exist_ok=True)
+                shutil.move(os.path.join(source, item), destination)
+        else:
+            shutil.move(source, os.path.join(fragment_path, name))
+
+
+def remove_manuscript(filename, data_path):
+    """
+    remove the pages and fragments of a manuscript that is no longer in the transcriptions
+    :param filename: the manuscript XML filename
+    :param data_path: the data directory of the edition
+    """
+    pages = os.path.join(data_path, 'transcription', filename.replace('.xml', ''))
+    if os.path.isdir(pages):
+        shutil.rmtree(pages)
+    if os.path.isdir(_fragment_path(data_path, filename)):
+        shutil.rmtree(_fragment_path(data_path, filename))
+
+
+def build_pages(data_path, scripts_path, workers=None, done=None):
+    """
+    run the page scripts for every manuscript, each in its own staging directory and several at once,
+    then merge the index files they made (e.g. the menu data) into the data path
+    with the subprocess script runner each manuscript is built on its own core, the in process runner runs
+    one script at a time
+    :param data_path: the data directory of the edition
+    :param scripts_path: the edition scripts directory
+    :param workers: the number of manuscripts built at once, defaults to the number of cores
+    :param done: called with the filename of each manuscript once it is built
+    :return: list of the manuscripts built
+    """
+    filenames = manuscript_files(scripts_path)
+    fragments_root = staging.mkdtemp()
+    try:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+            futures = {executor.submit(build_manuscript, filename, data_path, scripts_path, scripts=PAGE_SCRIPTS,
+                                       fragments_root=fragments_root): filename
+                       for filename in filenames}
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    if done:
+                        done(futures[future])
+            except BaseException:
+                # don't start the manuscripts that are still waiting once one has failed
+                executor.shutdown(cancel_futures=True)
+                raise
+        merge_fragments(data_path, fragments_root)
+    finally:
+        shutil.rmtree(fragments_root)
+    return filenames
+
+
+def merge_fragments(data_path, fragments_root=None):
+    """
+    rebuild the edition wide index files (menu data, chapter index, etc.) from the stored fragments
+    :param data_path: the data directory of the edition
+    :param fragments_root: where the fragments are stored, defaults to the fragment store of the data path
+    :return: list of the index files written
+    :raises MergeError: if a fragment isn't one of the INDEX_MERGES, or its fragments disagree
+    """
+    fragments_root = fragments_root or os.path.join(data_path, INCREMENTAL_DIR, FRAGMENTS_DIR)
+    if not os.path.isdir(fragments_root):
+        return []
+
+    parts = collections.OrderedDict()
+    for manuscript in sorted(os.listdir(fragments_root)):
+        for name in sorted(os.listdir(os.path.join(fragments_root, manuscript))):
+            parts.setdefault(name, []).append(os.path.join(fragments_root, manuscript, name))
+
+    for name, filenames in parts.items():
+        if name not in INDEX_MERGES:
+            raise MergeError('{} is not an index file that can be merged from the manuscripts'.format(name))
+        prefix = None
+        datas = []
+        for filename in filenames:
+            with open(filename, encoding='utf-8') as fp:
+                prefix, data = _parse_index(name, fp.read())
+            if data is None:
+                raise MergeError('{} could not be read'.format(filename))
+            datas.append(data)
+        merged = INDEX_MERGES[name](datas)
+        if prefix:
+            _write_atomic(os.path.join(data_path, name), '{} = {}'.format(prefix, json.dumps(merged)))
+        else:
+            _write_atomic(os.path.join(data_path, name), json.dumps(merged))
+    return list(parts)
+
+
+def parse_js_assignment(content):
+    """
+    split a javascript data file of the form NAME = {...}; into its variable name and JSON
+    :param content: the content of the javascript file
+    :return: (name, json text) or None if the content isn't a single assignment
+    """
+    match = JS_ASSIGNMENT.match(content)
+    return match.groups() if match else None
+
+
+def _parse_index(name, content):
+    """
+    :return: (prefix, data) where prefix is the javascript variable name of a .js index, or None for .json
+             data is None if the file could not be read
+    """
+    prefix = None
+    if name.endswith('.js'):
+        assignment = parse_js_assignment(content)
+        if not assignment:
+            return None, None
+        prefix, content = assignment
+    elif not name.endswith('.json'):
+        return None, None
+    try:
+        return prefix, json.loads(content, object_pairs_hook=collections.OrderedDict)
+    except ValueError:
+        return None, None
+
+
+def merge_by_manuscript(datas):
+    """
+    merge an index whose entries each belong to one manuscript, e.g. the pages of each manuscript
+    :param datas: the index from each manuscript, in order
+    :return: the index with the entries of every manuscript
+    """
+    merged = collections.OrderedDict()
+    for data in datas:
+        if not isinstance(data, dict):
+            raise MergeError('Expected an object of entries, not {}'.format(type(data).__name__))
+        for key, value in data.items():
+            if key in merged and merged[key] != value:
+                raise MergeError('{} has a different entry in more than one manuscript'.format(key))
+            merged[key] = value
+    return merged
+
+
+def merge_lists(datas):
+    """
+    merge an index of lists that each manuscript adds to, e.g. the manuscripts of each chapter
+    :param datas: the index from each manuscript, in order
+    :return: the index with the lists of every manuscript joined together in order
+    """
+    merged = collections.OrderedDict()
+    for data in datas:
+        if not isinstance(data, dict) or not all(isinstance(value, list) for value in data.values()):
+            raise MergeError('Expected an object of lists')
+        for key, value in data.items():
+            merged[key] = merged.get(key, []) + value
+    return merged
+
+
+# how each index file the transcription scripts write is merged from the fragments of the manuscripts
+INDEX_MERGES = {
+    'menu_data.js': merge_by_manuscript,
+    'page_chapter_index.js': merge_by_manuscript,
+    'page_chapter_index.json': merge_by_manuscript,
+    'chapter_index.json': merge_lists,
+}
+
+
+def _fragment_path(data_path, filename, fragments_root=None):
+    return os.path.join(fragments_root or os.path.join(data_path, INCREMENTAL_DIR, FRAGMENTS_DIR),
+                        filename.replace('.xml', ''))
+
+
+def _write_atomic(filename, content):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temporary = filename + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as fp:
+        fp.write(content)
+    os.replace(temporary, filename)
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from djangoproject.benchmarks import write_results
+from estoria_app.benchmark import run_benchmark
+
+
+def parse_config(value):
+    """
+    :param value: pool size, shard size and worker threads separated by colons, e.g. 2:10:2
+    :return: tuple of the three numbers
+    """
+    try:
+        pool_size, shard_size, workers = (int(part) for part in value.split(':'))
+    except ValueError:
+        raise CommandError('A configuration must be pool_size:shard_size:workers, not {}'.format(value))
+    return pool_size, shard_size, workers
+
+
+class Command(BaseCommand):
+    help = 'Benchmark baking offline against a local stand-in of the chapter pages and print the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chapters', type=int, default=20, help='the number of chapters to bake')
+        parser.add_argument('--verses', type=int, default=10, help='the number of verses in each chapter')
+        parser.add_argument('--render-delay', type=int, default=0,
+                            help='milliseconds each page waits before it renders the chapter')
+        parser.add_argument('--server-delay', type=float, default=0,
+                            help='seconds the server waits before answering each request')
+        parser.add_argument('--config', action='append', dest='configs',
+                            help='pool_size:shard_size:workers, can be given several times (default 1:25:1)')
+        parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        configs = [parse_config(value) for value in options['configs'] or ['1:25:1']]
+        results = run_benchmark(configs, chapters=options['chapters'], verses=options['verses'],
+                                render_delay=options['render_delay'], server_delay=options['server_delay'])
+        write_results(results, options['output'], self.stdout)
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+
+def multi_arguments(concurrency, app='djangoproject'):
+    """
+    :param concurrency: dict of the queues of each worker, separated by commas, to its number of processes
+    :param app: the Celery application
+    :return: list of the arguments of celery multi that start a worker for each entry
+    """
+    names = [queues.split(',')[0] for queues in concurrency]
+    arguments = ['celery', '-A', app, 'multi', 'start'] + names
+    for name, (queues, processes) in zip(names, concurrency.items()):
+        arguments += ['-Q:{}'.format(name), queues, '-c:{}'.format(name), str(processes)]
+    return arguments
+
+
+class Command(BaseCommand):
+    help = 'Print the celery multi command that starts a worker for each queue in WORKER_CONCURRENCY'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--app', default='djangoproject', help='the Celery application')
+
+    def handle(self, *args, **options):
+        concurrency = getattr(settings, 'WORKER_CONCURRENCY', {'baking': 1, 'rebuilds,celery': 1, 'conversions': 2})
+        self.stdout.write(' '.join(multi_arguments(concurrency, options['app'])))
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from estoria_app import collations
+from estoria_app.renderer import ChapterRenderer, RenderError, compare
+
+import os
+
+DATA_PATHS = {'estoria-digital': 'ESTORIA_DATA_PATH', 'cpsf-digital': 'CPSF_DATA_PATH'}
+
+
+class Command(BaseCommand):
+    help = 'Render the baked chapters in python and diff them against the chapters baked by the browser'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project', choices=sorted(DATA_PATHS), default='estoria-digital')
+        parser.add_argument('--start', type=int, default=1, help='the first chapter to compare')
+        parser.add_argument('--stop', type=int, help='the last chapter to compare, defaults to the last chapter')
+        parser.add_argument('--exact', action='store_true',
+                            help='compare the html as it is, not only what changes the page')
+        parser.add_argument('--data-path', help='the data directory of the edition, defaults to the project\'s')
+        parser.add_argument('--approved-path',
+                            help='the directory of approved collations, defaults to the project\'s')
+
+    def handle(self, *args, **options):
+        project = options['project']
+        data_path = options['data_path'] or getattr(settings, DATA_PATHS[project])
+        approved_path = options['approved_path'] or os.path.join(settings.ESTORIA_BASE_LOCATION, project,
+                                                                 'collation', 'approved')
+        stop = options['stop'] or collations.get_index(data_path).maximum_chapter
+        chapter_renderer = ChapterRenderer(data_path, approved_path, project)
+
+        differ = []
+        missing = []
+        for chapter in range(options['start'], stop + 1):
+            try:
+                with open(os.path.join(data_path, 'critical', '{}.html'.format(chapter)), encoding='utf-8') as fp:
+                    baked = fp.read()
+            except FileNotFoundError:
+                missing.append(chapter)
+                continue
+            try:
+                diff = compare(baked, chapter_renderer.render(chapter), exact=options['exact'])
+            except RenderError as e:
+                diff = ['could not render: {}'.format(e)]
+            if diff:
+                differ.append(chapter)
+                self.stdout.write('chapter {} differs'.format(chapter))
+                self.stdout.write('\n'.join(diff))
+
+        compared = stop - options['start'] + 1 - len(missing)
+        self.stdout.write('{} of {} baked chapters are the same'.format(compared - len(differ), compared))
+        if missing:
+            self.stdout.write('not baked: {}'.format(', '.join(str(chapter) for chapter in missing)))
+        if differ:
+            raise CommandError('{} chapters differ: {}'.format(len(differ), ', '.join(str(c) for c in differ)))
@@ -0,0 +1,141 @@
+"""
+Resumable pipelines of the edition scripts
+
+Each script of a pipeline is run by its own run_step task, in a Celery chain that ends with finish_pipeline.
+Each step that completes is recorded in a checkpoint under the data path, along with a fingerprint of the
+scripts and of the pipeline's input files. A resubmission with the same inputs, or a retry of a failed step,
+starts from the first step that hasn't completed. The checkpoint is removed once the whole pipeline has
+finished, so the next rebuild runs every step again.
+"""
+from . import incremental
+
+import hashlib
+import json
+import os
+
+CHECKPOINT_DIR = 'checkpoints'
+# the step that runs the page scripts for each manuscript in parallel, see incremental.build_pages
+PAGES_STEP = 'build manuscript pages'
+
+# the scripts of each pipeline, in order, and the directories of its input files relative to the project
+PIPELINES = {
+    'estoria_xml': {
+        'scripts': ['make_paginated_json.py', 'add_html_to_paginated_json.py', 'make_chapter_index_json.py'],
+        'inputs': ['transcriptions/manuscripts'],
+    },
+    'estoria_xml_parallel': {
+        'scripts': [PAGES_STEP, 'make_chapter_index_json.py'],
+        'inputs': ['transcriptions/manuscripts'],
+    },
+    'reader_xml': {
+        'scripts': ['make_reader.py'],
+        'inputs': ['transcriptions/readerXML'],
+    },
+    'translation_xml': {
+        'scripts': ['make_translation.py'],
+        'inputs': ['transcriptions/translationXML'],
+    },
+    'cpsf_critical_xml': {
+        'scripts': ['make_cpsf_critical.py'],
+        'inputs': ['transcriptions/criticalXML'],
+    },
+    'critical_edition_first': {
+        'scripts': ['make_critical_chapter_verse_json.py', 'make_verse_page_index_json.py'],
+        'inputs': ['collation/approved'],
+    },
+}
+
+
+def project_path(scripts_path):
+    """
+    :param scripts_path: the edition scripts directory (edition/src/assets/scripts)
+    :return: the project directory the scripts belong to
+    """
+    return os.path.normpath(os.path.join(scripts_path, '..', '..', '..', '..'))
+
+
+def inputs_fingerprint(name, scripts_path):
+    """
+    :param name: the name of the pipeline
+    :param scripts_path: the edition scripts directory
+    :return: the sha256 hex digest of the pipeline's scripts and the names, sizes and times of its input files
+    """
+    sha = hashlib.sha256()
+    scripts = []
+    for step in PIPELINES[name]['scripts']:
+        scripts += incremental.PAGE_SCRIPTS if step == PAGES_STEP else [step]
+    for script in scripts:
+        sha.update(script.encode())
+        try:
+            with open(os.path.join(scripts_path, script), 'rb') as fp:
+                sha.update(hashlib.sha256(fp.read()).digest())
+        except OSError:
+            sha.update(b'missing')
+    for inputs in PIPELINES[name]['inputs']:
+        location = os.path.join(project_path(scripts_path), inputs)
+        for directory, dirnames, filenames in os.walk(location):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                stat = os.stat(os.path.join(directory, filename))
+                sha.update('{}:{}:{}\n'.format(os.path.relpath(os.path.join(directory, filename), location),
+                                               stat.st_size, stat.st_mtime_ns).encode())
+    return sha.hexdigest()
+
+
+def load_checkpoint(data_path, name):
+    """
+    :return: the checkpoint of the pipeline, {'fingerprint': ..., 'done': [{'name': ..., 'elapsed': ...}]},
+             or None if there isn't one
+    """
+    try:
+        with open(_checkpoint_file(data_path, name), encoding='utf-8') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(data_path, name, checkpoint):
+    """
+    write the checkpoint, replacing the old one in a single step
+    """
+    filename = _checkpoint_file(data_path, name)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temporary = filename + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as fp:
+        json.dump(checkpoint, fp, indent=1)
+    os.replace(temporary, filename)
+
+
+def clear_checkpoint(data_path, name):
+    try:
+        os.remove(_checkpoint_file(data_path, name))
+    except FileNotFoundError:
+        pass
+
+
+def start(data_path, name, scripts_path):
+    """
+    find the steps that are still to be run, starting a new checkpoint if the inputs have changed
+    :return: (the steps already done, the scripts still to be run)
+    """
+    fingerprint = inputs_fingerprint(name, scripts_path)
+    checkpoint = load_checkpoint(data_path, name)
+    if not checkpoint or checkpoint.get('fingerprint') != fingerprint:
+        checkpoint = {'fingerprint': fingerprint, 'done': []}
+        save_checkpoint(data_path, name, checkpoint)
+    done = [step['name'] for step in checkpoint['done']]
+    return checkpoint['done'], [script for script in PIPELINES[name]['scripts'] if script not in done]
+
+
+def step_done(data_path, name, script, elapsed):
+    """
+    record that a step of the pipeline has completed
+    """
+    checkpoint = load_checkpoint(data_path, name) or {'fingerprint': None, 'done': []}
+    checkpoint['done'] = [step for step in checkpoint['done'] if step['name'] != script]
+    checkpoint['done'].append({'name': script, 'elapsed': elapsed})
+    save_checkpoint(data_path, name, checkpoint)
+
+
+def _checkpoint_file(data_path, name):
+    return os.path.join(data_path, CHECKPOINT_DIR, name + '.json')
@@ -0,0 +1,138 @@
+"""
+Coalescing of rebuild requests
+
+Only one run of each rebuild pipeline of a project is queued or running at a time. A request for a pipeline
+that is already queued is given the id of the queued task. A request while it is running is given the id of
+a single follow-up run, which is queued REBUILD_DEBOUNCE seconds after the running task finishes, so that
+every request made during the run and the debounce window shares it. The full and the incremental
+(incremental=True) runs of a pipeline write to the same data path, so they are coalesced together: a full run
+does the work of an incremental one, and a full request turns the follow-up into a full run. The state is kept
+in the task state cache (TASK_STATUS_CACHE), which must be shared by the web server and the workers.
+"""
+from celery import signals, current_app, uuid
+from celery.states import READY_STATES, IGNORED
+from django.conf import settings
+from djangoproject import status
+from contextlib import contextmanager
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+ENTRY_PREFIX = 'rebuild:'
+TASK_PREFIX = 'rebuild-task:'
+# seconds to wait for another request to finish checking the same pipeline
+LOCK_WAIT = 5
+
+
+def _cache():
+    return status.shared_cache()
+
+
+def _timeout():
+    # forget about a run that never reported finishing, e.g. because its worker was killed
+    return getattr(settings, 'REBUILD_LOCK_TIMEOUT', 6 * 60 * 60)
+
+
+@contextmanager
+def _locked(entry_key):
+    """
+    hold the lock of a pipeline while its entry is checked and changed
+    """
+    lock_key = entry_key + ':lock'
+    deadline = time.monotonic() + LOCK_WAIT
+    acquired = _cache().add(lock_key, True, 30)
+    while not acquired and time.monotonic() < deadline:
+        time.sleep(0.05)
+        acquired = _cache().add(lock_key, True, 30)
+    if not acquired:
+        logger.warning('Carrying on without the lock of {}'.format(entry_key))
+    try:
+        yield
+    finally:
+        if acquired:
+            _cache().delete(lock_key)
+
+
+def start_rebuild(project, pipeline, celery_task, *args, **kwargs):
+    """
+    start a rebuild, unless the same rebuild is already queued or running
+    :param project: the project being rebuilt, e.g. estoria-digital
+    :param pipeline: the name of the rebuild, the same for requests that write to the same data
+    :param celery_task: the Celery task of the rebuild
+    :param args: the arguments of the task
+    :param kwargs: the keyword arguments of the task, incremental=True for a rebuild of the changed files only
+    :return: the id of the task the request is served by
+    """
+    entry_key = '{}{}:{}'.format(ENTRY_PREFIX, project, pipeline)
+    with _locked(entry_key):
+        entry = _cache().get(entry_key)
+        if entry:
+            state = status.get_status(entry['task_id'])['state']
+            if state == 'PENDING' and _covers(entry.get('kwargs', {}), kwargs):
+                logger.info('{} is already queued as {}'.format(entry_key, entry['task_id']))
+                return entry['task_id']
+            if state not in READY_STATES:
+                followup = entry['followup']
+                if not followup:
+                    followup = entry['followup'] = {'task_id': uuid(), 'task': celery_task.name,
+                                                    'args': list(args), 'kwargs': kwargs}
+                    _cache().set(entry_key, entry, _timeout())
+                elif not _covers(followup['kwargs'], kwargs):
+                    # the requests for the follow-up are served by the full run just as well
+                    followup['kwargs'] = kwargs
+                    _cache().set(entry_key, entry, _timeout())
+                logger.info('{} is running, the follow-up run is {}'.format(entry_key, followup['task_id']))
+                return followup['task_id']
+
+        task_id = str(celery_task.delay(*args, **kwargs).id)
+        _cache().set(entry_key, {'task_id': task_id, 'kwargs': kwargs, 'followup': None}, _timeout())
+        _cache().set(TASK_PREFIX + task_id, entry_key, _timeout())
+        return task_id
+
+
+def _covers(kwargs, requested):
+    """
+    :return: whether a run with kwargs does the work of the run that is requested
+    """
+    return not kwargs.get('incremental') or bool(requested.get('incremental'))
+
+
+def _task_postrun(task_id=None, state=None, **kwargs):
+    """
+    when a rebuild finishes, queue its follow-up run if one was asked for
+    """
+    if state == IGNORED:
+        # the task was replaced by the chain of its steps, whose last task takes over its id
+        return
+    finished(task_id)
+
+
+def finished(task_id):
+    """
+    a rebuild is no longer running, e.g. because a step of its chain failed for good, so queue its follow-up run
+    if one was asked for, or forget about it
+    :param task_id: the id the rebuild was started as
+    """
+    entry_key = _cache().get(TASK_PREFIX + str(task_id))
+    if not entry_key:
+        return
+    with _locked(entry_key):
+        _cache().delete(TASK_PREFIX + str(task_id))
+        entry = _cache().get(entry_key)
+        if not entry or entry['task_id'] != task_id:
+            return
+        followup = entry['followup']
+        if not followup:
+            _cache().delete(entry_key)
+            return
+        current_app.tasks[followup['task']].apply_async(followup['args'], followup['kwargs'],
+                                                        task_id=followup['task_id'],
+                                                        countdown=getattr(settings, 'REBUILD_DEBOUNCE', 30))
+        _cache().set(entry_key, {'task_id': followup['task_id'], 'kwargs': followup['kwargs'], 'followup': None},
+                     _timeout())
+        _cache().set(TASK_PREFIX + followup['task_id'], entry_key, _timeout())
+        logger.info('{}: queued the follow-up run {} of {}'.format(task_id, followup['task_id'], entry_key))
+
+
+signals.task_postrun.connect(_task_postrun, weak=False)
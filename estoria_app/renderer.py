@@ -0,0 +1,301 @@
+"""
+Rendering of the baked chapters without a browser
+
+A baked chapter is the content of the .container element of chapter_check.html once process_data in
+simpleeditor.js has rendered the approved collation of each verse with the overtext and variant templates.
+The renderer builds the same markup directly from collations.json, page_chapter_index.json (or their .js
+versions) and the approved collations, written the way the browser serialises it, so that baking needs no
+browser (BAKING_RENDERER = 'python').
+Anything that would stop the page from finishing in the browser raises RenderError instead.
+
+compare() diffs a rendered chapter against one baked by the browser, see the compare_baked_chapters command.
+"""
+from .fingerprints import load_json_index
+from html.parser import HTMLParser
+
+import logging
+import difflib
+import math
+import json
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# the .container element of chapter_check.html around what is added to #apparatus and #variants
+CONTAINER_START = '\n      <div id="apparatus">\n      '
+CONTAINER_MIDDLE = ('</div>\n      <br>\n      <label for="variants">Footnotes:</label>\n'
+                    '      <div id="variants">\n      ')
+CONTAINER_END = '</div>\n      <br>\n    '
+
+
+class RenderError(Exception):
+    """
+    the chapter can't be rendered, the page would never finish in the browser
+    """
+
+
+class ChapterRenderer(object):
+    """
+    renders the chapters of one project
+    """
+    def __init__(self, data_path, approved_path, project, collations=None, page_chapter_index=None):
+        """
+        :param data_path: the data directory of the edition, with the collations and page_chapter_index files
+        :param approved_path: the directory of approved collations
+        :param project: the project, e.g. estoria-digital
+        :param collations: the collations index if it is already loaded
+        :param page_chapter_index: the page chapter index if it is already loaded
+        """
+        if not approved_path:
+            raise RenderError('The chapters can only be rendered from a directory of approved collations')
+        self.approved_path = approved_path
+        self.project = project
+        self.collations = collations if collations is not None else load_json_index(data_path, 'collations')
+        self.page_chapter_index = (page_chapter_index if page_chapter_index is not None
+                                   else load_json_index(data_path, 'page_chapter_index'))
+
+    def render(self, chapter):
+        """
+        :param chapter: the chapter number
+        :return: the html of the chapter, as it is baked
+        """
+        verses = self.collations.get(str(chapter))
+        if verses is None:
+            raise RenderError('Chapter {} is not in the collations index'.format(chapter))
+        apparatus = []
+        variants = []
+        for verse in verses:
+            context = 'D{}S{}'.format(chapter, verse)
+            try:
+                with open(os.path.join(self.approved_path, context + '.json'), encoding='utf-8') as fp:
+                    data = json.load(fp)
+            except (OSError, ValueError) as e:
+                # the page leaves out a verse whose collation doesn't load
+                logger.debug('Leaving out {}: {!r}'.format(context, e))
+                continue
+            try:
+                render_verse(data, str(chapter), self.page_chapter_index, self.project, apparatus, variants)
+            except (KeyError, IndexError, TypeError, AttributeError) as e:
+                raise RenderError('Could not render {}: {!r}'.format(context, e))
+        return CONTAINER_START + ''.join(apparatus) + CONTAINER_MIDDLE + ''.join(variants) + CONTAINER_END
+
+
+def render_verse(data, chapter, page_chapter_index, project, apparatus, variants):
+    """
+    render the approved collation of a verse, as process_data in simpleeditor.js does
+    :param data: the approved collation
+    :param chapter: the chapter being rendered
+    :param page_chapter_index: the page chapter index, witness to verse context to page
+    :param project: the project, e.g. estoria-digital
+    :param apparatus: list the html added to #apparatus is appended to
+    :param variants: list the html added to #variants is appended to
+    """
+    verse_blocks = []
+    verse_variants = []
+    real_variants = []
+    context = data['context']
+    chapter_and_verse = context.split('S')
+    verse_number = chapter_and_verse[1] if len(chapter_and_verse) > 1 else None
+    chapter_id_name = _split(chapter_and_verse[0], 'D', 1)
+    is_rubric = verse_number == 'Rubric'
+    context_key = 'D{}S100'.format(chapter_id_name) if context.endswith('Rubric') else context
+    for i, unit in enumerate(data['structure']['apparatus']):
+        overtext_witnesses = ''
+        overtext_witnesses_list = []
+        for j, reading in enumerate(unit['readings']):
+            witnesses = reading['witnesses']
+            text = ' '.join(_js_string(token.get('interface')) for token in reading['text'])
+            if j == 0:
+                overtext_witnesses = ' '.join(witnesses)
+                overtext_witnesses_list = witnesses
+                verse_blocks.append({'text': text, 'id': '{}_{}'.format(context, i), 'i': i})
+                continue
+
+            if len(witnesses) == 1 and text == '':
+                # an omission in only one of E1 and E2 is left out, unless the other is the first overtext
+                # witness, as $.inArray returns the index of the witness, or -1 if it isn't there
+                if witnesses[0] == 'E2' and _in_array('E1', overtext_witnesses_list) != 0:
+                    continue
+                if witnesses[0] == 'E1' and _in_array('E2', overtext_witnesses_list) != 0:
+                    continue
+
+            formatted = []
+            for witness in witnesses:
+                page = page_chapter_index[witness.split('-mod')[0]].get(context_key)
+                if page:
+                    formatted.append('<span class="witname" data-page-name="{}">{}</span>'.format(
+                        _attribute(page), _text(witness)))
+            if not formatted:
+                continue
+            real_variants.append(i)
+            last_wit = _split(overtext_witnesses, ' ', 1)
+            if overtext_witnesses == 'Base':
+                last_wit = get_base_witness(chapter_id_name)
+            elif project == 'cpsf-digital':
+                # always use E2 for cpsf edition
+                last_wit = 'E2'
+            verse_variants.append({'formatted_witnesses': ' '.join(formatted),
+                                   'text': text,
+                                   'id': '{}_{}'.format(context, i),
+                                   'overtext_witnesses': overtext_witnesses,
+                                   'overtext_page_name': page_chapter_index[last_wit].get(context_key),
+                                   'last_wit': last_wit})
+
+    if is_rubric:
+        verse_label = 'R'
+    else:
+        try:
+            verse_label = _js_number(float(verse_number) / 100 if verse_number.strip() else 0.0)
+        except (ValueError, AttributeError):
+            verse_label = 'NaN'
+
+    if verse_variants:
+        variants.append('<span class="variant_number"><strong>{}.</strong></span> '.format(_text(verse_label)))
+    variants.append(_variant_template(verse_variants))
+    variants.append(' ')
+
+    if is_rubric:
+        # the stray </strong> in simpleeditor.js is dropped, leaving the space in the span
+        apparatus.append('<span class="chapter">{} </span>'.format(_text(chapter)))
+    else:
+        apparatus.append('<sub>{}</sub> '.format(_text(verse_label)))
+    apparatus.append(_overtext_template(verse_blocks, real_variants, verse_number, is_rubric))
+    apparatus.append(' ')
+
+
+def get_base_witness(page):
+    """
+    :return: the base witness of the chapter, as get_base_witness in simpleeditor.js, or None
+    """
+    try:
+        page_number = int(page)
+    except (TypeError, ValueError):
+        return None
+    if page_number < 575:
+        return 'E1'
+    elif page_number < 656:
+        return 'E2'
+    elif page_number < 821:
+        return 'T'
+    return None
+
+
+def _overtext_template(blocks, real_variants, verse_number, is_rubric):
+    html = '\n   <span id="verse-{}">\n'.format(_attribute(_js_string(verse_number)))
+    for block in blocks:
+        marked = block['i'] in real_variants
+        if block['text']:
+            content = _text(block['text'])
+            if marked:
+                content = '⸂' + content + '<span class="critical_marker">⸃</span>'
+        else:
+            content = '<span class="critical_marker">⸆</span>' if marked else ''
+        html += '     <span id="{}" class="overtext">{}</span>\n'.format(_attribute(block['id']), content)
+    return html + '     {}\n   </span>\n   '.format('<br>' if blocks and is_rubric else '')
+
+
+def _variant_template(variants):
+    html = '\n'
+    for index, variant in enumerate(variants):
+        if variant['text']:
+            text = '<span class="variant-wit-text">{}</span>'.format(_text(variant['text']))
+        else:
+            text = '<span class="variant-wit-text"><em>om</em></span>'
+        html += ('     <span id="{}" class="variant" data-base-witness="{}"><span class="base_counter" '
+                 'data-base-last-wit="{}" data-base-page-name="{}">{}</span> {}: {}</span>\n').format(
+            _attribute(variant['id']), _attribute(variant['overtext_witnesses']),
+            _attribute(_js_string(variant['last_wit'])), _attribute(_js_string(variant['overtext_page_name'])),
+            '|' if index else '', variant['formatted_witnesses'], text)
+    return html + '   '
+
+
+def _text(value):
+    # as the browser serialises a text node
+    return str(value).replace('&', '&amp;').replace('\xa0', '&nbsp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _attribute(value):
+    # as the browser serialises an attribute value
+    return str(value).replace('&', '&amp;').replace('\xa0', '&nbsp;').replace('"', '&quot;')
+
+
+def _js_string(value):
+    # as Handlebars and Array.join print a value
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float):
+        return _js_number(value)
+    return str(value)
+
+
+def _js_number(value):
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return 'Infinity' if value > 0 else '-Infinity'
+    if value == int(value) and abs(value) < 1e21:
+        return str(int(value))
+    return repr(value)
+
+
+def _split(value, separator, index):
+    # value.split(separator)[index] in javascript, None where it would be undefined
+    parts = value.split(separator)
+    return parts[index] if index < len(parts) else None
+
+
+def _in_array(value, items):
+    return items.index(value) if value in items else -1
+
+
+class _Normaliser(HTMLParser):
+    """
+    writes html out again without the differences that don't change the page: how entities, attributes and
+    empty elements are written, and runs of whitespace
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        self.parts.append('<{}{}>'.format(tag, ''.join(' {}="{}"'.format(name, _attribute(value or ''))
+                                                       for name, value in sorted(attrs))))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        self.parts.append('</{}>'.format(tag))
+
+    def handle_data(self, data):
+        self.parts.append(_text(re.sub(r'\s+', ' ', data)))
+
+
+def normalise(html):
+    """
+    :return: the html written out the same way whichever browser or renderer made it
+    """
+    parser = _Normaliser()
+    parser.feed(html)
+    parser.close()
+    return re.sub(r'\s+', ' ', ''.join(parser.parts)).strip()
+
+
+def compare(baked, rendered, exact=False):
+    """
+    diff a rendered chapter against the same chapter baked by the browser
+    :param baked: the html baked by the browser
+    :param rendered: the html from ChapterRenderer.render
+    :param exact: compare the html as it is, rather than normalised
+    :return: list of the lines of a unified diff, with a line for each element, empty if they are the same
+    """
+    if not exact:
+        baked, rendered = normalise(baked), normalise(rendered)
+    return list(difflib.unified_diff(_lines(baked), _lines(rendered), 'baked', 'rendered', lineterm=''))
+
+
+def _lines(html):
+    return [line for part in re.split(r'(?=<)', html) for line in part.split('\n') if line]
@@ -0,0 +1,120 @@
+var EDITION_INDEX = (function () {
+
+    /* options: index_url, the element to list the chapters in, the bake_form used to bake a single chapter,
+       the filter_form with start_chapter, stop_chapter and q inputs, and the more button */
+    var init = function (options) {
+        var page = 0;
+        var has_next = true;
+        var loading = false;
+        var filters = {};
+        /* changes whenever the filters do, so a page that arrives for the old filters is dropped */
+        var generation = 0;
+
+        var chapter_element = function (item) {
+            var wrapper = document.createElement('div');
+            var heading = document.createElement('p');
+            var title = document.createElement('strong');
+            title.textContent = item.chapter;
+            heading.appendChild(title);
+            heading.appendChild(document.createTextNode(' | ('));
+            var link = document.createElement('a');
+            link.href = '/estoria-admin/apparatus/chapter/' + item.chapter;
+            link.textContent = 'whole chapter';
+            heading.appendChild(link);
+            heading.appendChild(document.createTextNode(') '));
+            var bake = document.createElement('button');
+            bake.type = 'button';
+            bake.textContent = 'Bake';
+            bake.addEventListener('click', function () {
+                options.bake_form.elements.chapter.value = item.chapter;
+                options.bake_form.submit();
+            });
+            heading.appendChild(bake);
+            wrapper.appendChild(heading);
+
+            var list = document.createElement('ul');
+            item.verses.forEach(function (verse) {
+                var entry = document.createElement('li');
+                entry.appendChild(document.createTextNode(verse + ' | '));
+                var verse_link = document.createElement('a');
+                verse_link.href = '/estoria-admin/apparatus/D' + item.chapter + 'S' + encodeURIComponent(verse);
+                verse_link.textContent = 'Critical Edition';
+                entry.appendChild(verse_link);
+                list.appendChild(entry);
+            });
+            wrapper.appendChild(list);
+            return wrapper;
+        };
+
+        var load_next = function () {
+            if (loading || !has_next) {
+                return;
+            }
+            loading = true;
+            var requested = generation;
+            var query = $.param($.extend({page: page + 1}, filters));
+            $.getJSON(options.index_url + '?' + query).done(function (data) {
+                if (requested !== generation) {
+                    return;
+                }
+                data.chapters.forEach(function (item) {
+                    options.element.appendChild(chapter_element(item));
+                });
+                page = data.page;
+                has_next = data.has_next;
+                loading = false;
+                options.more.style.display = has_next ? '' : 'none';
+                if (data.total === 0) {
+                    options.element.textContent = 'No chapters found.';
+                }
+            }).fail(function (xhr) {
+                if (requested !== generation) {
+                    return;
+                }
+                /* show why, and let the more button try the same page again */
+                var error = document.createElement('p');
+                error.className = 'error';
+                error.textContent = (xhr.responseJSON && xhr.responseJSON.error) || 'The chapters could not be loaded.';
+                options.element.appendChild(error);
+                loading = false;
+            });
+        };
+
+        var reset = function () {
+            filters = {};
+            ['start_chapter', 'stop_chapter', 'q'].forEach(function (name) {
+                var value = options.filter_form.elements[name].value.trim();
+                if (value) {
+                    filters[name] = value;
+                }
+            });
+            options.element.textContent = '';
+            generation += 1;
+            loading = false;
+            page = 0;
+            has_next = true;
+            load_next();
+        };
+
+        options.filter_form.addEventListener('submit', function (event) {
+            event.preventDefault();
+            reset();
+        });
+        options.more.addEventListener('click', load_next);
+
+        /* load the next page as the end of the list scrolls into view */
+        if (window.IntersectionObserver) {
+            new IntersectionObserver(function (entries) {
+                if (entries[0].isIntersecting) {
+                    load_next();
+                }
+            }).observe(options.more);
+        }
+        reset();
+    };
+
+    return {
+        init: init,
+    };
+
+})();
@@ -1,109 +1,283 @@
 from __future__ import absolute_import, unicode_literals
-from celery import shared_task, current_task
+from celery import shared_task, current_task, current_app, chain, chord, uuid
 from django.conf import settings
-from selenium import webdriver
-from selenium.webdriver import FirefoxOptions
+from djangoproject.runner import run_script
+from djangoproject.progress import TaskProgress
+from djangoproject import metrics, status
+# rebuilds also connects the queueing of follow-up rebuilds when a rebuild finishes in the worker
+from . import incremental, browsers, fingerprints, pipeline, renderer, rebuilds
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
-import subprocess
+from contextlib import contextmanager
 import logging
+import time
 import os
 
 logger = logging.getLogger(__name__)
-python_path = os.path.join(settings.VIRTUAL_ENV_PATH, 'bin', 'python3')
 
-@shared_task
-def estoria_xml(data_path, scripts_path):
+@shared_task(bind=True)
+def estoria_xml(self, data_path, scripts_path, incremental=False):
     """
     update the Estoria site with the current transcription XML files
+    :param incremental: only rebuild the manuscripts that have changed since the last incremental rebuild
     """
-    logger.info('{}: estoria_xml task started'.format(current_task.request.id))
-    logger.debug('{}: Data path: {}'.format(current_task.request.id, data_path))
-    logger.debug('{}: Scripts location: {}'.format(current_task.request.id, scripts_path))
+    logger.info('{}: estoria_xml task started'.format(self.request.id))
+    logger.debug('{}: Data path: {}'.format(self.request.id, data_path))
+    logger.debug('{}: Scripts location: {}'.format(self.request.id, scripts_path))
 
-    logger.debug('{}: run make_paginated_json.py'.format(current_task.request.id))
-    subprocess.check_call([python_path, 'make_paginated_json.py', '-d', data_path], cwd=scripts_path)
+    if incremental:
+        return _estoria_xml_incremental(data_path, scripts_path)
 
-    logger.debug('{}: run add_html_to_paginated_json.py'.format(current_task.request.id))
-    subprocess.check_call([python_path, 'add_html_to_paginated_json.py', '-d', data_path], cwd=scripts_path)
+    # the pages of each manuscript are only built on their own, in parallel, when more than one worker is asked for
+    if getattr(settings, 'TRANSCRIPTION_WORKERS', 1) == 1:
+        return _run_pipeline(self, 'estoria_xml', data_path, scripts_path)
+    return _run_pipeline(self, 'estoria_xml_parallel', data_path, scripts_path)
 
-    logger.debug('{}: run make_chapter_index_json.py'.format(current_task.request.id))
-    subprocess.check_call([python_path, 'make_chapter_index_json.py', '-d', data_path], cwd=scripts_path)
 
-    logger.info('{}: complete'.format(current_task.request.id))
+def _run_pipeline(task, name, data_path, scripts_path):
+    """
+    replace the task with a chain of the steps of the pipeline that haven't completed yet
+    the steps log and report their progress under the id of the task, which the last task of the chain takes over
+    """
+    done, scripts = pipeline.start(data_path, name, scripts_path)
+    if done:
+        logger.info('{}: resume {} from {}'.format(task.request.id, name, scripts[0] if scripts else 'the end'))
+    steps = [run_step.si(name, script, data_path, scripts_path, task.request.id) for script in scripts]
+    return task.replace(chain(steps + [finish_pipeline.si(name, data_path, task.request.id)]))
 
 
-@shared_task
-def reader_xml(data_path, scripts_path):
+@shared_task(bind=True)
+def run_step(self, name, script, data_path, scripts_path, pipeline_id):
     """
-    update the Estoria site with the current reader XML file
+    run one script of a pipeline and record it in the pipeline's checkpoint
+    a failed script is retried up to PIPELINE_STEP_RETRIES times, without running the earlier steps again
+    :param name: the name of the pipeline
+    :param pipeline_id: the id of the task the pipeline was started as
     """
-    logger.info('{}: reader_xml task started'.format(current_task.request.id))
-    logger.debug('{}: Data path: {}'.format(current_task.request.id, data_path))
-    logger.debug('{}: Scripts location: {}'.format(current_task.request.id, scripts_path))
+    checkpoint = pipeline.load_checkpoint(data_path, name) or {'done': []}
+    progress = TaskProgress(pipeline_id, total=len(pipeline.PIPELINES[name]['scripts']),
+                            steps=[{'name': _step_name(step['name']), 'elapsed': step['elapsed']}
+                                   for step in checkpoint['done']],
+                            done=len(checkpoint['done']))
+    logger.debug('{}: run {}'.format(pipeline_id, script))
+    try:
+        if script == pipeline.PAGES_STEP:
+            progress.step(script, total=len(incremental.manuscript_files(scripts_path)))
+            incremental.build_pages(data_path, scripts_path, workers=getattr(settings, 'TRANSCRIPTION_WORKERS', None),
+                                    done=lambda filename: progress.advance())
+        else:
+            progress.step(_step_name(script))
+            run_script(script, ['-d', data_path], scripts_path)
+            progress.advance()
+    except Exception as e:
+        logger.warning('{}: {} failed (attempt {}): {!r}'.format(pipeline_id, script, self.request.retries + 1, e))
+        max_retries = getattr(settings, 'PIPELINE_STEP_RETRIES', 2)
+        if self.request.retries >= max_retries:
+            _fail_pipeline(pipeline_id, e)
+        raise self.retry(exc=e, countdown=getattr(settings, 'PIPELINE_STEP_RETRY_DELAY', 10), max_retries=max_retries)
+    pipeline.step_done(data_path, name, script, progress.finish()[-1]['elapsed'])
 
-    logger.debug('{}: run make_reader.py'.format(current_task.request.id))
-    subprocess.check_call([python_path, 'make_reader.py', '-d', data_path], cwd=scripts_path)
 
-    logger.info('{}: complete'.format(current_task.request.id))
+def _fail_pipeline(pipeline_id, exc):
+    """
+    a step has failed for good, so the rest of the chain, and with it the task that takes over the id of the
+    pipeline, never runs: record the failure under that id and let a follow-up rebuild go ahead
+    """
+    logger.error('{}: failed: {!r}'.format(pipeline_id, exc))
+    try:
+        current_app.backend.mark_as_failure(pipeline_id, exc)
+    except Exception as e:
+        logger.warning('{}: could not store the failure: {!r}'.format(pipeline_id, e))
+    status.set_status(pipeline_id, 'FAILURE', exc)
+    rebuilds.finished(pipeline_id)
+
+
+def _step_name(script):
+    return script if script == pipeline.PAGES_STEP else 'run {}'.format(script)
 
 
 @shared_task
-def translation_xml(data_path, scripts_path):
+def finish_pipeline(name, data_path, pipeline_id):
     """
-    update the Estoria site with the current reader XML file
+    the last task of a pipeline's chain, which takes over the id of the task the pipeline was started as
     """
-    logger.info('{}: translation_xml task started'.format(current_task.request.id))
-    logger.debug('{}: Data path: {}'.format(current_task.request.id, data_path))
-    logger.debug('{}: Scripts location: {}'.format(current_task.request.id, scripts_path))
+    pipeline.clear_checkpoint(data_path, name)
+    logger.info('{}: complete'.format(pipeline_id))
 
-    logger.debug('{}: run make_translation.py'.format(current_task.request.id))
-    subprocess.check_call([python_path, 'make_translation.py', '-d', data_path], cwd=scripts_path)
+
+def _estoria_xml_incremental(data_path, scripts_path):
+    """
+    rebuild only the changed or new manuscripts and then merge the index files from the stored fragments
+    if the fragments can't be merged, the task is replaced by the full rebuild
+    :return: dict of the manuscripts that were rebuilt and removed
+    """
+    changed, removed, hashes = incremental.find_changes(data_path, scripts_path)
+    logger.debug('{}: changed manuscripts: {}'.format(current_task.request.id, ', '.join(changed) or 'none'))
+    logger.debug('{}: removed manuscripts: {}'.format(current_task.request.id, ', '.join(removed) or 'none'))
+
+    progress = TaskProgress(current_task.request.id)
+    manifest = incremental.load_manifest(data_path)
+    progress.step('rebuild changed manuscripts', total=len(changed))
+    for filename in changed:
+        logger.debug('{}: rebuild {}'.format(current_task.request.id, filename))
+        incremental.build_manuscript(filename, data_path, scripts_path)
+        # record each manuscript as it is done, so a failure later on doesn't lose the work
+        manifest[filename] = hashes[filename]
+        incremental.save_manifest(data_path, manifest)
+        progress.advance()
+
+    progress.step('remove deleted manuscripts', total=len(removed))
+    for filename in removed:
+        logger.debug('{}: remove {}'.format(current_task.request.id, filename))
+        incremental.remove_manuscript(filename, data_path)
+        del manifest[filename]
+        incremental.save_manifest(data_path, manifest)
+        progress.advance()
+
+    if changed or removed:
+        logger.debug('{}: merge index fragments'.format(current_task.request.id))
+        progress.step('merge index fragments')
+        try:
+            incremental.merge_fragments(data_path)
+        except incremental.MergeError as e:
+            # the pages are in place, but the index files can only be made by running the scripts over everything
+            logger.warning('{}: could not merge the index fragments, rebuilding everything: {}'.format(
+                current_task.request.id, e))
+            progress.finish()
+            return _run_pipeline(current_task, 'estoria_xml', data_path, scripts_path)
+    progress.finish()
 
     logger.info('{}: complete'.format(current_task.request.id))
+    return {'rebuilt': changed, 'removed': removed}
 
 
-@shared_task
-def cpsf_critical_xml(data_path, scripts_path):
+@shared_task(bind=True)
+def reader_xml(self, data_path, scripts_path):
     """
     update the Estoria site with the current reader XML file
     """
-    logger.info('{}: cpsf_critical_xml task started'.format(current_task.request.id))
-    logger.debug('{}: Data path: {}'.format(current_task.request.id, data_path))
-    logger.debug('{}: Scripts location: {}'.format(current_task.request.id, scripts_path))
+    logger.info('{}: reader_xml task started'.format(self.request.id))
+    logger.debug('{}: Data path: {}'.format(self.request.id, data_path))
+    logger.debug('{}: Scripts location: {}'.format(self.request.id, scripts_path))
 
-    logger.debug('{}: run make_cpsf_critical.py'.format(current_task.request.id))
-    subprocess.check_call([python_path, 'make_cpsf_critical.py', '-d', data_path], cwd=scripts_path)
+    return _run_pipeline(self, 'reader_xml', data_path, scripts_path)
 
-    logger.info('{}: complete'.format(current_task.request.id))
 
+@shared_task(bind=True)
+def translation_xml(self, data_path, scripts_path):
+    """
+    update the Estoria site with the current reader XML file
+    """
+    logger.info('{}: translation_xml task started'.format(self.request.id))
+    logger.debug('{}: Data path: {}'.format(self.request.id, data_path))
+    logger.debug('{}: Scripts location: {}'.format(self.request.id, scripts_path))
 
-@shared_task
-def critical_edition_first(data_path, scripts_path):
+    return _run_pipeline(self, 'translation_xml', data_path, scripts_path)
+
+
+@shared_task(bind=True)
+def cpsf_critical_xml(self, data_path, scripts_path):
+    """
+    update the Estoria site with the current reader XML file
+    """
+    logger.info('{}: cpsf_critical_xml task started'.format(self.request.id))
+    logger.debug('{}: Data path: {}'.format(self.request.id, data_path))
+    logger.debug('{}: Scripts location: {}'.format(self.request.id, scripts_path))
+
+    return _run_pipeline(self, 'cpsf_critical_xml', data_path, scripts_path)
+
+
+@shared_task(bind=True)
+def critical_edition_first(self, data_path, scripts_path):
     """
     the first part of updating the critical edition
     """
-    logger.info('{}: critical_edition_first task started'.format(current_task.request.id))
-    logger.debug('{}: Data path: {}'.format(current_task.request.id, data_path))
-    logger.debug('{}: Scripts location: {}'.format(current_task.request.id, scripts_path))
+    logger.info('{}: critical_edition_first task started'.format(self.request.id))
+    logger.debug('{}: Data path: {}'.format(self.request.id, data_path))
+    logger.debug('{}: Scripts location: {}'.format(self.request.id, scripts_path))
 
-    logger.debug('{}: run make_critical_chapter_verse_json.py'.format(current_task.request.id))
-    subprocess.check_call([python_path, 'make_critical_chapter_verse_json.py', '-d', data_path], cwd=scripts_path)
+    return _run_pipeline(self, 'critical_edition_first', data_path, scripts_path)
 
-    logger.debug('{}: run make_verse_page_index_json.py'.format(current_task.request.id))
-    subprocess.check_call([python_path, 'make_verse_page_index_json.py', '-d', data_path], cwd=scripts_path)
 
-    logger.info('{}: complete'.format(current_task.request.id))
+class BakingError(Exception):
+    """
+    one or more chapters could not be baked
+    """
+
+
+def chapter_shards(start, stop, shard_size):
+    """
+    split a range of chapters into shards
+    :param start: the first chapter
+    :param stop: the last chapter (inclusive)
+    :param shard_size: the maximum number of chapters in a shard
+    :return: list of (start, stop) tuples, with stop inclusive
+    """
+    shard_size = max(1, shard_size)
+    return [(i, min(i + shard_size - 1, stop)) for i in range(start, stop + 1, shard_size)]
+
+
+def bake_in_shards(start, stop, baking_url, data_path, approved_path=None, force=False, priority=None,
+                   project=None):
+    """
+    set off the baking of a range of chapters
+    a range that fits in one shard is a single bake_chapters task, otherwise the shards are baked as a group
+    in parallel and collect_bakes reports on the whole range once they have all finished
+    :param priority: the priority of the tasks in the baking queue, None for the queue's default
+    :param project: the project the chapters belong to, e.g. estoria-digital
+    :return: the AsyncResult to report back to the user
+    """
+    shards = chapter_shards(start, stop, getattr(settings, 'BAKING_SHARD_SIZE', 25))
+    if len(shards) == 1:
+        return bake_chapters.apply_async((start, stop, baking_url, data_path),
+                                         {'approved_path': approved_path, 'force': force, 'project': project},
+                                         priority=priority)
+    # the shards report their combined progress as the progress of collect_bakes, which the user is shown
+    callback_id = uuid()
+    header = [bake_chapters.s(shard_start, shard_stop, baking_url, data_path, raise_on_failure=False,
+                              approved_path=approved_path, force=force, project=project,
+                              progress_id=callback_id, progress_total=stop - start + 1).set(priority=priority)
+              for shard_start, shard_stop in shards]
+    return chord(header)(collect_bakes.s().set(task_id=callback_id, priority=priority))
 
 
 @shared_task
-def bake_chapters(start, stop, baking_url, data_path):
+def collect_bakes(results):
+    """
+    combine the results of the bake_chapters shards
+    :param results: list of the results of each bake_chapters shard
+    :return: dict of the baked and skipped chapters, and the failed chapters with the reason for each
+    """
+    baked = sorted(chapter for result in results for chapter in result['baked'])
+    skipped = sorted(chapter for result in results for chapter in result['skipped'])
+    failed = {}
+    for result in results:
+        failed.update(result['failed'])
+    logger.info('{}: {} chapters baked, {} unchanged, {} failed'.format(current_task.request.id, len(baked),
+                                                                       len(skipped), len(failed)))
+    if failed:
+        raise BakingError('Failed to bake chapters: {}'.format(', '.join(sorted(failed, key=int))))
+    return {'baked': baked, 'skipped': skipped, 'failed': failed}
+
+
+@shared_task
+def bake_chapters(start, stop, baking_url, data_path, raise_on_failure=True, approved_path=None, force=False,
+                  progress_id=None, progress_total=None, project=None):
     """
     Use Selenium to get the live javascript rendered webpage and then save it
-    requires a geckodriver to be somewhere in the PATH
+    requires a geckodriver to be somewhere in the PATH, the browser comes from the worker's browser pool
+    with BAKING_RENDERER = 'python' the chapters are rendered in python instead, from the approved collations
     :param start: start with this chapter
     :param stop: stop at this chapter (inclusive)
+    :param raise_on_failure: fail the task if any chapter could not be baked, rather than only reporting it
+    :param approved_path: the directory of approved collations, if given then chapters whose inputs are
+                          unchanged since they were last baked are skipped
+    :param force: bake every chapter, even if it is unchanged
+    :param progress_id: the id to also report the progress of a whole sharded range under
+    :param progress_total: the number of chapters in the whole sharded range
+    :param project: the project the chapters belong to, e.g. estoria-digital
+    :return: dict of the baked and skipped chapters, and the failed chapters with the reason for each
     """
     logger.info('{}: bake_chapters task started'.format(current_task.request.id))
     logger.debug('{}: Baking chapters: {} to {}'.format(current_task.request.id, start, stop))
@@ -112,20 +286,89 @@ def bake_chapters(start, stop, baking_url, data_path):
     except FileExistsError:
         pass
 
-    options = FirefoxOptions()
-    options.add_argument("--headless")
-    driver = webdriver.Firefox(options=options)
-
-    for i in range(start, stop+1):
-        logger.debug('{}: Bake chapter: {} at {}'.format(current_task.request.id, i, baking_url))
-        url = baking_url + '/chapter/{}'.format(i)
-        driver.get(url)
-        WebDriverWait(driver, 60).until(
-            EC.presence_of_element_located((By.ID, 'finished'))
-        )
-        container = driver.find_element_by_class_name('container').get_attribute('innerHTML')
-        with open(os.path.join(data_path, 'critical', str(i) + '.html'), 'w',
-                  encoding='utf-8') as f:
-            f.write(container)
+    chapters = list(range(start, stop+1))
+    progress = TaskProgress(current_task.request.id, group_id=progress_id, group_total=progress_total)
+    skipped = []
+    chapter_fingerprints = {}
+    collations = page_chapter_index = None
+    if approved_path:
+        progress.step('fingerprint chapters', total=len(chapters))
+        collations = fingerprints.load_json_index(data_path, 'collations')
+        page_chapter_index = fingerprints.load_json_index(data_path, 'page_chapter_index')
+        for i in chapters:
+            chapter_fingerprints[i] = fingerprints.chapter_fingerprint(i, collations, page_chapter_index,
+                                                                       approved_path)
+        if not force:
+            skipped = [i for i in chapters
+                       if chapter_fingerprints[i] == fingerprints.stored_fingerprint(data_path, i)
+                       and os.path.isfile(os.path.join(data_path, 'critical', str(i) + '.html'))]
+            chapters = [i for i in chapters if i not in skipped]
+            if skipped:
+                logger.debug('{}: Unchanged chapters: {}'.format(current_task.request.id,
+                                                                 ', '.join(str(i) for i in skipped)))
+            for i in skipped:
+                progress.advance(chapter=i)
+            if skipped:
+                metrics.increment('estoria_chapters_total', len(skipped), outcome='skipped')
+
+    baked = []
+    failed = {}
+    if not chapters:
+        progress.finish()
+        logger.info('{}: complete'.format(current_task.request.id))
+        return {'baked': baked, 'skipped': skipped, 'failed': failed}
+
+    progress.step('bake chapters', total=len(chapters))
+    with _chapter_renderer(baking_url, data_path, approved_path, project, collations,
+                           page_chapter_index) as render:
+        for i in chapters:
+            logger.debug('{}: Bake chapter: {} at {}'.format(current_task.request.id, i, baking_url))
+            chapter_started = time.monotonic()
+            try:
+                container = render(i)
+                with open(os.path.join(data_path, 'critical', str(i) + '.html'), 'w',
+                          encoding='utf-8') as f:
+                    f.write(container)
+            except Exception as e:
+                logger.error('{}: Failed to bake chapter {}: {!r}'.format(current_task.request.id, i, e))
+                failed[str(i)] = repr(e)
+                outcome = 'failed'
+            else:
+                baked.append(i)
+                outcome = 'baked'
+                if i in chapter_fingerprints:
+                    fingerprints.store_fingerprint(data_path, i, chapter_fingerprints[i])
+            metrics.observe('estoria_chapter_bake_duration_seconds', time.monotonic() - chapter_started,
+                            outcome=outcome)
+            metrics.increment('estoria_chapters_total', outcome=outcome)
+            progress.advance(chapter=i)
+    progress.finish()
+
+    if failed and raise_on_failure:
+        raise BakingError('Failed to bake chapters: {}'.format(', '.join(failed)))
 
     logger.info('{}: complete'.format(current_task.request.id))
+    return {'baked': baked, 'skipped': skipped, 'failed': failed}
+
+
+@contextmanager
+def _chapter_renderer(baking_url, data_path, approved_path, project, collations=None, page_chapter_index=None):
+    """
+    the renderer of the baked chapters chosen by BAKING_RENDERER
+    :return: a function of the chapter number that returns its baked html
+    """
+    if getattr(settings, 'BAKING_RENDERER', 'browser') == 'python':
+        chapter_renderer = renderer.ChapterRenderer(data_path, approved_path, project, collations,
+                                                    page_chapter_index)
+        yield chapter_renderer.render
+        return
+
+    with browsers.get_pool().browser() as browser:
+        def render(chapter):
+            browser.pages += 1
+            browser.driver.get(baking_url + '/chapter/{}'.format(chapter))
+            WebDriverWait(browser.driver, 60).until(
+                EC.presence_of_element_located((By.ID, 'finished'))
+            )
+            return browser.driver.find_element_by_class_name('container').get_attribute('innerHTML')
+        yield render
@@ -1,15 +1,28 @@
-from .tasks import reader_xml, estoria_xml, critical_edition_first, bake_chapters
+from .tasks import reader_xml, estoria_xml, critical_edition_first, bake_chapters, collect_bakes, chapter_shards
 from .apps import EstoriaAppConfig
+from .browsers import BrowserPool, close_pool
+from . import collations, benchmark, rebuilds, pipeline, renderer, incremental
+from djangoproject import status
+from djangoproject.tests import TEST_CACHES
+from celery.result import AsyncResult
 
 from django.apps import apps
 from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.core.files.base import ContentFile
 from django.conf import settings
+from django.core.management import call_command, CommandError
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from testfixtures import log_capture
 from unittest.mock import patch
 from selenium.webdriver import FirefoxOptions
 import selenium
+import tempfile
+import io
+import shutil
+import urllib.request
+import json
 import os
 
 
@@ -29,7 +42,23 @@ class TestEstoriaApp(TestCase):
         self.assertEqual(apps.get_app_config('estoria_app').name, 'estoria_app')
 
 
-class Test1EstoriaXml(TestCase):
+class TemporaryDataPathMixin(object):
+    """
+    points the data paths at a directory of each test's own, so the tasks never write to the configured ones
+    """
+    def setUp(self):
+        super().setUp()
+        self.data_path = tempfile.mkdtemp()
+        self.data_settings = override_settings(ESTORIA_DATA_PATH=self.data_path, CPSF_DATA_PATH=self.data_path)
+        self.data_settings.enable()
+
+    def tearDown(self):
+        self.data_settings.disable()
+        shutil.rmtree(self.data_path)
+        super().tearDown()
+
+
+class Test1EstoriaXml(TemporaryDataPathMixin, TestCase):
     """
     Test estoria_xml Celery task
     """
@@ -60,7 +89,283 @@ class Test1EstoriaXml(TestCase):
         )
 
 
-class Test2ReaderXml(TestCase):
+FAKE_PAGINATED_SCRIPT = """
+import glob, json, os, sys
+data = sys.argv[2]
+menu = {}
+for xml in sorted(glob.glob('../../../../transcriptions/manuscripts/*.xml')):
+    name = os.path.basename(xml).replace('.xml', '')
+    os.makedirs(os.path.join(data, 'transcription', name), exist_ok=True)
+    with open(os.path.join(data, 'transcription', name, '1r.json'), 'w') as fp:
+        fp.write(open(xml).read())
+    menu[name] = ['1r']
+with open(os.path.join(data, 'menu_data.js'), 'w') as fp:
+    fp.write('MENU_DATA = ' + json.dumps(menu))
+"""
+
+FAKE_CHAPTER_INDEX_SCRIPT = """
+import json, os, sys
+data = sys.argv[2]
+with open(os.path.join(data, 'chapter_index.json'), 'w') as fp:
+    json.dump({'1': sorted(os.listdir(os.path.join(data, 'transcription')))}, fp)
+"""
+
+
+# writes an index file that the incremental rebuild doesn't know how to merge
+FAKE_UNKNOWN_INDEX_SCRIPT = """
+import json, os, sys
+data = sys.argv[2]
+with open(os.path.join(data, 'search.json'), 'w') as fp:
+    json.dump(sorted(os.listdir(os.path.join(data, 'transcription'))), fp)
+"""
+
+
+@override_settings(SCRIPT_RUNNER='inprocess')
+class Test1EstoriaXmlIncremental(TestCase):
+    """
+    Test estoria_xml Celery task in incremental mode, with stand in versions of the scripts
+    """
+    def setUp(self):
+        self.project = tempfile.mkdtemp()
+        self.scripts_path = os.path.join(self.project, 'edition/src/assets/scripts')
+        self.manuscripts = os.path.join(self.project, 'transcriptions/manuscripts')
+        self.data_path = os.path.join(self.project, 'data')
+        os.makedirs(self.scripts_path)
+        os.makedirs(self.manuscripts)
+        os.makedirs(self.data_path)
+        for script, content in (('make_paginated_json.py', FAKE_PAGINATED_SCRIPT),
+                                ('add_html_to_paginated_json.py', ''),
+                                ('make_chapter_index_json.py', FAKE_CHAPTER_INDEX_SCRIPT)):
+            with open(os.path.join(self.scripts_path, script), 'w') as fp:
+                fp.write(content)
+        for name in ('A', 'B'):
+            self._write_manuscript(name, '<{}/>'.format(name))
+
+    def tearDown(self):
+        shutil.rmtree(self.project)
+
+    def _write_manuscript(self, name, content):
+        with open(os.path.join(self.manuscripts, name + '.xml'), 'w') as fp:
+            fp.write(content)
+
+    def _run(self):
+        task = estoria_xml.apply(args=[self.data_path, self.scripts_path], kwargs={'incremental': True})
+        self.assertEqual(task.state, 'SUCCESS')
+        return task.get()
+
+    def test_incremental_rebuild(self):
+        """
+        first run builds everything, then only the changed and removed manuscripts are processed
+        and the index files are merged from all the manuscripts
+        """
+        self.assertEqual(self._run(), {'rebuilt': ['A.xml', 'B.xml'], 'removed': []})
+        with open(os.path.join(self.data_path, 'chapter_index.json')) as fp:
+            self.assertEqual(json.load(fp), {'1': ['A', 'B']})
+
+        self.assertEqual(self._run(), {'rebuilt': [], 'removed': []})
+
+        self._write_manuscript('B', '<B>changed</B>')
+        self.assertEqual(self._run(), {'rebuilt': ['B.xml'], 'removed': []})
+        with open(os.path.join(self.data_path, 'transcription/B/1r.json')) as fp:
+            self.assertEqual(fp.read(), '<B>changed</B>')
+        with open(os.path.join(self.data_path, 'menu_data.js')) as fp:
+            self.assertEqual(json.loads(fp.read().replace('MENU_DATA = ', '')), {'A': ['1r'], 'B': ['1r']})
+
+        os.remove(os.path.join(self.manuscripts, 'A.xml'))
+        self.assertEqual(self._run(), {'rebuilt': [], 'removed': ['A.xml']})
+        self.assertFalse(os.path.exists(os.path.join(self.data_path, 'transcription/A')))
+        with open(os.path.join(self.data_path, 'chapter_index.json')) as fp:
+            self.assertEqual(json.load(fp), {'1': ['B']})
+
+    def test_incremental_same_as_full(self):
+        """
+        the index files merged by an incremental rebuild are the same, byte for byte, as those of a full rebuild
+        """
+        self._run()
+        full_data_path = os.path.join(self.project, 'full')
+        os.makedirs(full_data_path)
+        with override_settings(TRANSCRIPTION_WORKERS=1):
+            task = estoria_xml.apply(args=[full_data_path, self.scripts_path])
+        self.assertEqual(task.state, 'SUCCESS')
+        compared = 0
+        for name in incremental.INDEX_MERGES:
+            self.assertEqual(os.path.exists(os.path.join(self.data_path, name)),
+                             os.path.exists(os.path.join(full_data_path, name)), name)
+            if os.path.exists(os.path.join(full_data_path, name)):
+                with open(os.path.join(self.data_path, name), 'rb') as merged, \
+                        open(os.path.join(full_data_path, name), 'rb') as full:
+                    self.assertEqual(merged.read(), full.read(), name)
+                compared += 1
+        self.assertEqual(compared, 2)
+
+    def test_merge_error_rebuilds_everything(self):
+        """
+        an index file that can't be merged makes the incremental rebuild run the full rebuild instead
+        """
+        with open(os.path.join(self.scripts_path, 'add_html_to_paginated_json.py'), 'w') as fp:
+            fp.write(FAKE_UNKNOWN_INDEX_SCRIPT)
+        task = estoria_xml.apply(args=[self.data_path, self.scripts_path], kwargs={'incremental': True})
+        self.assertEqual(task.state, 'SUCCESS')
+        with open(os.path.join(self.data_path, 'chapter_index.json')) as fp:
+            self.assertEqual(json.load(fp), {'1': ['A', 'B']})
+        with open(os.path.join(self.data_path, 'search.json')) as fp:
+            self.assertEqual(json.load(fp), ['A', 'B'])
+
+    def test_merge_fragments(self):
+        """
+        each index file is merged in its own way, and one that can't be merged is an error
+        """
+        fragments = os.path.join(self.project, 'fragments')
+        for name, menu, chapters in (('A', {'A': ['1r']}, {'1': ['A']}),
+                                     ('B', {'B': ['1v']}, {'1': ['B'], '2': ['B']})):
+            os.makedirs(os.path.join(fragments, name))
+            with open(os.path.join(fragments, name, 'menu_data.js'), 'w') as fp:
+                fp.write('MENU_DATA = ' + json.dumps(menu))
+            with open(os.path.join(fragments, name, 'chapter_index.json'), 'w') as fp:
+                json.dump(chapters, fp)
+        incremental.merge_fragments(self.data_path, fragments)
+        with open(os.path.join(self.data_path, 'menu_data.js')) as fp:
+            self.assertEqual(fp.read(), 'MENU_DATA = {"A": ["1r"], "B": ["1v"]}')
+        with open(os.path.join(self.data_path, 'chapter_index.json')) as fp:
+            self.assertEqual(json.load(fp), {'1': ['A', 'B'], '2': ['B']})
+
+        with open(os.path.join(fragments, 'B', 'menu_data.js'), 'w') as fp:
+            fp.write('MENU_DATA = ' + json.dumps({'A': ['2r']}))
+        with self.assertRaises(incremental.MergeError):
+            incremental.merge_fragments(self.data_path, fragments)
+
+        os.remove(os.path.join(fragments, 'B', 'menu_data.js'))
+        with open(os.path.join(fragments, 'B', 'unknown.json'), 'w') as fp:
+            fp.write('{}')
+        with self.assertRaises(incremental.MergeError):
+            incremental.merge_fragments(self.data_path, fragments)
+
+    @override_settings(TRANSCRIPTION_WORKERS=2)
+    def test_parallel_rebuild(self):
+        """
+        a full rebuild builds the pages of each manuscript on its own, merges the menu data
+        and then makes the chapter index from all of them
+        """
+        self._write_manuscript('C', '<C/>')
+        task = estoria_xml.apply(args=[self.data_path, self.scripts_path])
+        self.assertEqual(task.state, 'SUCCESS')
+        for name in ('A', 'B', 'C'):
+            with open(os.path.join(self.data_path, 'transcription', name, '1r.json')) as fp:
+                self.assertEqual(fp.read(), '<{}/>'.format(name))
+        with open(os.path.join(self.data_path, 'menu_data.js')) as fp:
+            self.assertEqual(json.loads(fp.read().replace('MENU_DATA = ', '')),
+                             {'A': ['1r'], 'B': ['1r'], 'C': ['1r']})
+        with open(os.path.join(self.data_path, 'chapter_index.json')) as fp:
+            self.assertEqual(json.load(fp), {'1': ['A', 'B', 'C']})
+        # the parallel build doesn't touch the fragments of the incremental rebuild
+        self.assertFalse(os.path.exists(os.path.join(self.data_path, 'incremental')))
+
+
+RECORDING_SCRIPT = """
+import os, sys
+data = sys.argv[2]
+with open(os.path.join(data, 'runs.log'), 'a') as fp:
+    fp.write('{}\\n'.format(os.path.basename(__file__)))
+fail = os.path.join(data, 'fail-' + os.path.basename(__file__))
+if os.path.exists(fail):
+    if os.path.exists(os.path.join(data, 'once')):
+        os.remove(fail)
+    raise RuntimeError('locked')
+"""
+
+
+@override_settings(SCRIPT_RUNNER='inprocess', PIPELINE_STEP_RETRY_DELAY=0, TRANSCRIPTION_WORKERS=1)
+class Test1EstoriaXmlResume(TestCase):
+    """
+    Test that estoria_xml resumes from the first step that hasn't completed
+    """
+    def setUp(self):
+        self.project = tempfile.mkdtemp()
+        self.scripts_path = os.path.join(self.project, 'edition/src/assets/scripts')
+        self.data_path = os.path.join(self.project, 'data')
+        os.makedirs(self.scripts_path)
+        os.makedirs(os.path.join(self.project, 'transcriptions/manuscripts'))
+        os.makedirs(self.data_path)
+        for script in pipeline.PIPELINES['estoria_xml']['scripts']:
+            with open(os.path.join(self.scripts_path, script), 'w') as fp:
+                fp.write(RECORDING_SCRIPT)
+
+    def tearDown(self):
+        shutil.rmtree(self.project)
+
+    def _runs(self):
+        with open(os.path.join(self.data_path, 'runs.log')) as fp:
+            runs = fp.read().split()
+        os.remove(os.path.join(self.data_path, 'runs.log'))
+        return runs
+
+    def _fail(self, script, once=False):
+        open(os.path.join(self.data_path, 'fail-' + script), 'w').close()
+        if once:
+            open(os.path.join(self.data_path, 'once'), 'w').close()
+
+    @override_settings(PIPELINE_STEP_RETRIES=0)
+    def test_resume(self):
+        self._fail('make_chapter_index_json.py')
+        task = estoria_xml.apply(args=[self.data_path, self.scripts_path])
+        self.assertEqual(task.state, 'FAILURE')
+        self.assertEqual(self._runs(), ['make_paginated_json.py', 'add_html_to_paginated_json.py',
+                                        'make_chapter_index_json.py'])
+        self.assertEqual([step['name'] for step in pipeline.load_checkpoint(self.data_path, 'estoria_xml')['done']],
+                         ['make_paginated_json.py', 'add_html_to_paginated_json.py'])
+
+        # the resubmission only runs the step that failed
+        os.remove(os.path.join(self.data_path, 'fail-make_chapter_index_json.py'))
+        task = estoria_xml.apply(args=[self.data_path, self.scripts_path])
+        self.assertEqual(task.state, 'SUCCESS')
+        self.assertEqual(self._runs(), ['make_chapter_index_json.py'])
+        self.assertIsNone(pipeline.load_checkpoint(self.data_path, 'estoria_xml'))
+
+        # once complete, the next rebuild runs every step
+        estoria_xml.apply(args=[self.data_path, self.scripts_path])
+        self.assertEqual(len(self._runs()), 3)
+
+    @override_settings(PIPELINE_STEP_RETRIES=0)
+    def test_changed_inputs_start_again(self):
+        self._fail('add_html_to_paginated_json.py')
+        estoria_xml.apply(args=[self.data_path, self.scripts_path])
+        self._runs()
+        os.remove(os.path.join(self.data_path, 'fail-add_html_to_paginated_json.py'))
+        with open(os.path.join(self.project, 'transcriptions/manuscripts/A.xml'), 'w') as fp:
+            fp.write('<A/>')
+        task = estoria_xml.apply(args=[self.data_path, self.scripts_path])
+        self.assertEqual(task.state, 'SUCCESS')
+        self.assertEqual(len(self._runs()), 3)
+
+    @override_settings(PIPELINE_STEP_RETRIES=0, CACHES=TEST_CACHES)
+    def test_failed_rebuild_is_released(self):
+        """
+        a step that fails for good fails the pipeline's own id and queues the follow-up of the rebuild
+        """
+        cache.clear()
+        with patch.object(estoria_xml, 'delay') as mocked_delay:
+            mocked_delay.return_value.id = 'first'
+            rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, self.data_path, self.scripts_path)
+        status.set_status('first', 'STARTED')
+        followup = rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, self.data_path, self.scripts_path)
+
+        self._fail('make_chapter_index_json.py')
+        with patch.object(estoria_xml, 'apply_async') as mocked_apply:
+            estoria_xml.apply(args=[self.data_path, self.scripts_path], task_id='first')
+        self.assertEqual(status.get_status('first')['state'], 'FAILURE')
+        self.assertEqual(AsyncResult('first').state, 'FAILURE')
+        self.assertEqual(mocked_apply.call_args[1]['task_id'], followup)
+
+    @override_settings(PIPELINE_STEP_RETRIES=1)
+    def test_retry_step(self):
+        self._fail('make_chapter_index_json.py', once=True)
+        task = estoria_xml.apply(args=[self.data_path, self.scripts_path])
+        self.assertEqual(task.state, 'SUCCESS')
+        self.assertEqual(self._runs(), ['make_paginated_json.py', 'add_html_to_paginated_json.py',
+                                        'make_chapter_index_json.py', 'make_chapter_index_json.py'])
+
+
+class Test2ReaderXml(TemporaryDataPathMixin, TestCase):
     """
     Test reader_xml Celery task
     """
@@ -89,7 +394,7 @@ class Test2ReaderXml(TestCase):
         )
 
 
-class Test3CriticalEditionFirst(TestCase):
+class Test3CriticalEditionFirst(TemporaryDataPathMixin, TestCase):
     """
     Test test_critical_edition_first_run_task Celery task
     """
@@ -119,10 +424,18 @@ class Test3CriticalEditionFirst(TestCase):
         )
 
 
-class Test4BakeChapters(TestCase):
+class Test4BakeChapters(TemporaryDataPathMixin, TestCase):
     """
     Test bake_chapters Celery task
     """
+    def setUp(self):
+        super().setUp()
+        close_pool()
+
+    def tearDown(self):
+        close_pool()
+        super().tearDown()
+
     @patch.object(selenium.webdriver.FirefoxOptions, 'add_argument')
     @patch('selenium.webdriver.Firefox')
     @patch('builtins.open')
@@ -145,7 +458,508 @@ class Test4BakeChapters(TestCase):
             ('estoria_app.tasks', 'DEBUG', '{}: Bake chapter: 101 at {}'.format(self.task.id, baking_url)),
             ('estoria_app.tasks', 'INFO', '{}: complete'.format(self.task.id)),
         )
+        self.assertEqual(self.results, {'baked': [101], 'skipped': [], 'failed': {}})
+
+    @patch('selenium.webdriver.Firefox')
+    @patch('builtins.open')
+    def test_bake_chapters_with_failure(self, mocked_open, mocked_firefox):
+        """
+        Test bake_chapters Celery task when a chapter can't be loaded
+        should carry on with the rest of the range and report the chapter that failed
+        """
+        mocked_firefox.return_value.get.side_effect = lambda url: url.endswith('/2') and 1 / 0
+        data_path = settings.ESTORIA_DATA_PATH
+        self.task = bake_chapters.apply(args=(1, 3, 'http://localhost', data_path),
+                                        kwargs={'raise_on_failure': False})
+        self.assertEqual(self.task.state, 'SUCCESS')
+        self.assertEqual(self.task.get()['baked'], [1, 3])
+        self.assertEqual(list(self.task.get()['failed']), ['2'])
+
+        self.task = bake_chapters.apply(args=(1, 3, 'http://localhost', data_path))
+        self.assertEqual(self.task.state, 'FAILURE')
+
+
+class TestBakeUnchangedChapters(TestCase):
+    """
+    Test bake_chapters skips the chapters whose inputs haven't changed
+    """
+    def setUp(self):
+        close_pool()
+        self.data_path = tempfile.mkdtemp()
+        self.approved_path = os.path.join(self.data_path, 'approved')
+        os.makedirs(self.approved_path)
+        with open(os.path.join(self.data_path, 'collations.json'), 'w') as fp:
+            json.dump({'1': ['Rubric', '1'], '2': ['1']}, fp)
+        with open(os.path.join(self.data_path, 'page_chapter_index.js'), 'w') as fp:
+            fp.write('PAGE_CHAPTER_INDEX = ' + json.dumps({'E1': {'D1S100': '1r', 'D1S1': '1r', 'D2S1': '1v'}}))
+        for context in ('D1SRubric', 'D1S1', 'D2S1'):
+            self._write_collation(context, '{}')
+
+    def tearDown(self):
+        close_pool()
+        shutil.rmtree(self.data_path)
+
+    def _write_collation(self, context, content):
+        with open(os.path.join(self.approved_path, context + '.json'), 'w') as fp:
+            fp.write(content)
+
+    def _bake(self, force=False):
+        task = bake_chapters.apply(args=(1, 2, 'http://localhost', self.data_path),
+                                   kwargs={'approved_path': self.approved_path, 'force': force})
+        self.assertEqual(task.state, 'SUCCESS')
+        return task.get()
+
+    @patch('selenium.webdriver.Firefox')
+    def test_bake_unchanged_chapters(self, mocked_firefox):
+        """
+        unchanged chapters are skipped, changed chapters are baked, and force bakes everything
+        """
+        mocked_firefox.return_value.find_element_by_class_name.return_value.get_attribute.return_value = '<p/>'
+        self.assertEqual(self._bake(), {'baked': [1, 2], 'skipped': [], 'failed': {}})
+        self.assertEqual(self._bake(), {'baked': [], 'skipped': [1, 2], 'failed': {}})
+
+        self._write_collation('D2S1', '{"changed": true}')
+        self.assertEqual(self._bake(), {'baked': [2], 'skipped': [1], 'failed': {}})
+
+        with open(os.path.join(self.data_path, 'page_chapter_index.js'), 'w') as fp:
+            fp.write('PAGE_CHAPTER_INDEX = ' + json.dumps({'E1': {'D1S100': '2r', 'D1S1': '1r', 'D2S1': '1v'}}))
+        self.assertEqual(self._bake(), {'baked': [1], 'skipped': [2], 'failed': {}})
+
+        self.assertEqual(self._bake(force=True), {'baked': [1, 2], 'skipped': [], 'failed': {}})
+
+
+class TestChapterRenderer(TestCase):
+    """
+    Test rendering the baked chapters without a browser
+    """
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp()
+        self.approved_path = os.path.join(self.data_path, 'approved')
+        os.makedirs(self.approved_path)
+        with open(os.path.join(self.data_path, 'collations.json'), 'w') as fp:
+            json.dump({'1': ['Rubric', '100']}, fp)
+        with open(os.path.join(self.data_path, 'page_chapter_index.js'), 'w') as fp:
+            fp.write('PAGE_CHAPTER_INDEX = ' + json.dumps({'E1': {'D1S100': '1r'}, 'E2': {'D1S100': '2v'},
+                                                           'T': {}}))
+        self._write_collation('D1SRubric', [[('capitulo', ['E1', 'E2']), ('', ['T'])]])
+        self._write_collation('D1S100', [[('el rey', ['E1', 'E2']), ('el & rey', ['E2-mod'])],
+                                         [('', ['E1', 'E2']), ('dixo', ['E1'])]])
+
+    def tearDown(self):
+        shutil.rmtree(self.data_path)
+
+    def _write_collation(self, context, apparatus):
+        units = [{'readings': [{'text': [{'interface': token} for token in text.split()], 'witnesses': witnesses}
+                               for text, witnesses in unit]}
+                 for unit in apparatus]
+        with open(os.path.join(self.approved_path, context + '.json'), 'w') as fp:
+            json.dump({'context': context, 'structure': {'apparatus': units}}, fp)
+
+    def test_render(self):
+        """
+        the chapter is rendered as simpleeditor.js renders it in chapter_check.html
+        """
+        html = renderer.ChapterRenderer(self.data_path, self.approved_path, 'estoria-digital').render(1)
+        self.assertEqual(html, (
+            '\n      <div id="apparatus">\n      '
+            '<span class="chapter">1 </span>\n'
+            '   <span id="verse-Rubric">\n'
+            '     <span id="D1SRubric_0" class="overtext">capitulo</span>\n'
+            '     <br>\n'
+            '   </span>\n'
+            '    <sub>1</sub> \n'
+            '   <span id="verse-100">\n'
+            '     <span id="D1S100_0" class="overtext">⸂el rey<span class="critical_marker">⸃</span></span>\n'
+            '     <span id="D1S100_1" class="overtext"><span class="critical_marker">⸆</span></span>\n'
+            '     \n'
+            '   </span>\n'
+            '    </div>\n      <br>\n      <label for="variants">Footnotes:</label>\n'
+            '      <div id="variants">\n      '
+            '\n   '
+            ' <span class="variant_number"><strong>1.</strong></span> \n'
+            '     <span id="D1S100_0" class="variant" data-base-witness="E1 E2"><span class="base_counter" '
+            'data-base-last-wit="E2" data-base-page-name="2v"></span> '
+            '<span class="witname" data-page-name="2v">E2-mod</span>: '
+            '<span class="variant-wit-text">el &amp; rey</span></span>\n'
+            '     <span id="D1S100_1" class="variant" data-base-witness="E1 E2"><span class="base_counter" '
+            'data-base-last-wit="E2" data-base-page-name="2v">|</span> '
+            '<span class="witname" data-page-name="1r">E1</span>: <span class="variant-wit-text">dixo</span></span>\n'
+            '    </div>\n      <br>\n    '))
+
+    def test_render_errors(self):
+        """
+        a chapter that would never finish in the browser can't be rendered
+        """
+        chapter_renderer = renderer.ChapterRenderer(self.data_path, self.approved_path, 'estoria-digital')
+        with self.assertRaises(renderer.RenderError):
+            chapter_renderer.render(2)
+        self._write_collation('D1S100', [[('el rey', ['E1']), ('rey', ['Y'])]])
+        with self.assertRaises(renderer.RenderError):
+            chapter_renderer.render(1)
+
+    def test_compare(self):
+        """
+        only differences that change the page are reported, unless the comparison is exact
+        """
+        self.assertEqual(renderer.compare('<p>el  &amp; rey<br /></p>\n', '<p>el &amp; rey<br></p>'), [])
+        self.assertTrue(renderer.compare('<p>el  &amp; rey<br /></p>\n', '<p>el &amp; rey<br></p>', exact=True))
+        self.assertIn('+<span class="overtext">rey', renderer.compare('<span class="overtext">el</span>',
+                                                                     '<span class="overtext">rey</span>'))
+
+    @override_settings(BAKING_RENDERER='python')
+    @patch('selenium.webdriver.Firefox')
+    def test_bake_chapters_python_renderer(self, mocked_firefox):
+        """
+        the chapters are baked without a browser, and compare_baked_chapters reports any that differ
+        """
+        task = bake_chapters.apply(args=(1, 1, 'http://localhost', self.data_path),
+                                   kwargs={'approved_path': self.approved_path, 'project': 'estoria-digital'})
+        self.assertEqual(task.get(), {'baked': [1], 'skipped': [], 'failed': {}})
+        self.assertFalse(mocked_firefox.called)
+        with open(os.path.join(self.data_path, 'critical', '1.html'), encoding='utf-8') as fp:
+            self.assertIn('<span class="variant-wit-text">dixo</span>', fp.read())
+
+        out = io.StringIO()
+        call_command('compare_baked_chapters', data_path=self.data_path, approved_path=self.approved_path,
+                     stdout=out)
+        self.assertIn('1 of 1 baked chapters are the same', out.getvalue())
+
+        self._write_collation('D1S100', [[('el rey', ['E1', 'E2']), ('el buen rey', ['E2-mod'])]])
+        out = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command('compare_baked_chapters', data_path=self.data_path, approved_path=self.approved_path,
+                         stdout=out)
+        self.assertIn('chapter 1 differs', out.getvalue())
+        self.assertIn('+<span class="variant-wit-text">el buen rey', out.getvalue())
+
+
+class TestBrowserPool(TestCase):
+    """
+    Test the pool of browsers used for baking
+    """
+    @patch('selenium.webdriver.Firefox')
+    def test_browser_reused(self, mocked_firefox):
+        """
+        a browser checked back in is used again, and quit when the pool is closed
+        """
+        pool = BrowserPool(size=1)
+        with pool.browser() as browser:
+            first = browser.driver
+        with pool.browser() as browser:
+            self.assertIs(browser.driver, first)
+        self.assertEqual(mocked_firefox.call_count, 1)
+        pool.close()
+        self.assertTrue(first.quit.called)
+
+    @patch('selenium.webdriver.Firefox')
+    def test_browser_recycled_after_max_pages(self, mocked_firefox):
+        """
+        a browser is quit and replaced once it has loaded max_pages pages
+        """
+        pool = BrowserPool(size=1, max_pages=2)
+        with pool.browser() as browser:
+            browser.pages += 2
+            first = browser.driver
+        self.assertTrue(first.quit.called)
+        with pool.browser() as browser:
+            self.assertEqual(mocked_firefox.call_count, 2)
+        pool.close()
+
+    @patch('selenium.webdriver.Firefox')
+    def test_unhealthy_browser_replaced(self, mocked_firefox):
+        """
+        a browser that doesn't respond is replaced when it is checked out
+        """
+        pool = BrowserPool(size=1)
+        with pool.browser() as browser:
+            browser.driver.execute_script.side_effect = Exception('gone')
+        with pool.browser() as browser:
+            pass
+        self.assertEqual(mocked_firefox.call_count, 2)
+        pool.close()
+
+    @patch('selenium.webdriver.Firefox')
+    def test_crashed_browser_not_returned(self, mocked_firefox):
+        """
+        a browser that crashed while it was checked out is quit rather than returned to the pool
+        """
+        pool = BrowserPool(size=1)
+        with pool.browser() as browser:
+            first = browser.driver
+            first.execute_script.side_effect = Exception('crashed')
+        self.assertTrue(first.quit.called)
+        self.assertEqual(pool.memory(), [])
+        pool.close()
+
+    @patch('estoria_app.browsers.PooledBrowser.memory')
+    @patch('selenium.webdriver.Firefox')
+    def test_browser_over_memory_replaced_at_checkout(self, mocked_firefox, mocked_memory):
+        """
+        a browser that has grown past the memory limit while idle is replaced before it is handed out
+        """
+        pool = BrowserPool(size=1, max_memory=100)
+        mocked_memory.return_value = 10
+        with pool.browser():
+            pass
+        mocked_memory.return_value = 1000
+        with pool.browser():
+            pass
+        self.assertEqual(mocked_firefox.call_count, 2)
+        pool.close()
+
+    @patch('selenium.webdriver.Firefox')
+    def test_pool_size_limit(self, mocked_firefox):
+        """
+        no more than size browsers can be checked out at once
+        """
+        pool = BrowserPool(size=1)
+        browser = pool.checkout()
+        with self.assertRaises(TimeoutError):
+            pool.checkout(timeout=0.01)
+        pool.checkin(browser)
+        pool.close()
+        with self.assertRaises(RuntimeError):
+            pool.checkout()
+
+
+class TestCollationsIndex(TestCase):
+    """
+    Test the cached collations index
+    """
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp()
+        self.write_collations({'1': ['Rubric', '1', '2'], '2': ['1'], '10': ['1', '2']})
+
+    def tearDown(self):
+        collations.clear()
+        shutil.rmtree(self.data_path)
+
+    def write_collations(self, data):
+        with open(os.path.join(self.data_path, 'collations.json'), 'w') as fp:
+            json.dump(data, fp)
+
+    def test_derived_structures(self):
+        index = collations.get_index(self.data_path)
+        self.assertEqual(list(index.data), ['1', '2', '10'])
+        self.assertEqual(index.maximum_chapter, 10)
+        self.assertEqual(index.chapter_verses[1], ['Rubric', '1', '2'])
+        self.assertEqual(index.total_verses, 6)
+
+    def test_parsed_once(self):
+        """
+        the index is only parsed again when the file changes
+        """
+        index = collations.get_index(self.data_path)
+        self.assertIs(collations.get_index(self.data_path), index)
+
+        self.write_collations({'1': ['1'], '2': ['1'], '3': ['1']})
+        stat = os.stat(collations.collations_file(self.data_path))
+        os.utime(collations.collations_file(self.data_path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        index = collations.get_index(self.data_path)
+        self.assertEqual(index.maximum_chapter, 3)
+        self.assertEqual(index.total_verses, 3)
+
+
+class FakeFirefox(object):
+    """
+    loads pages without running their javascript, enough for bake_chapters to save them
+    """
+    def __init__(self, **kwargs):
+        self.page = ''
+
+    def get(self, url):
+        with urllib.request.urlopen(url) as response:
+            self.page = response.read().decode()
+
+    def find_element(self, by, value):
+        if value not in self.page:
+            raise selenium.common.exceptions.NoSuchElementException(value)
+        return self
+
+    def find_element_by_class_name(self, name):
+        return self.find_element('class name', name)
+
+    def get_attribute(self, name):
+        return self.page
+
+    def execute_script(self, script):
+        return 1
+
+    def quit(self):
+        pass
+
+
+class TestCeleryWorkers(TestCase):
+    """
+    Test the routing of the tasks to the queues of each workload
+    """
+    def test_routes(self):
+        from celery import current_app
+        for name in settings.CELERY_TASK_ROUTES:
+            self.assertIn(name, current_app.tasks)
+        self.assertEqual(current_app.amqp.router.route({}, 'estoria_app.tasks.bake_chapters')['queue'].name, 'baking')
+
+    def test_acks_late(self):
+        # a rebuild or a bake can run for longer than RabbitMQ's consumer_timeout, so only the conversions are late
+        from celery import current_app
+        self.assertTrue(current_app.tasks['xmlconversion_app.tasks.xmlconversion'].acks_late)
+        self.assertFalse(current_app.tasks['estoria_app.tasks.bake_chapters'].acks_late)
+        self.assertFalse(current_app.tasks['estoria_app.tasks.estoria_xml'].acks_late)
+
+    @override_settings(WORKER_CONCURRENCY={'baking': 2, 'rebuilds,celery': 1})
+    def test_command(self):
+        out = io.StringIO()
+        call_command('celery_workers', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'celery -A djangoproject multi start baking rebuilds '
+                                                 '-Q:baking baking -c:baking 2 -Q:rebuilds rebuilds,celery -c:rebuilds 1')
+
+
+class TestBakingBenchmark(TestCase):
+    """
+    Test the offline baking benchmark
+    """
+    def tearDown(self):
+        close_pool()
+
+    def test_standin_server(self):
+        data_path = tempfile.mkdtemp()
+        approved_path = benchmark.make_fixture(data_path, 2, 3)
+        with benchmark.StandinChapterServer(data_path, approved_path, render_delay=10) as server:
+            with urllib.request.urlopen(server.url + '/chapter/2') as response:
+                page = response.read().decode()
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(server.url + '/chapter/3')
+        shutil.rmtree(data_path)
+        self.assertIn('"context": "D2SRubric"', page)
+        self.assertIn("finished.id = 'finished';", page)
+
+    def test_fixture_renders(self):
+        # the readings are lists of tokens, as in the real approved collations
+        data_path = tempfile.mkdtemp()
+        approved_path = benchmark.make_fixture(data_path, 1, 1, units=1)
+        html = renderer.ChapterRenderer(data_path, approved_path, 'estoria-digital').render(1)
+        shutil.rmtree(data_path)
+        self.assertIn('reading0 word', html)
+        self.assertIn('variant0', html)
+
+    @override_settings(BAKING_RENDERER='python')
+    @patch('selenium.webdriver.Firefox', FakeFirefox)
+    def test_run_benchmark(self):
+        """
+        every chapter is baked in the browser and timed, with the shards sharing the pool
+        """
+        results = benchmark.run_benchmark([(1, 2, 2)], chapters=4, verses=2)
+        run = results['runs'][0]
+        self.assertEqual((run['shards'], run['baked'], run['failed'], run['browsers']), (2, 4, {}, 1))
+        self.assertGreater(run['chapters_per_minute'], 0)
+        self.assertLessEqual(run['latency_seconds']['p50'], run['latency_seconds']['max'])
+
+    def test_percentile(self):
+        self.assertEqual(benchmark.percentile([5, 1, 4, 2, 3], 0.5), 3)
+        self.assertEqual(benchmark.percentile(list(range(1, 101)), 0.99), 99)
+        self.assertIsNone(benchmark.percentile([], 0.5))
+
+
+class Test4BakeShards(TestCase):
+    """
+    Test splitting baking into shards
+    """
+    def test_chapter_shards(self):
+        self.assertEqual(chapter_shards(1, 10, 4), [(1, 4), (5, 8), (9, 10)])
+        self.assertEqual(chapter_shards(5, 5, 25), [(5, 5)])
+        self.assertEqual(chapter_shards(1, 3, 0), [(1, 1), (2, 2), (3, 3)])
+
+    def test_collect_bakes(self):
+        """
+        the results of all the shards are combined and any failure fails the task
+        """
+        task = collect_bakes.apply(args=([{'baked': [3, 4], 'skipped': [5], 'failed': {}},
+                                          {'baked': [1, 2], 'skipped': [], 'failed': {}}],))
+        self.assertEqual(task.state, 'SUCCESS')
+        self.assertEqual(task.get(), {'baked': [1, 2, 3, 4], 'skipped': [5], 'failed': {}})
+
+        task = collect_bakes.apply(args=([{'baked': [1], 'skipped': [], 'failed': {'2': 'timeout'}},
+                                          {'baked': [3], 'skipped': [], 'failed': {}}],))
+        self.assertEqual(task.state, 'FAILURE')
+        self.assertIn('Failed to bake chapters: 2', str(task.result))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TestCoalesceRebuilds(TestCase):
+    """
+    Test that duplicate rebuild requests share a task
+    """
+    def setUp(self):
+        cache.clear()
+
+    @patch('estoria_app.tasks.estoria_xml.delay')
+    def test_queued_rebuild_is_joined(self, mocked_task):
+        mocked_task.return_value.id = 'first'
+        self.assertEqual(rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, 'data', 'scripts'), 'first')
+        self.assertEqual(rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, 'data', 'scripts'), 'first')
+        self.assertEqual(mocked_task.call_count, 1)
+        # other projects and pipelines are not coalesced
+        rebuilds.start_rebuild('cpsf-digital', 'xml', estoria_xml, 'data', 'scripts')
+        rebuilds.start_rebuild('estoria-digital', 'reader_xml', estoria_xml, 'data', 'scripts')
+        self.assertEqual(mocked_task.call_count, 3)
+
+    @patch('estoria_app.tasks.estoria_xml.delay')
+    def test_full_and_incremental_rebuilds_are_coalesced(self, mocked_task):
+        mocked_task.return_value.id = 'first'
+        rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, 'data', 'scripts')
+        # a queued full rebuild does the work of an incremental one
+        self.assertEqual(rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, 'data', 'scripts',
+                                                incremental=True), 'first')
+        self.assertEqual(mocked_task.call_count, 1)
+
+        cache.clear()
+        rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, 'data', 'scripts', incremental=True)
+        # but not the other way round, so the full one waits for the queued incremental one to finish
+        followup = rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, 'data', 'scripts')
+        self.assertNotEqual(followup, 'first')
+        self.assertEqual(mocked_task.call_count, 2)
+
+    @patch('estoria_app.tasks.estoria_xml.apply_async')
+    @patch('estoria_app.tasks.estoria_xml.delay')
+    def test_follow_up_of_running_rebuild(self, mocked_task, mocked_apply):
+        mocked_task.return_value.id = 'first'
+        rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, 'data', 'scripts', incremental=True)
+        status.set_status('first', 'STARTED')
+        followup = rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, 'data', 'scripts', incremental=True)
+        self.assertNotEqual(followup, 'first')
+        # every request during the run shares the one follow-up
+        self.assertEqual(rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, 'data', 'scripts'), followup)
+        self.assertEqual(mocked_task.call_count, 1)
+        mocked_apply.assert_not_called()
+
+        # the full rebuild asked for during the run makes the follow-up a full one
+        with override_settings(REBUILD_DEBOUNCE=10):
+            rebuilds._task_postrun(task_id='first')
+        mocked_apply.assert_called_once_with(['data', 'scripts'], {}, task_id=followup, countdown=10)
+        # requests in the debounce window join the queued follow-up
+        self.assertEqual(rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, 'data', 'scripts'), followup)
 
+        rebuilds._task_postrun(task_id=followup)
+        self.assertEqual(mocked_apply.call_count, 1)
+        mocked_task.return_value.id = 'second'
+        self.assertEqual(rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, 'data', 'scripts'), 'second')
+
+    @patch('estoria_app.tasks.estoria_xml.delay')
+    def test_finished_rebuild_is_not_joined(self, mocked_task):
+        mocked_task.return_value.id = 'first'
+        rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, 'data', 'scripts')
+        # e.g. the worker didn't report the end of the task
+        status.set_status('first', 'FAILURE')
+        mocked_task.return_value.id = 'second'
+        self.assertEqual(rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, 'data', 'scripts'), 'second')
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    @patch('estoria_app.tasks.estoria_xml.delay')
+    def test_unshared_cache_is_refused(self, mocked_task):
+        # the worker would never see the rebuild, so its follow-up would never be queued
+        with self.assertRaises(ImproperlyConfigured):
+            rebuilds.start_rebuild('estoria-digital', 'xml', estoria_xml, 'data', 'scripts')
+        self.assertFalse(mocked_task.called)
 
 
 class TestIndexView(TestCase):
@@ -180,10 +994,15 @@ class TestIndexView(TestCase):
     # TODO add tests for selection of project if none selected
 
 
+@override_settings(CACHES=TEST_CACHES)
 class TestTranscriptionsView(TestCase):
     """
     Test Transcriptions Views
     """
+    def setUp(self):
+        # rebuilds are coalesced through the cache
+        cache.clear()
+
     def test_transcriptions_empty_get(self):
         """
         Empty GET request of the transcriptions page
@@ -255,6 +1074,21 @@ class TestTranscriptionsView(TestCase):
         self.assertTrue(response['Location'].startswith('?job='))
         self.assertTrue(mocked_task.called)
 
+    @patch('estoria_app.tasks.estoria_xml.delay')
+    def test_transcriptions_rebuild_changed_post(self, mocked_task):
+        """
+        'rebuildchanged' POST request of the transcriptions page
+        should set off the incremental task and push the user to the job status page
+        """
+        session = self.client.session
+        session['project'] = 'estoria-digital'
+        session.save()
+        url = reverse('transcriptions')
+        response = self.client.post(url, {'rebuildchanged': 'Rebuild changed files'})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].startswith('?job='))
+        self.assertEqual(mocked_task.call_args[1], {'incremental': True})
+
     def test_transcriptions_upload_empty_post(self):
         """
         'upload' POST request of the transcriptions page, without a file
@@ -300,10 +1134,15 @@ class TestTranscriptionsView(TestCase):
         self.assertEqual(response.context['message'], 'The uploaded file is not valid XML')
 
 
+@override_settings(CACHES=TEST_CACHES)
 class TestReaderxmlView(TestCase):
     """
     Test Reader XML Views
     """
+    def setUp(self):
+        # rebuilds are coalesced through the cache
+        cache.clear()
+
     def test_readerxml_empty_get(self):
         """
         Empty GET request of the readerxml page
@@ -480,7 +1319,8 @@ class TestBakingView(TestCase):
         self.assertContains(response, '<h1>Baking Chapters</h1>')
         self.assertContains(response, '<p id="user-count">Checking the server for the task.</p>')
 
-    @patch('estoria_app.tasks.bake_chapters.delay')
+    @override_settings(BAKING_ONE_PRIORITY=9, BAKING_RANGE_PRIORITY=1)
+    @patch('estoria_app.tasks.bake_chapters.apply_async')
     def test_baking_sensible_range_post(self, mocked_task):
         """
         'range' POST request of the baking page, with sensible input
@@ -494,6 +1334,25 @@ class TestBakingView(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertTrue(response['Location'].startswith('?job='))
         self.assertTrue(mocked_task.called)
+        self.assertEqual(mocked_task.call_args[1], {'priority': 1})
+
+    @override_settings(BAKING_SHARD_SIZE=1, BAKING_RANGE_PRIORITY=1)
+    @patch('estoria_app.tasks.chord')
+    def test_baking_sharded_range_post(self, mocked_chord):
+        """
+        'range' POST request of the baking page, with a range larger than a shard
+        should set off a group of bake_chapters tasks and push the user to the job status page
+        """
+        session = self.client.session
+        session['project'] = 'estoria-digital'
+        session.save()
+        url = reverse('apparatus')
+        response = self.client.post(url, {'range': 'Bake', 'start_chapter': 1, 'stop_chapter': 2})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].startswith('?job='))
+        header = mocked_chord.call_args[0][0]
+        self.assertEqual([shard.args[:2] for shard in header], [(1, 1), (2, 2)])
+        self.assertEqual([shard.options['priority'] for shard in header], [1, 1])
 
     def test_baking_backwards_range_post(self):
         """
@@ -525,7 +1384,8 @@ class TestBakingView(TestCase):
         self.assertContains(response, '<form method="post">')
         self.assertEqual(response.context['message'], 'There was a problem with the supplied chapters to bake!')
 
-    @patch('estoria_app.tasks.bake_chapters.delay')
+    @override_settings(BAKING_ONE_PRIORITY=9, BAKING_RANGE_PRIORITY=1)
+    @patch('estoria_app.tasks.bake_chapters.apply_async')
     def test_baking_sensible_one_post(self, mocked_task):
         """
         'one' POST request of the baking page, with sensible input
@@ -539,6 +1399,10 @@ class TestBakingView(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertTrue(response['Location'].startswith('?job='))
         self.assertTrue(mocked_task.called)
+        # a single chapter goes ahead of the ranges waiting to be baked
+        self.assertTrue(mocked_task.call_args[0][1]['force'])
+        self.assertEqual(mocked_task.call_args[0][1]['project'], 'estoria-digital')
+        self.assertEqual(mocked_task.call_args[1], {'priority': 9})
 
     def test_baking_nonnumerical_one_post(self):
         """
@@ -571,10 +1435,73 @@ class TestBakingView(TestCase):
         self.assertEqual(response.context['message'], 'There was a problem with the supplied chapters to bake!')
 
 
+class TestEditionIndexView(TestCase):
+    """
+    Test the JSON edition index of the baking page
+    """
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp()
+        with open(os.path.join(self.data_path, 'collations.json'), 'w') as fp:
+            json.dump({str(chapter): ['Rubric', '1', '2'] for chapter in range(1, 13)}, fp)
+        session = self.client.session
+        session['project'] = 'estoria-digital'
+        session.save()
+
+    def tearDown(self):
+        collations.clear()
+        shutil.rmtree(self.data_path)
+
+    def test_index_pages(self):
+        """
+        the chapters are split into pages
+        """
+        with self.settings(ESTORIA_DATA_PATH=self.data_path):
+            response = self.client.get(reverse('apparatus_index'), {'page': 3, 'page_size': 5})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([item['chapter'] for item in data['chapters']], [11, 12])
+        self.assertEqual(data['chapters'][0]['verses'], ['Rubric', '1', '2'])
+        self.assertEqual((data['total'], data['has_next'], data['maximum_chapter']), (12, False, 12))
+
+    def test_index_range_and_search(self):
+        """
+        the chapters can be limited to a range and the verses to those matching a context
+        """
+        with self.settings(ESTORIA_DATA_PATH=self.data_path):
+            response = self.client.get(reverse('apparatus_index'),
+                                       {'start_chapter': 2, 'stop_chapter': 11, 'q': 'd1'})
+        data = response.json()
+        self.assertEqual(data['chapters'], [{'chapter': 10, 'verses': ['Rubric', '1', '2']},
+                                            {'chapter': 11, 'verses': ['Rubric', '1', '2']}])
+
+        with self.settings(ESTORIA_DATA_PATH=self.data_path):
+            response = self.client.get(reverse('apparatus_index'), {'q': 'D3S2'})
+        self.assertEqual(response.json()['chapters'], [{'chapter': 3, 'verses': ['2']}])
+
+    def test_index_bad_parameters(self):
+        with self.settings(ESTORIA_DATA_PATH=self.data_path):
+            response = self.client.get(reverse('apparatus_index'), {'page': 'aaa'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_baking_page_has_no_index(self):
+        """
+        the baking page doesn't include the index, which is loaded separately
+        """
+        with self.settings(ESTORIA_DATA_PATH=self.data_path):
+            response = self.client.get(reverse('apparatus'))
+        self.assertContains(response, '<div id="edition-index"></div>')
+        self.assertNotContains(response, 'D1SRubric')
+
+
+@override_settings(CACHES=TEST_CACHES)
 class TestCriticalView(TestCase):
     """
     Test Critical Edition Views
     """
+    def setUp(self):
+        # rebuilds are coalesced through the cache
+        cache.clear()
+
     def test_critical_empty_get(self):
         """
         Empty GET request of the critical edition page
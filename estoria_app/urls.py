@@ -8,6 +8,7 @@ urlpatterns = [
     path('translation', views.translation, name='translation'),
     path('cpsfcritical', views.cpsf_critical, name='cpsfcritical'),
     re_path(r'apparatus/?$', views.apparatus, name='apparatus'),
+    path('apparatus/index.json', views.apparatus_index, name='apparatus_index'),
     re_path(r'apparatus/chapter/(?P<chapter>\d+)/?$', views.chapter, name='chapter'),
     re_path(r'apparatus/(?P<context>D\d+S.+)/?$', views.sentence, name='sentence'),
     path('critical', views.critical, name='critical'),
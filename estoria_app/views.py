@@ -1,26 +1,30 @@
-from .tasks import estoria_xml, reader_xml, translation_xml, cpsf_critical_xml, critical_edition_first, bake_chapters
+from .tasks import estoria_xml, reader_xml, translation_xml, cpsf_critical_xml, critical_edition_first, bake_in_shards
 from djangoproject.forms import UploadFileForm, RangeForm
-from djangoproject.shared import validate_xml
+from djangoproject.shared import save_valid_xml
+from . import collations, rebuilds
 
 from django.shortcuts import render
 from django.urls import reverse
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse
 from celery.result import AsyncResult
 from django.conf import settings
 import os
-import json
-import collections
 
 # TODO: everything in here is to be restricted, via a http digest password
 
+# the number of chapters in each page of the edition index on the baking page, and the most that can be asked for
+INDEX_PAGE_SIZE = 50
+MAX_INDEX_PAGE_SIZE = 500
 
-def _upload_and_process_xml(request, celery_task, file_location, template, title):
+
+def _upload_and_process_xml(request, celery_task, file_location, template, title, incremental=False):
     """
     combined function for the transcriptions and readerxml pages
     :param request: the Django request
     :param celery_task: the name of the Celery task to be run
     :param file_location: the destination for the xml file to be written too
     :param template: the template for render() to use
+    :param incremental: the task supports rebuilding only the files that have changed
     :return: the render object
     """
     message = ''
@@ -35,10 +39,11 @@ def _upload_and_process_xml(request, celery_task, file_location, template, title
         context = {'result': task.result, 'state': task.state, 'task_id': task_id, 'title': title, 'current_project': request.session['project']}
         return render(request, 'estoria_app/show_result.html', context)
 
-    elif request.POST.get('rebuild'):
+    elif request.POST.get('rebuild') or (incremental and request.POST.get('rebuildchanged')):
         """
         If we have a POST request and 'rebuild' in the request then we set off the relevant task
         and send the user to the job result page
+        'rebuildchanged' sets off the task to only rebuild the files that have changed
         """
         scripts_path = os.path.join(settings.ESTORIA_BASE_LOCATION, request.session['project'], 'edition/src/assets/scripts')
         if request.session['project'] == 'estoria-digital':
@@ -46,8 +51,16 @@ def _upload_and_process_xml(request, celery_task, file_location, template, title
         elif request.session['project'] == 'cpsf-digital':
             data_path = settings.CPSF_DATA_PATH
 
-        task = celery_task.delay(data_path, scripts_path)
-        return HttpResponseRedirect('?job={}'.format(task.id))
+        # a rebuild that is already queued or running is joined rather than started again, the full and the
+        # changed files only rebuilds together as both write to the data path
+        pipeline = '{}:{}'.format(celery_task.name, data_path)
+        if request.POST.get('rebuildchanged'):
+            task_id = rebuilds.start_rebuild(request.session['project'], pipeline,
+                                             celery_task, data_path, scripts_path, incremental=True)
+        else:
+            task_id = rebuilds.start_rebuild(request.session['project'], pipeline,
+                                             celery_task, data_path, scripts_path)
+        return HttpResponseRedirect('?job={}'.format(task_id))
 
     elif request.POST.get('upload'):
         """
@@ -56,10 +69,7 @@ def _upload_and_process_xml(request, celery_task, file_location, template, title
         form = UploadFileForm(request.POST, request.FILES)
         if form.is_valid():
             xmlfile = request.FILES['xmlfile']
-            if validate_xml(xmlfile.read()):
-                with open(os.path.join(file_location, xmlfile.name), 'wb+') as destination:
-                    for chunk in xmlfile.chunks():
-                        destination.write(chunk)
+            if save_valid_xml(xmlfile, os.path.join(file_location, xmlfile.name)):
                 message = 'File uploaded'
             else:
                 message = 'The uploaded file is not valid XML'
@@ -98,7 +108,7 @@ def transcriptions(request):
                                           'manuscripts')
     return _upload_and_process_xml(request, estoria_xml, transcription_location,
                                    'estoria_app/transcriptions.html',
-                                   'Transcriptions')
+                                   'Transcriptions', incremental=True)
 
 
 def readerxml(request):
@@ -161,9 +171,6 @@ def apparatus(request):
         data_path = settings.ESTORIA_DATA_PATH
     elif request.session['project'] == 'cpsf-digital':
         data_path = settings.CPSF_DATA_PATH
-    with open(os.path.join(data_path, 'collations.json'), encoding='utf-8') as fp:
-        data = json.load(fp, object_pairs_hook=collections.OrderedDict)
-    maximum_chapter = int(next(reversed(data)))
 
     if 'job' in request.GET:
         """
@@ -181,7 +188,8 @@ def apparatus(request):
     elif request.POST.get('range') or request.POST.get('one'):
         """
         If we have a POST request and 'range' or 'one' is in the request then we check that the input is valid
-        If it is valid then we set off the bake_chapters task and send the user to the job result page
+        If it is valid then we set off the bake_chapters task, split into shards if the range is large,
+        and send the user to the job result page
         """
         if request.POST.get('range'):
             if request.POST.get('start_chapter').isdigit():
@@ -198,13 +206,23 @@ def apparatus(request):
             else:
                 start = stop = -1
 
-        if 1 <= start <= stop <= maximum_chapter:
+        if 1 <= start <= stop <= collations.get_index(data_path).maximum_chapter:
             url = settings.ADMIN_TOOLS_LOCATION + '/apparatus/' + request.session['project']
             if request.session['project'] == 'estoria-digital':
                 data_path = settings.ESTORIA_DATA_PATH
             elif request.session['project'] == 'cpsf-digital':
                 data_path = settings.CPSF_DATA_PATH
-            task = bake_chapters.delay(start, stop, url, data_path)
+            approved_path = os.path.join(settings.ESTORIA_BASE_LOCATION, request.session['project'],
+                                         'collation', 'approved')
+            # a single chapter is always baked, a range skips the chapters that haven't changed unless forced
+            force = bool(request.POST.get('one') or request.POST.get('force'))
+            # someone is waiting on a single chapter, so it goes ahead of the ranges in the baking queue
+            if request.POST.get('one'):
+                priority = getattr(settings, 'BAKING_ONE_PRIORITY', None)
+            else:
+                priority = getattr(settings, 'BAKING_RANGE_PRIORITY', None)
+            task = bake_in_shards(start, stop, url, data_path, approved_path=approved_path, force=force,
+                                  priority=priority, project=request.session['project'])
 
             return HttpResponseRedirect('?job={}'.format(task.id))
         else:
@@ -214,12 +232,45 @@ def apparatus(request):
     return render(request,
                   'estoria_app/app_list.html',
                   {'form': form,
-                   'data': data,
                    'message': message,
                    'current_project': request.session['project']}
                    )
 
 
+def apparatus_index(request):
+    """
+    one page of the edition index as JSON, for the baking page to load as it is needed
+    the GET parameters are all optional: page (from 1), page_size (at most MAX_INDEX_PAGE_SIZE), start_chapter
+    and stop_chapter to limit the range of chapters, and q to only list verses whose context (e.g. D12S3)
+    contains it
+    """
+    if 'project' not in request.session:
+        return JsonResponse({'error': 'No project selected'}, status=400)
+    if request.session['project'] == 'estoria-digital':
+        data_path = settings.ESTORIA_DATA_PATH
+    elif request.session['project'] == 'cpsf-digital':
+        data_path = settings.CPSF_DATA_PATH
+
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+        page_size = min(MAX_INDEX_PAGE_SIZE, max(1, int(request.GET.get('page_size', INDEX_PAGE_SIZE))))
+        start = int(request.GET['start_chapter']) if request.GET.get('start_chapter') else None
+        stop = int(request.GET['stop_chapter']) if request.GET.get('stop_chapter') else None
+    except ValueError:
+        return JsonResponse({'error': 'The page and chapters must be numbers'}, status=400)
+
+    index = collations.get_index(data_path)
+    found = index.find(start, stop, request.GET.get('q', '').strip())
+    chapters = found[(page - 1) * page_size:page * page_size]
+    return JsonResponse({'chapters': [{'chapter': chapter, 'verses': verses} for chapter, verses in chapters],
+                         'page': page,
+                         'page_size': page_size,
+                         'total': len(found),
+                         'has_next': page * page_size < len(found),
+                         'maximum_chapter': index.maximum_chapter,
+                         'total_verses': index.total_verses})
+
+
 def chapter(request, project=None, chapter=None):
 
     if not project:
@@ -291,8 +342,9 @@ def critical(request):
             elif request.session['project'] == 'cpsf-digital':
                 data_path = settings.CPSF_DATA_PATH
 
-            task = critical_edition_first.delay(data_path, scripts_path)
-            return HttpResponseRedirect('?job={}'.format(task.id))
+            task_id = rebuilds.start_rebuild(request.session['project'], critical_edition_first.name,
+                                             critical_edition_first, data_path, scripts_path)
+            return HttpResponseRedirect('?job={}'.format(task_id))
         else:
             message = 'There is a problem. The collation does not appear to exist.'
 
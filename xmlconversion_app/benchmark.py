@@ -0,0 +1,159 @@
+"""
+Offline benchmark of the xmlconversion pipeline
+
+Synthetic TEI transcriptions of a given number of pages are validated as an upload would be, then converted by
+the xmlconversion task in this process, with stand-in versions of the edition's conversion scripts and the real
+resources directory. Each stage reports its wall time, peak memory and bytes written.
+
+    python manage.py benchmark_xmlconversion --pages 10 100 2000 --output results.json
+"""
+from django.core.files.uploadedfile import SimpleUploadedFile
+from djangoproject import benchmarks
+from djangoproject.shared import stream_xml
+from .tasks import xmlconversion
+from . import bundle
+
+import tempfile
+import hashlib
+import random
+import time
+import shutil
+import os
+
+WORDS = ['capitulo', 'del', 'rey', 'don', 'alfonso', 'que', 'fue', 'en', 'espanna', 'los', 'moros', 'cibdat',
+         'toledo', 'et', 'dixo', 'assi', 'commo', 'cuenta', 'la', 'estoria', 'sennor', 'tierra', 'grand', 'guerra']
+
+# parses the manuscripts and writes a json file of the text of each page and the menu, like make_paginated_json.py
+STANDIN_PAGINATED_SCRIPT = """
+import glob, json, os, sys
+from lxml import etree
+TEI = '{http://www.tei-c.org/ns/1.0}'
+data = sys.argv[2]
+menu = {}
+for xml in sorted(glob.glob('../../../../transcriptions/manuscripts/*.xml')):
+    name = os.path.basename(xml).replace('.xml', '')
+    os.makedirs(os.path.join(data, 'transcription', name))
+    menu[name] = []
+    pages = []
+    for element in etree.parse(xml).iter(TEI + 'pb', TEI + 'ab'):
+        if element.tag == TEI + 'pb':
+            pages.append((element.get('n'), []))
+        elif pages:
+            pages[-1][1].append(etree.tostring(element, encoding='unicode'))
+    for page, fragments in pages:
+        with open(os.path.join(data, 'transcription', name, page + '.json'), 'w') as fp:
+            json.dump({'name': page, 'xml': fragments}, fp)
+        menu[name].append(page)
+with open(os.path.join(data, 'menu_data.js'), 'w') as fp:
+    fp.write('MENU_DATA = ' + json.dumps(menu))
+"""
+
+# adds the expanded and abbreviated html of each page, like add_html_to_paginated_json.py
+STANDIN_HTML_SCRIPT = """
+import glob, json, os, sys
+from lxml import etree
+TEI = '{http://www.tei-c.org/ns/1.0}'
+data = sys.argv[2]
+
+def html(fragments, drop):
+    paragraphs = []
+    for fragment in fragments:
+        element = etree.fromstring(fragment)
+        for choice in element.iter(TEI + 'choice'):
+            for unwanted in choice.findall(TEI + drop):
+                choice.remove(unwanted)
+        paragraphs.append('<p id="{}">{}</p>'.format(element.get('n'), ' '.join(element.itertext())))
+    return ''.join(paragraphs)
+
+for page_file in glob.glob(os.path.join(data, 'transcription', '*', '*.json')):
+    with open(page_file) as fp:
+        page = json.load(fp)
+    page['html'] = html(page['xml'], 'abbr')
+    page['html_abbrev'] = html(page['xml'], 'expan')
+    with open(page_file, 'w') as fp:
+        json.dump(page, fp)
+"""
+
+
+def synthetic_transcription(pages, verses_per_page=8, words_per_verse=30, seed=0):
+    """
+    a TEI transcription shaped like the edition's manuscripts
+    :param pages: the number of pages (pb elements)
+    :return: the XML as bytes
+    """
+    rng = random.Random(seed)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+             '<TEI xmlns="http://www.tei-c.org/ns/1.0"><teiHeader><fileDesc><titleStmt>',
+             '<title>Benchmark {} pages</title></titleStmt></fileDesc></teiHeader><text><body>'.format(pages)]
+    verse = 0
+    for page in range(pages):
+        parts.append('<pb n="{}{}"/><cb n="a"/>'.format(page // 2 + 1, 'r' if page % 2 == 0 else 'v'))
+        for i in range(verses_per_page):
+            verse += 1
+            words = []
+            for j in range(words_per_verse):
+                word = rng.choice(WORDS)
+                if j % 7 == 3:
+                    words.append('<choice><abbr>{}</abbr><expan>{}</expan></choice>'.format(word[:2] + '~', word))
+                else:
+                    words.append('<w>{}</w>'.format(word))
+            parts.append('<ab n="D{}S{}">{}</ab>'.format(verse // 20 + 1, verse % 20 + 1, ' '.join(words)))
+    parts.append('</body></text></TEI>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def run_benchmark(page_counts, repeat=1, resources_location=None):
+    """
+    convert synthetic transcriptions of each size and measure each stage
+    :param page_counts: list of the numbers of pages to benchmark
+    :param repeat: the number of runs of each size
+    :param resources_location: the resources directory, defaults to RESOURCES_LOCATION
+    :return: dict of the environment and a result for each run
+    """
+    workdir = tempfile.mkdtemp(prefix='xmlconversion-benchmark-')
+    base_location = os.path.join(workdir, 'base')
+    output_location = os.path.join(workdir, 'output')
+    scripts_path = os.path.join(base_location, 'estoria-digital/edition/src/assets/scripts')
+    os.makedirs(scripts_path)
+    os.makedirs(output_location)
+    with open(os.path.join(scripts_path, 'make_paginated_json.py'), 'w') as fp:
+        fp.write(STANDIN_PAGINATED_SCRIPT)
+    with open(os.path.join(scripts_path, 'add_html_to_paginated_json.py'), 'w') as fp:
+        fp.write(STANDIN_HTML_SCRIPT)
+
+    overrides = {'SCRIPT_RUNNER': 'inprocess', 'ESTORIA_BASE_LOCATION': base_location,
+                 'OUTPUT_LOCATION': output_location, 'CONVERSION_CACHE_MAX_SIZE': None, 'METRICS_LOCATION': None}
+    if resources_location:
+        overrides['RESOURCES_LOCATION'] = resources_location
+    runs = []
+    try:
+        with benchmarks.benchmark_settings(**overrides):
+            # the static bundle is built once per version of the resources, not per conversion
+            bundle.static_bundle()
+            for pages in page_counts:
+                xml = synthetic_transcription(pages)
+                for run in range(repeat):
+                    runs.append(_convert(pages, xml, run, output_location))
+    finally:
+        shutil.rmtree(workdir)
+    return {'benchmark': 'xmlconversion', 'environment': benchmarks.environment(), 'runs': runs}
+
+
+def _convert(pages, xml, run, output_location):
+    tempdir = tempfile.mkdtemp()
+    started = time.perf_counter()
+    with benchmarks.StageRecorder() as recorder:
+        recorder.start('validate upload')
+        with open(os.path.join(tempdir, 'benchmark.xml'), 'wb') as destination:
+            valid = stream_xml(SimpleUploadedFile('benchmark.xml', xml), destination, hashlib.sha256())
+        if not valid:
+            raise ValueError('The synthetic transcription is not well formed')
+        recorder.stop()
+        zipname = xmlconversion('benchmark.xml', tempdir)
+    total = time.perf_counter() - started
+
+    zip_path = os.path.join(output_location, zipname)
+    result = {'pages': pages, 'run': run, 'xml_bytes': len(xml), 'seconds': round(total, 4),
+              'zip_bytes': os.path.getsize(zip_path), 'stages': recorder.stages}
+    os.remove(zip_path)
+    return result
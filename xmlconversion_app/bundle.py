@@ -0,0 +1,97 @@
+"""
+Prebuilt bundle of the static files included in every conversion zip
+
+The js/css/font packages in RESOURCES_LOCATION are compressed once into a zip keyed by a hash of the
+resources, and rebuilt when they change. Each conversion starts from a copy of the bundle and only adds its
+own files, so the static files are never decompressed or recompressed per job.
+"""
+from django.conf import settings
+
+import tempfile
+import hashlib
+import zipfile
+import os
+
+# files that are already compressed are stored rather than deflated again
+STORED_EXTENSIONS = ('.woff', '.woff2', '.png', '.jpg', '.jpeg', '.gif', '.pdf', '.zip', '.gz')
+# the files in RESOURCES_LOCATION that go into the static directory of the output
+STATIC_FILES = ['estoria.js', 'estoria.css']
+STATIC_DIRS = ['deps']
+
+
+def bundle_location():
+    """
+    :return: the directory the bundles are kept in
+    """
+    return getattr(settings, 'ASSET_BUNDLE_LOCATION', None) or os.path.join(settings.OUTPUT_LOCATION, '.bundles')
+
+
+def compress_type(filename):
+    """
+    :param filename: the name of the file to add to a zip
+    :return: the zipfile compression to use for the file
+    """
+    if filename.lower().endswith(STORED_EXTENSIONS):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def static_members(resources_location):
+    """
+    :param resources_location: the resources directory
+    :return: sorted list of (full path, name in the zip) for the static files of the output
+    """
+    members = [(os.path.join(resources_location, name), 'static/' + name) for name in STATIC_FILES]
+    for directory in STATIC_DIRS:
+        for root, dirs, files in os.walk(os.path.join(resources_location, directory)):
+            for name in files:
+                full_path = os.path.join(root, name)
+                members.append((full_path, 'static/' + os.path.relpath(full_path, resources_location)))
+    return sorted(members, key=lambda member: member[1])
+
+
+def resources_fingerprint(resources_location):
+    """
+    a hash of the names, sizes and modification times of the static files, which changes if any of them do
+    :param resources_location: the resources directory
+    :return: the hex digest
+    """
+    sha = hashlib.sha256()
+    for full_path, arcname in static_members(resources_location):
+        stat = os.stat(full_path)
+        sha.update('{}\0{}\0{}\n'.format(arcname, stat.st_size, stat.st_mtime_ns).encode())
+    return sha.hexdigest()
+
+
+def static_bundle(resources_location=None):
+    """
+    the zip of the static files for the current resources, built if it doesn't exist yet
+    :param resources_location: the resources directory, defaults to RESOURCES_LOCATION
+    :return: the full path of the bundle
+    """
+    resources_location = resources_location or settings.RESOURCES_LOCATION
+    location = bundle_location()
+    bundle = os.path.join(location, 'static-{}.zip'.format(resources_fingerprint(resources_location)[:16]))
+    if os.path.isfile(bundle):
+        return bundle
+
+    os.makedirs(location, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=location, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as fp, zipfile.ZipFile(fp, 'w') as zf:
+            for full_path, arcname in static_members(resources_location):
+                zf.write(full_path, arcname, compress_type=compress_type(arcname))
+        # several workers may build the same bundle at once, which is harmless as the rename is atomic
+        os.replace(temporary, bundle)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+    # remove the bundles of older versions of the resources
+    for name in os.listdir(location):
+        if name.startswith('static-') and name.endswith('.zip') and os.path.join(location, name) != bundle:
+            try:
+                os.remove(os.path.join(location, name))
+            except OSError:
+                pass
+    return bundle
@@ -0,0 +1,198 @@
+"""
+Content addressed cache of conversion results
+
+A conversion is identified by the uploaded filename and bytes and a fingerprint of the conversion scripts and
+resources. Each finished conversion records which task made which zip under OUTPUT_LOCATION/.cache, so the
+same upload can be sent straight to the existing result, for as long as the task's result is kept by the
+result backend (CELERY_RESULT_EXPIRES).
+
+A zip counts as used when it is made, downloaded or its upload is converted again. The zips that haven't been
+used for CONVERSION_CACHE_MAX_AGE are deleted, and then the least recently used until the rest fit in
+CONVERSION_CACHE_MAX_SIZE. The results of the tasks that made the deleted zips are forgotten, so their links
+fail straight away.
+"""
+from django.conf import settings
+from djangoproject import status
+from celery.result import AsyncResult
+from . import bundle
+
+import tempfile
+import hashlib
+import json
+import time
+import os
+
+CACHE_DIR = '.cache'
+CONVERSION_SCRIPTS = ['make_paginated_json.py', 'add_html_to_paginated_json.py']
+# the zips left behind by conversions that didn't finish are deleted after this many seconds
+PARTIAL_MAX_AGE = 24 * 60 * 60
+
+
+def cache_location():
+    """
+    :return: the directory of the cache entries
+    """
+    return os.path.join(settings.OUTPUT_LOCATION, CACHE_DIR)
+
+
+def version_fingerprint(scripts_path, resources_location=None):
+    """
+    a hash of everything apart from the upload that the conversion result depends on
+    :param scripts_path: the edition scripts directory
+    :param resources_location: the resources directory, defaults to RESOURCES_LOCATION
+    :return: the hex digest
+    """
+    resources_location = resources_location or settings.RESOURCES_LOCATION
+    sha = hashlib.sha256()
+    for filename in [os.path.join(scripts_path, name) for name in CONVERSION_SCRIPTS] + \
+            [os.path.join(resources_location, 'index.html')]:
+        try:
+            with open(filename, 'rb') as fp:
+                sha.update(fp.read())
+        except FileNotFoundError:
+            sha.update(b'missing')
+    sha.update(bundle.resources_fingerprint(resources_location).encode())
+    return sha.hexdigest()
+
+
+def cache_key(filename, content_hash, version):
+    """
+    :param filename: the uploaded filename, which is used in the output
+    :param content_hash: the sha256 hex digest of the uploaded bytes
+    :param version: the version_fingerprint()
+    :return: the key of the conversion
+    """
+    return hashlib.sha256('{}\0{}\0{}'.format(filename, content_hash, version).encode()).hexdigest()
+
+
+def lookup(key):
+    """
+    find a finished conversion and mark it as used
+    :param key: the cache_key()
+    :return: (task id, zip filename) or None if there is no finished conversion whose result is still known
+    """
+    entry_file = os.path.join(cache_location(), key)
+    try:
+        with open(entry_file, encoding='utf-8') as fp:
+            entry = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if not os.path.isfile(os.path.join(settings.OUTPUT_LOCATION, entry['zipname'])):
+        _remove(entry_file)
+        return None
+    # once the result backend has dropped the task's result, its job page would wait for ever
+    if AsyncResult(entry['task_id']).state != 'SUCCESS':
+        _remove(entry_file)
+        return None
+    try:
+        os.utime(entry_file)
+    except FileNotFoundError:
+        # evicted in the meantime
+        return None
+    return entry['task_id'], entry['zipname']
+
+
+def store(key, task_id, zipname):
+    """
+    record a finished conversion
+    :param key: the cache_key()
+    :param task_id: the id of the task that made the zip
+    :param zipname: the zip filename in OUTPUT_LOCATION
+    """
+    os.makedirs(cache_location(), exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=cache_location(), suffix='.tmp')
+    with os.fdopen(handle, 'w', encoding='utf-8') as fp:
+        json.dump({'task_id': task_id, 'zipname': zipname}, fp)
+    os.replace(temporary, os.path.join(cache_location(), key))
+
+
+def touch(zipname):
+    """
+    record that a zip has been downloaded
+    :param zipname: the zip filename in OUTPUT_LOCATION
+    """
+    try:
+        os.utime(os.path.join(settings.OUTPUT_LOCATION, zipname))
+    except FileNotFoundError:
+        pass
+
+
+def evict(max_size=None, keep=(), max_age=None):
+    """
+    delete the zips that haven't been used for max_age, then the least recently used zips until the rest of
+    the zips in OUTPUT_LOCATION fit in max_size
+    :param max_size: the size budget in bytes, defaults to CONVERSION_CACHE_MAX_SIZE (MB), None to not evict
+    :param keep: zip filenames that must not be deleted
+    :param max_age: seconds, defaults to CONVERSION_CACHE_MAX_AGE (days), None to keep the zips however old
+    :return: list of the zip filenames deleted
+    """
+    if max_size is None:
+        max_megabytes = getattr(settings, 'CONVERSION_CACHE_MAX_SIZE', None)
+        max_size = max_megabytes * 1024 * 1024 if max_megabytes else None
+    if max_age is None:
+        max_days = getattr(settings, 'CONVERSION_CACHE_MAX_AGE', None)
+        max_age = max_days * 24 * 60 * 60 if max_days else None
+    if max_size is None and max_age is None:
+        return []
+
+    # zip filename to list of (entry file, task id)
+    entries = {}
+    if os.path.isdir(cache_location()):
+        for key in os.listdir(cache_location()):
+            entry_file = os.path.join(cache_location(), key)
+            try:
+                with open(entry_file, encoding='utf-8') as fp:
+                    entry = json.load(fp)
+                entries.setdefault(entry['zipname'], []).append((entry_file, entry['task_id']))
+            except (OSError, ValueError, KeyError):
+                continue
+
+    now = time.time()
+    zips = []
+    for name in os.listdir(settings.OUTPUT_LOCATION):
+        full_path = os.path.join(settings.OUTPUT_LOCATION, name)
+        # another conversion or eviction may put in place or delete any of these files in the meantime
+        try:
+            if name.endswith('.part') and now - os.path.getmtime(full_path) > PARTIAL_MAX_AGE:
+                _remove(full_path)
+            elif name.endswith('.zip') and os.path.isfile(full_path):
+                last_used = max([os.path.getmtime(full_path)] + _mtimes(entries.get(name, [])))
+                zips.append((last_used, name, os.path.getsize(full_path)))
+        except FileNotFoundError:
+            continue
+
+    total = sum(size for last_used, name, size in zips)
+    removed = []
+    for last_used, name, size in sorted(zips):
+        expired = max_age is not None and now - last_used > max_age
+        if not expired and (max_size is None or total <= max_size):
+            continue
+        if name in keep:
+            continue
+        _remove(os.path.join(settings.OUTPUT_LOCATION, name))
+        for entry_file, task_id in entries.get(name, []):
+            _remove(entry_file)
+            status.forget(task_id)
+        total -= size
+        removed.append(name)
+    return removed
+
+
+def _mtimes(entries):
+    """
+    :return: the modification times of the entry files that are still there
+    """
+    mtimes = []
+    for entry_file, task_id in entries:
+        try:
+            mtimes.append(os.path.getmtime(entry_file))
+        except FileNotFoundError:
+            continue
+    return mtimes
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
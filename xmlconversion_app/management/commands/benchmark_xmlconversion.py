@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from djangoproject.benchmarks import write_results
+from xmlconversion_app.benchmark import run_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the xmlconversion pipeline offline on synthetic transcriptions and print the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, nargs='+', default=[10, 100, 500, 2000],
+                            help='the sizes of the synthetic transcriptions, in pages')
+        parser.add_argument('--repeat', type=int, default=1, help='the number of runs of each size')
+        parser.add_argument('--resources', help='the resources directory, defaults to RESOURCES_LOCATION')
+        parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        results = run_benchmark(options['pages'], repeat=options['repeat'], resources_location=options['resources'])
+        write_results(results, options['output'], self.stdout)
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from xmlconversion_app import cache
+
+
+class Command(BaseCommand):
+    help = 'Delete the conversion zips that are too old or don\'t fit in the size budget'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-size', type=float,
+                            help='the size budget in MB, defaults to CONVERSION_CACHE_MAX_SIZE')
+        parser.add_argument('--max-age', type=float,
+                            help='days since a zip was last used, defaults to CONVERSION_CACHE_MAX_AGE')
+
+    def handle(self, *args, **options):
+        max_size = options['max_size'] * 1024 * 1024 if options['max_size'] is not None else None
+        max_age = options['max_age'] * 24 * 60 * 60 if options['max_age'] is not None else None
+        for name in cache.evict(max_size=max_size, max_age=max_age):
+            self.stdout.write('deleted {}'.format(name))
@@ -1,24 +1,38 @@
 from __future__ import absolute_import, unicode_literals
 from celery import shared_task, current_task
 from django.conf import settings
+from djangoproject.runner import run_script
+from djangoproject.progress import TaskProgress
+from djangoproject import metrics, scratch
+from . import bundle, cache
 
 import os
 import shutil
-import re
 import logging
-import subprocess
 import tempfile
+import zipfile
 import json
+import time
 
 logger = logging.getLogger(__name__)
 
 
-@shared_task
-def xmlconversion(xml_filename, tempdir):
+def conversion_scripts_path():
+    """
+    :return: the location of the edition scripts used for the conversion
+    """
+    return os.path.join(settings.ESTORIA_BASE_LOCATION, 'estoria-digital/edition/src/assets/scripts')
+
+
+# acknowledged once it has finished, so a conversion whose worker dies is run again, which is safe as the zip is
+# only put in place by its last step and the conversions are well within RabbitMQ's consumer_timeout
+@shared_task(acks_late=True)
+def xmlconversion(xml_filename, tempdir, cache_key=None):
     """
     xml processing script
+    :param cache_key: if given, the result is recorded in the conversion cache under this key
     """
-    scripts_path = os.path.join(settings.ESTORIA_BASE_LOCATION, 'estoria-digital/edition/src/assets/scripts')
+    scripts_path = conversion_scripts_path()
     # TODO consider hard coded paths in here and if any should be variables or constants
     logger.info('{}: xmlconversion task started'.format(current_task.request.id))
     logger.debug('{}: Scripts location: {}'.format(current_task.request.id, scripts_path))
@@ -26,66 +40,117 @@ def xmlconversion(xml_filename, tempdir):
     logger.debug('{}: Output location: {}'.format(current_task.request.id, settings.OUTPUT_LOCATION))
     logger.debug('{}: Temporary directory: {}'.format(current_task.request.id, tempdir))
 
+    progress = TaskProgress(current_task.request.id)
     try:
         logger.debug('{}: create directory structure'.format(current_task.request.id))
+        progress.step('prepare the conversion')
         os.makedirs(os.path.join(tempdir, 'transcriptions/manuscripts'))
         os.makedirs(os.path.join(tempdir, 'edition/static/data'))
         os.makedirs(os.path.join(tempdir, 'edition/src/assets/scripts'))
-        os.makedirs(os.path.join(tempdir, 'output/static'))
 
         logger.debug('{}: add XML'.format(current_task.request.id))
         shutil.move(os.path.join(tempdir, xml_filename), os.path.join(tempdir, 'transcriptions/manuscripts/'))
 
-        logger.debug('{}: copy over scripts'.format(current_task.request.id))
-
-        shutil.copy(os.path.join(scripts_path, 'make_paginated_json.py'),
-                    os.path.join(tempdir, 'edition/src/assets/scripts/'))
-        shutil.copy(os.path.join(scripts_path, 'add_html_to_paginated_json.py'),
-                    os.path.join(tempdir, 'edition/src/assets/scripts/'))
+        logger.debug('{}: link the scripts'.format(current_task.request.id))
+        with metrics.timer('estoria_file_copy_duration_seconds', step='link conversion scripts'):
+            for script in ('make_paginated_json.py', 'add_html_to_paginated_json.py'):
+                scratch.link(os.path.join(scripts_path, script),
+                             os.path.join(tempdir, 'edition/src/assets/scripts', script))
         logger.debug('{}: run make_paginated_json.py'.format(current_task.request.id))
-        python_path = os.path.join(settings.VIRTUAL_ENV_PATH, 'bin', 'python3')
-        subprocess.check_output([python_path, 'make_paginated_json.py', '-d', os.path.join(tempdir, 'edition/static/data')], cwd=os.path.join(tempdir, 'edition/src/assets/scripts/'), stderr=subprocess.STDOUT)
+        progress.step('run make_paginated_json.py')
+        run_script('make_paginated_json.py', ['-d', os.path.join(tempdir, 'edition/static/data')],
+                   os.path.join(tempdir, 'edition/src/assets/scripts/'), capture=True)
 
         logger.debug('{}: run add_html_to_paginated_json.py'.format(current_task.request.id))
-        subprocess.check_call([python_path, 'add_html_to_paginated_json.py', '-d', os.path.join(tempdir, 'edition/static/data')], cwd=os.path.join(tempdir, 'edition/src/assets/scripts/'))
+        progress.step('run add_html_to_paginated_json.py')
+        run_script('add_html_to_paginated_json.py', ['-d', os.path.join(tempdir, 'edition/static/data')],
+                   os.path.join(tempdir, 'edition/src/assets/scripts/'))
 
-        logger.debug('{}: move edition/transcription/[dirname] to output/json'.format(current_task.request.id))
         dirname = xml_filename.replace('.xml', '')
-        shutil.copytree(os.path.join(tempdir, 'edition/static/data/transcription/', dirname), os.path.join(tempdir, 'output/json'))
-
-        logger.debug('{}: copy in the js/css/font packages to output'.format(current_task.request.id))
-        shutil.copytree(os.path.join(settings.RESOURCES_LOCATION, 'deps'), os.path.join(tempdir, 'output/static/deps'))
-        shutil.copy(os.path.join(settings.RESOURCES_LOCATION, 'estoria.js'), os.path.join(tempdir, 'output/static/'))
-        shutil.copy(os.path.join(settings.RESOURCES_LOCATION, 'estoria.css'), os.path.join(tempdir, 'output/static/'))
-
-        logger.debug('{}: build html from generated json files'.format(current_task.request.id))
-        menu = json.loads(open(os.path.join(tempdir, 'edition/static/data/menu_data.js')).read().replace('MENU_DATA = ', ''))
-        index_string = open(os.path.join(settings.RESOURCES_LOCATION, 'index.html')).read()
-
-        abbreviated_list = []
-        expanded_list = []
-        for file in menu[dirname]:
-            data = json.loads(open(os.path.join(tempdir, 'output/json', '{}.json'.format(file))).read());
-            abbreviated_list.append('<div class="panel-body" id="abbr-{}"><span class="page">{}</span>'.format(data['name'], data['name']))
-            abbreviated_list.append(data['html_abbrev'])
-            abbreviated_list.append('</div>')
-
-            expanded_list.append('<div class="panel-body" id="abbr-{}"><span class="page">{}</span>'.format(data['name'], data['name']))
-            expanded_list.append(data['html'])
-            expanded_list.append('</div>')
-
-        index_string = index_string.replace('%SGLM%', dirname)
-        index_string = index_string.replace('%ABBRVTD%', ''.join(abbreviated_list))
-        index_string = index_string.replace('%EXPNDD%', ''.join(expanded_list))
-        with open(os.path.join(tempdir, 'output/index.html'), 'w') as outfile:
-            outfile.write(index_string)
-
-        logger.debug('{}: zip up the result and copy to output location'.format(current_task.request.id))
-        zipname = re.sub('^' + tempfile.gettempdir() + '/', '', tempdir)
-        shutil.make_archive(os.path.join(settings.OUTPUT_LOCATION, zipname), 'zip', os.path.join(tempdir, 'output/'))
+        pages_path = os.path.join(tempdir, 'edition/static/data/transcription/', dirname)
+        zipname = os.path.basename(tempdir.rstrip('/'))
+        zip_path = os.path.join(settings.OUTPUT_LOCATION, '{}.zip'.format(zipname))
+
+        logger.debug('{}: start the zip from the prebuilt js/css/font bundle'.format(current_task.request.id))
+        progress.step('write the zip')
+        # the zip is written under a temporary name and only renamed into place once it is complete,
+        # the bundle's members are copied as they are and only the files of this job are compressed
+        zip_started = time.monotonic()
+        handle, partial_path = tempfile.mkstemp(dir=settings.OUTPUT_LOCATION, prefix='.', suffix='.part')
+        os.close(handle)
+        try:
+            shutil.copyfile(bundle.static_bundle(), partial_path)
+            with zipfile.ZipFile(partial_path, 'a') as zf:
+                logger.debug('{}: add edition/transcription/[dirname] to the zip as json'.format(
+                    current_task.request.id))
+                for name in sorted(os.listdir(pages_path)):
+                    zf.write(os.path.join(pages_path, name), 'json/' + name, compress_type=bundle.compress_type(name))
+
+                logger.debug('{}: build html from generated json files'.format(current_task.request.id))
+                menu = json.loads(open(os.path.join(tempdir, 'edition/static/data/menu_data.js')).read().replace('MENU_DATA = ', ''))
+                index_string = open(os.path.join(settings.RESOURCES_LOCATION, 'index.html')).read()
+
+                abbreviated_list = []
+                expanded_list = []
+                for file in menu[dirname]:
+                    data = json.loads(open(os.path.join(pages_path, '{}.json'.format(file))).read());
+                    abbreviated_list.append('<div class="panel-body" id="abbr-{}"><span class="page">{}</span>'.format(data['name'], data['name']))
+                    abbreviated_list.append(data['html_abbrev'])
+                    abbreviated_list.append('</div>')
+
+                    expanded_list.append('<div class="panel-body" id="abbr-{}"><span class="page">{}</span>'.format(data['name'], data['name']))
+                    expanded_list.append(data['html'])
+                    expanded_list.append('</div>')
+
+                index_string = index_string.replace('%SGLM%', dirname)
+                index_string = index_string.replace('%ABBRVTD%', ''.join(abbreviated_list))
+                index_string = index_string.replace('%EXPNDD%', ''.join(expanded_list))
+                zf.writestr('index.html', index_string, compress_type=bundle.compress_type('index.html'))
+
+            logger.debug('{}: move the zip into the output location'.format(current_task.request.id))
+            # mkstemp only lets this user read the file, but the web server may run as another user
+            os.chmod(partial_path, 0o644 & ~_umask())
+            os.replace(partial_path, zip_path)
+            metrics.observe('estoria_zip_build_duration_seconds', time.monotonic() - zip_started)
+        except BaseException:
+            os.remove(partial_path)
+            raise
     finally:
         logger.debug('{}: delete the unneeded tmp folder'.format(current_task.request.id))
         shutil.rmtree(tempdir)
 
+    if cache_key:
+        cache.store(cache_key, current_task.request.id, '{0}.zip'.format(zipname))
+    try:
+        evicted = cache.evict(keep=['{0}.zip'.format(zipname)])
+    except Exception as e:
+        # the conversion has succeeded, whatever happens to the eviction, which celery beat runs again anyway
+        logger.warning('{}: could not evict from the conversion cache: {!r}'.format(current_task.request.id, e))
+        evicted = []
+    if evicted:
+        logger.debug('{}: evicted from the conversion cache: {}'.format(current_task.request.id, ', '.join(evicted)))
+
+    progress.finish()
     logger.info('{}: complete, so return the zip filename {}'.format(current_task.request.id, zipname))
     return '{0}.zip'.format(zipname)
+
+
+def _umask():
+    """
+    :return: the umask of this process
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+@shared_task(acks_late=True)
+def evict_conversions():
+    """
+    delete the conversion zips that are too old or don't fit in the size budget, run periodically by celery beat
+    :return: list of the zip filenames deleted
+    """
+    evicted = cache.evict()
+    logger.info('{}: evicted from the conversion cache: {}'.format(current_task.request.id,
+                                                                   ', '.join(evicted) or 'nothing'))
+    return evicted
@@ -1,11 +1,13 @@
 from .tasks import xmlconversion
 from .apps import XmlconversionAppConfig
+from . import bundle, cache, benchmark
 
 from django.apps import apps
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.core.files.base import ContentFile
 from django.conf import settings
+from django.core.management import call_command
 
 from testfixtures import log_capture
 from unittest.mock import patch
@@ -13,6 +15,12 @@ from types import SimpleNamespace
 from celery import result
 import celery
 import tempfile
+import io
+import hashlib
+import time
+import zipfile
+import stat
+import shutil
 import re
 import os
 
@@ -30,20 +38,30 @@ class TestXmlconversion(TestCase):
     """
     Test Celery tasks
     """
+    # the file based cache and the metrics write through the mocked functions, so they are kept in memory here
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                       METRICS_LOCATION=None)
     @patch('subprocess.check_call')
     @patch('subprocess.check_output')
     @patch('os.makedirs')
     @patch('shutil.move')
-    @patch('shutil.copytree')
     @patch('shutil.copy')
     @patch('builtins.open', create=True)
     @patch('json.loads')
     @patch('shutil.rmtree')
-    @patch('shutil.make_archive')
+    @patch('shutil.copyfile')
+    @patch('xmlconversion_app.bundle.static_bundle')
+    @patch('zipfile.ZipFile')
+    @patch('tempfile.mkstemp', return_value=(3, 'tmp.part'))
+    @patch('os.close')
+    @patch('os.listdir', return_value=['1r.json'])
+    @patch('os.replace')
+    @patch('os.chmod')
     @log_capture('xmlconversion_app.tasks')
-    def test_xmlconversion_run_task(self, capture, mocked_make_archive, mocked_rmtree, mocked_json_loads,
-                                    mocked_open, mocked_copy, mocked_copytree, mocked_move,
-                                    mocked_makedirs, mocked_check_output, mocked_check_call):
+    def test_xmlconversion_run_task(self, capture, mocked_chmod, mocked_replace, mocked_listdir, mocked_close, mocked_mkstemp,
+                                    mocked_zipfile, mocked_static_bundle, mocked_copyfile, mocked_rmtree,
+                                    mocked_json_loads, mocked_open, mocked_copy, mocked_move, mocked_makedirs,
+                                    mocked_check_output, mocked_check_call):
         """
         Test the xmlconversion task
         A pile of functions are mocked
@@ -55,10 +73,13 @@ class TestXmlconversion(TestCase):
         self.assertTrue(mocked_check_output.called)
         self.assertTrue(mocked_makedirs.called)
         self.assertTrue(mocked_move.called)
-        self.assertTrue(mocked_copytree.called)
         self.assertTrue(mocked_copy.called)
         self.assertTrue(mocked_rmtree.called)
-        self.assertTrue(mocked_make_archive.called)
+        self.assertTrue(mocked_static_bundle.called)
+        self.assertTrue(mocked_copyfile.called)
+        self.assertTrue(mocked_zipfile.called)
+        self.assertEqual(mocked_replace.call_args[0], ('tmp.part', os.path.join(settings.OUTPUT_LOCATION, 'tmp.zip')))
+        self.assertEqual(mocked_chmod.call_args[0][0], 'tmp.part')
 
         capture.check(
             ('xmlconversion_app.tasks', 'INFO', '{}: xmlconversion task started'.format(self.task.id)),
@@ -74,29 +95,248 @@ class TestXmlconversion(TestCase):
 
             ('xmlconversion_app.tasks', 'DEBUG', '{}: create directory structure'.format(self.task.id)),
             ('xmlconversion_app.tasks', 'DEBUG', '{}: add XML'.format(self.task.id)),
-            ('xmlconversion_app.tasks', 'DEBUG', '{}: copy over scripts'.format(self.task.id)),
+            ('xmlconversion_app.tasks', 'DEBUG', '{}: link the scripts'.format(self.task.id)),
             ('xmlconversion_app.tasks', 'DEBUG', '{}: run make_paginated_json.py'.format(self.task.id)),
             ('xmlconversion_app.tasks', 'DEBUG', '{}: run add_html_to_paginated_json.py'.format(self.task.id)),
             ('xmlconversion_app.tasks', 'DEBUG',
-             '{}: move edition/transcription/[dirname] to output/json'.format(self.task.id)),
-            ('xmlconversion_app.tasks', 'DEBUG', '{}: copy in the js/css/font packages to output'.format(self.task.id)),
-            ('xmlconversion_app.tasks', 'DEBUG', '{}: build html from generated json files'.format(self.task.id)),
+             '{}: start the zip from the prebuilt js/css/font bundle'.format(self.task.id)),
             ('xmlconversion_app.tasks', 'DEBUG',
-             '{}: zip up the result and copy to output location'.format(self.task.id)),
+             '{}: add edition/transcription/[dirname] to the zip as json'.format(self.task.id)),
+            ('xmlconversion_app.tasks', 'DEBUG', '{}: build html from generated json files'.format(self.task.id)),
+            ('xmlconversion_app.tasks', 'DEBUG', '{}: move the zip into the output location'.format(self.task.id)),
             ('xmlconversion_app.tasks', 'DEBUG', '{}: delete the unneeded tmp folder'.format(self.task.id)),
             ('xmlconversion_app.tasks', 'INFO',
              '{}: complete, so return the zip filename {}'.format(self.task.id, re.sub('^/tmp/', '', 'tmp'))),
         )
 
 
+FAKE_PAGINATED_SCRIPT = """
+import glob, json, os, sys
+data = sys.argv[2]
+menu = {}
+for xml in glob.glob('../../../../transcriptions/manuscripts/*.xml'):
+    name = os.path.basename(xml).replace('.xml', '')
+    os.makedirs(os.path.join(data, 'transcription', name))
+    menu[name] = []
+    for page in ('1r', '1v'):
+        with open(os.path.join(data, 'transcription', name, page + '.json'), 'w') as fp:
+            json.dump({'name': page, 'html': '<p>' + page + '</p>', 'html_abbrev': '<p>' + page + '.</p>'}, fp)
+        menu[name].append(page)
+with open(os.path.join(data, 'menu_data.js'), 'w') as fp:
+    fp.write('MENU_DATA = ' + json.dumps(menu))
+"""
+
+
+class TestXmlconversionOutput(TestCase):
+    """
+    Test the xmlconversion task end to end, with stand in versions of the scripts
+    """
+    def setUp(self):
+        self.base_location = tempfile.mkdtemp()
+        self.output_location = tempfile.mkdtemp()
+        scripts_path = os.path.join(self.base_location, 'estoria-digital/edition/src/assets/scripts')
+        os.makedirs(scripts_path)
+        with open(os.path.join(scripts_path, 'make_paginated_json.py'), 'w') as fp:
+            fp.write(FAKE_PAGINATED_SCRIPT)
+        with open(os.path.join(scripts_path, 'add_html_to_paginated_json.py'), 'w') as fp:
+            fp.write('')
+        self.settings = override_settings(SCRIPT_RUNNER='inprocess', ESTORIA_BASE_LOCATION=self.base_location,
+                                          OUTPUT_LOCATION=self.output_location)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.base_location)
+        shutil.rmtree(self.output_location)
+
+    def _convert(self):
+        tempdir = tempfile.mkdtemp()
+        with open(os.path.join(tempdir, 'Y.xml'), 'w') as fp:
+            fp.write('<a/>')
+        task = xmlconversion.apply(args=('Y.xml', tempdir))
+        self.assertEqual(task.state, 'SUCCESS')
+        return os.path.join(self.output_location, task.get())
+
+    def test_xmlconversion_output_zip(self):
+        """
+        the zip has the pages, the index page and the static files, with the fonts stored uncompressed
+        """
+        with zipfile.ZipFile(self._convert()) as zf:
+            names = zf.namelist()
+            self.assertIn('index.html', names)
+            self.assertIn('json/1r.json', names)
+            self.assertIn('static/estoria.js', names)
+            self.assertIn('static/deps/jquery.min.js', names)
+            self.assertIn('<p>1v.</p>', zf.read('index.html').decode())
+            self.assertEqual(zf.getinfo('static/deps/junicode-woff/Junicode.woff').compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(zf.getinfo('index.html').compress_type, zipfile.ZIP_DEFLATED)
+            self.assertIsNone(zf.testzip())
+        self.assertEqual([name for name in os.listdir(self.output_location) if name.endswith('.part')], [])
+
+    def test_xmlconversion_zip_readable(self):
+        """
+        the zip can be read by other users, such as the web server's, as the umask allows
+        """
+        umask = os.umask(0o022)
+        try:
+            zip_path = self._convert()
+        finally:
+            os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(zip_path).st_mode), 0o644)
+
+    @patch.object(celery.result.AsyncResult, 'state', 'SUCCESS')
+    def test_xmlconversion_result_cached(self):
+        """
+        a conversion with a cache key is recorded in the cache
+        """
+        tempdir = tempfile.mkdtemp()
+        with open(os.path.join(tempdir, 'Y.xml'), 'w') as fp:
+            fp.write('<a/>')
+        task = xmlconversion.apply(args=('Y.xml', tempdir), kwargs={'cache_key': 'key'})
+        self.assertEqual(cache.lookup('key'), (task.id, task.get()))
+
+    def test_static_bundle_reused(self):
+        """
+        the static bundle is built once and reused while the resources are unchanged
+        """
+        self._convert()
+        bundles = os.listdir(bundle.bundle_location())
+        with patch('zipfile.ZipFile.write') as mocked_write:
+            bundle.static_bundle()
+            self.assertFalse(mocked_write.called)
+        self._convert()
+        self.assertEqual(os.listdir(bundle.bundle_location()), bundles)
+
+
+class TestConversionCache(TestCase):
+    """
+    Test the cache of conversion results
+    """
+    def setUp(self):
+        self.output_location = tempfile.mkdtemp()
+        self.settings = override_settings(OUTPUT_LOCATION=self.output_location)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.output_location)
+
+    def _make_zip(self, name, size, age):
+        with open(os.path.join(self.output_location, name), 'wb') as fp:
+            fp.write(b'x' * size)
+        os.utime(os.path.join(self.output_location, name), (time.time() - age, time.time() - age))
+
+    @patch.object(celery.result.AsyncResult, 'state', 'SUCCESS')
+    def test_store_and_lookup(self):
+        """
+        a stored conversion is found while its zip exists
+        """
+        self.assertIsNone(cache.lookup('key'))
+        cache.store('key', 'job', 'a.zip')
+        self.assertIsNone(cache.lookup('key'))
+        cache.store('key', 'job', 'a.zip')
+        self._make_zip('a.zip', 10, 0)
+        self.assertEqual(cache.lookup('key'), ('job', 'a.zip'))
+
+    @patch.object(celery.result.AsyncResult, 'state', 'PENDING')
+    def test_lookup_expired_result(self):
+        """
+        a conversion whose task result has expired isn't found, so the upload is converted again
+        """
+        cache.store('key', 'job', 'a.zip')
+        self._make_zip('a.zip', 10, 0)
+        self.assertIsNone(cache.lookup('key'))
+        self.assertEqual(os.listdir(cache.cache_location()), [])
+
+    @patch.object(celery.result.AsyncResult, 'state', 'SUCCESS')
+    def test_lookup_evicted_meanwhile(self):
+        """
+        a conversion evicted while it is looked up is a miss
+        """
+        cache.store('key', 'job', 'a.zip')
+        self._make_zip('a.zip', 10, 0)
+        with patch('os.utime', side_effect=FileNotFoundError):
+            self.assertIsNone(cache.lookup('key'))
+
+    def test_version_fingerprint(self):
+        """
+        the fingerprint changes when a conversion script changes
+        """
+        scripts_path = tempfile.mkdtemp()
+        first = cache.version_fingerprint(scripts_path)
+        with open(os.path.join(scripts_path, 'make_paginated_json.py'), 'w') as fp:
+            fp.write('changed')
+        self.assertNotEqual(cache.version_fingerprint(scripts_path), first)
+        shutil.rmtree(scripts_path)
+
+    @patch.object(celery.result.AsyncResult, 'state', 'SUCCESS')
+    def test_evict_least_recently_used(self):
+        """
+        the least recently used zips are deleted until the rest fit in the budget
+        """
+        self._make_zip('old.zip', 100, 300)
+        self._make_zip('used.zip', 100, 200)
+        self._make_zip('new.zip', 100, 100)
+        # using a zip through the cache makes it recently used
+        cache.store('key', 'job', 'used.zip')
+        self.assertEqual(cache.lookup('key'), ('job', 'used.zip'))
+        self.assertEqual(cache.evict(max_size=150), ['old.zip', 'new.zip'])
+        self.assertEqual(os.listdir(self.output_location), ['.cache', 'used.zip'])
+        self.assertEqual(cache.evict(max_size=50, keep=['used.zip']), [])
+
+    @patch('djangoproject.status.forget')
+    def test_evict_expired(self, mocked_forget):
+        """
+        the zips that haven't been used for the maximum age are deleted, along with their task results,
+        and so are partial zips left behind by conversions that didn't finish
+        """
+        self._make_zip('old.zip', 10, 3 * 24 * 60 * 60)
+        self._make_zip('new.zip', 10, 0)
+        self._make_zip('.abc.part', 10, 2 * 24 * 60 * 60)
+        self._make_zip('.def.part', 10, 0)
+        cache.store('key', 'oldjob', 'old.zip')
+        os.utime(os.path.join(cache.cache_location(), 'key'), (time.time() - 3 * 24 * 60 * 60,) * 2)
+        with override_settings(CONVERSION_CACHE_MAX_SIZE=None, CONVERSION_CACHE_MAX_AGE=2):
+            self.assertEqual(cache.evict(), ['old.zip'])
+        mocked_forget.assert_called_once_with('oldjob')
+        self.assertEqual(sorted(os.listdir(self.output_location)), ['.cache', '.def.part', 'new.zip'])
+        self.assertEqual(os.listdir(cache.cache_location()), [])
+
+    def test_evict_files_gone(self):
+        """
+        files another conversion or eviction removes while the zips are checked are left out
+        """
+        self._make_zip('old.zip', 100, 300)
+        listdir = os.listdir
+
+        def listdir_with_gone(path):
+            names = listdir(path)
+            return names + ['gone.zip', '.gone.part'] if path == self.output_location else names
+
+        with patch('os.listdir', side_effect=listdir_with_gone):
+            self.assertEqual(cache.evict(max_size=50), ['old.zip'])
+
+    def test_downloads_are_used(self):
+        """
+        downloading a zip keeps it over the zips that haven't been downloaded
+        """
+        self._make_zip('downloaded.zip', 100, 300)
+        self._make_zip('new.zip', 100, 100)
+        cache.touch('downloaded.zip')
+        cache.touch('missing.zip')
+        out = io.StringIO()
+        call_command('evict_conversions', '--max-size', str(150 / 1024 / 1024), stdout=out)
+        self.assertEqual(out.getvalue(), 'deleted new.zip\n')
+
+
 class TestIndexView(TestCase):
     """
     Test Index Views
     """
-    def _mocked_xmlconversion(a, b):
+    def _mocked_xmlconversion(a, b, **kwargs):
         """
         fake the response of xmlconversion.delay()
-        the two inputs are unimportant
+        the inputs are unimportant
         outputs an id of 'fakeid', so that task.id works
         """
         d = {'id': 'fakeid'}
@@ -181,7 +421,10 @@ class TestIndexView(TestCase):
     @patch('xmlconversion_app.tasks.xmlconversion.delay', side_effect=_mocked_xmlconversion)
     @patch('tempfile.mkdtemp')
     @patch('builtins.open')
-    def test_index_upload_xmlfile_post(self, mocked_task, mocked_mkdtemp, mocked_open):
+    @patch('xmlconversion_app.cache.version_fingerprint', return_value='version')
+    @patch('xmlconversion_app.cache.lookup', return_value=None)
+    def test_index_upload_xmlfile_post(self, mocked_lookup, mocked_fingerprint, mocked_task, mocked_mkdtemp,
+                                       mocked_open):
         """
         'upload' POST request of the index page, with a valid XML file
         should set off the task and push the user to the job status page
@@ -196,6 +439,45 @@ class TestIndexView(TestCase):
         self.assertTrue(mocked_mkdtemp.called)
         self.assertTrue(mocked_open.called)
 
+    @patch.object(celery.result.AsyncResult, 'state', 'SUCCESS')
+    @patch('xmlconversion_app.tasks.xmlconversion.delay')
+    @patch('xmlconversion_app.cache.version_fingerprint', return_value='version')
+    def test_index_upload_cached_xmlfile_post(self, mocked_fingerprint, mocked_task):
+        """
+        'upload' POST request of the index page, with a file that has already been converted
+        should push the user to the existing job status page without setting off a task
+        """
+        output_location = tempfile.mkdtemp()
+        with override_settings(OUTPUT_LOCATION=output_location):
+            key = cache.cache_key('test.xml', hashlib.sha256(b'<a><b></b></a>').hexdigest(), 'version')
+            cache.store(key, 'oldjob', 'old.zip')
+            with open(os.path.join(output_location, 'old.zip'), 'wb') as fp:
+                fp.write(b'zip')
+            url = reverse('xmlconversion-index')
+            faked_file = ContentFile('<a><b></b></a>')
+            faked_file.name = 'test.xml'
+            response = self.client.post(url, {'upload': 'Upload', 'xmlfile': faked_file})
+        shutil.rmtree(output_location)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], '?job=oldjob')
+        self.assertFalse(mocked_task.called)
+
+    @patch('xmlconversion_app.tasks.xmlconversion.delay')
+    @patch('djangoproject.scratch.free_space', return_value=0)
+    def test_index_upload_scratch_full_post(self, mocked_free_space, mocked_task):
+        """
+        'upload' POST request of the index page, while the scratch space is nearly full
+        should get an error message without setting off a task
+        """
+        url = reverse('xmlconversion-index')
+        faked_file = ContentFile('<a><b></b></a>')
+        faked_file.name = 'test.xml'
+        with override_settings(SCRATCH_MIN_FREE=1):
+            response = self.client.post(url, {'upload': 'Upload', 'xmlfile': faked_file})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['message'], 'The server is busy, please try again later')
+        self.assertFalse(mocked_task.called)
+
     def test_index_upload_nonvalidxmlfile_post(self):
         """
         'upload' POST request of the index page, with a invalid XML file
@@ -247,6 +529,39 @@ class TestIndexView(TestCase):
         self.assertEqual(response['Content-Type'], 'application/zip')
         settings.OUTPUT_LOCATION = output_location
 
+    @patch.object(celery.result.AsyncResult, 'result', 'test.zip')
+    def test_index_download_file_streamed_and_ranges(self):
+        """
+        'file' GET request of the index page, with and without a Range header
+        should stream the whole file, or just the requested bytes
+        """
+        output_location = tempfile.mkdtemp()
+        with open(os.path.join(output_location, 'test.zip'), 'wb') as fp:
+            fp.write(b'0123456789')
+        url = reverse('xmlconversion-index')
+        with override_settings(OUTPUT_LOCATION=output_location):
+            response = self.client.get(url, {'file': 'test'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Accept-Ranges'], 'bytes')
+            self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+            response = self.client.get(url, {'file': 'test'}, HTTP_RANGE='bytes=2-4')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+            self.assertEqual(b''.join(response.streaming_content), b'234')
+
+            response = self.client.get(url, {'file': 'test'}, HTTP_RANGE='bytes=-3')
+            self.assertEqual(b''.join(response.streaming_content), b'789')
+
+            response = self.client.get(url, {'file': 'test'}, HTTP_RANGE='bytes=20-')
+            self.assertEqual(response.status_code, 416)
+
+            with override_settings(DOWNLOAD_SENDFILE='x-accel-redirect', DOWNLOAD_ACCEL_PREFIX='/protected/'):
+                response = self.client.get(url, {'file': 'test'})
+                self.assertEqual(response['X-Accel-Redirect'], '/protected/test.zip')
+                self.assertEqual(response.content, b'')
+        shutil.rmtree(output_location)
+
     @patch.object(celery.result.AsyncResult, 'result', 'onion')
     def test_index_download_file_nonexistent_file_get(self):
         """
@@ -259,3 +574,30 @@ class TestIndexView(TestCase):
         self.assertContains(response, '<h1>XML to JSON Conversion</h1>')
         self.assertContains(response, '<form method="post" enctype="multipart/form-data">')
         self.assertEqual(response.context['message'], 'There was a problem with the file download')
+
+
+class TestBenchmark(TestCase):
+    """
+    Test the offline xmlconversion benchmark
+    """
+    def test_synthetic_transcription(self):
+        xml = benchmark.synthetic_transcription(4)
+        self.assertEqual(xml.count(b'<pb '), 4)
+        self.assertEqual(xml, benchmark.synthetic_transcription(4))
+
+    def test_run_benchmark(self):
+        """
+        each run reports the zip size and the measurements of every stage
+        """
+        previous = (settings.OUTPUT_LOCATION, settings.SCRIPT_RUNNER)
+        results = benchmark.run_benchmark([3], repeat=2)
+        self.assertEqual([(run['pages'], run['run']) for run in results['runs']], [(3, 0), (3, 1)])
+        run = results['runs'][0]
+        self.assertGreater(run['zip_bytes'], 0)
+        self.assertEqual([stage['name'] for stage in run['stages']],
+                         ['validate upload', 'prepare the conversion', 'run make_paginated_json.py',
+                          'run add_html_to_paginated_json.py', 'write the zip'])
+        for stage in run['stages']:
+            self.assertGreater(stage['peak_rss_bytes'], 0)
+        # the stand-in locations are only used while the benchmark runs
+        self.assertEqual((settings.OUTPUT_LOCATION, settings.SCRIPT_RUNNER), previous)
@@ -1,12 +1,15 @@
-from .tasks import xmlconversion
+from .tasks import xmlconversion, conversion_scripts_path
+from . import cache
 from djangoproject.forms import UploadFileForm
-from djangoproject.shared import validate_xml
+from djangoproject.shared import stream_xml, serve_file
+from djangoproject import scratch
 
 from django.shortcuts import render
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect
 from celery.result import AsyncResult
 from django.conf import settings
-import tempfile
+import hashlib
+import shutil
 import os
 
 
@@ -35,10 +38,9 @@ def index(request):
         if task.result:
             file_and_path = os.path.join(settings.OUTPUT_LOCATION, task.result)
             if ('/' not in task.result) and os.path.isfile(file_and_path):
-                response = HttpResponse(content_type='application/zip')
-                response['Content-Disposition'] = 'attachment; filename=' + task.result
-                response.write(open(file_and_path, 'rb').read())
-                return response
+                # a downloaded zip is kept for longer than the ones nobody is using
+                cache.touch(task.result)
+                return serve_file(request, file_and_path, task.result, 'application/zip')
             else:
                 message = 'There was a problem with the file download'
         else:
@@ -51,14 +53,31 @@ def index(request):
         form = UploadFileForm(request.POST, request.FILES)
         if form.is_valid():
             xmlfile = request.FILES['xmlfile']
-            if validate_xml(xmlfile.read()):
-                tempdir = tempfile.mkdtemp()
+            try:
+                tempdir = scratch.mkdtemp()
+            except scratch.ScratchFullError:
+                return render(request, 'xmlconversion_app/index.html',
+                              {'form': form, 'message': 'The server is busy, please try again later'})
+            upload_hash = hashlib.sha256()
+            try:
                 with open(os.path.join(tempdir, xmlfile.name), 'wb+') as destination:
-                    for chunk in xmlfile.chunks():
-                        destination.write(chunk)
-                task = xmlconversion.delay(xmlfile.name, tempdir)
+                    valid = stream_xml(xmlfile, destination, upload_hash)
+            except BaseException:
+                shutil.rmtree(tempdir)
+                raise
+            if valid:
+                # the same file converted by the same scripts goes straight to the existing result
+                key = cache.cache_key(xmlfile.name, upload_hash.hexdigest(),
+                                      cache.version_fingerprint(conversion_scripts_path()))
+                cached = cache.lookup(key)
+                if cached:
+                    shutil.rmtree(tempdir)
+                    return HttpResponseRedirect('?job=' + cached[0])
+
+                task = xmlconversion.delay(xmlfile.name, tempdir, cache_key=key)
                 return HttpResponseRedirect('?job=' + task.id)
             else:
+                shutil.rmtree(tempdir)
                 message = 'The uploaded file is not valid XML'
         else:
             message = 'There was a problem with the file upload'